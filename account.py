@@ -18,20 +18,22 @@ have type that begins with sliver.
 There are any number of race conditions that may result from the fact
 that account names are not unique over time.  Moreover, it's a bad
 idea to perform lengthy operations while holding the database lock.
-In order to deal with both of these problems, we use a worker thread
-for each account name that ever exists.  On 32-bit systems with large
-numbers of accounts, this may cause the NM process to run out of
-*virtual* memory!  This problem may be remedied by decreasing the
-maximum stack size.
+In order to deal with both of these problems, the operations on accounts
+are run by a bounded pool of threads (see WorkerPool), that runs the
+operations on a given account name one at a time and in order, while
+operations on different names proceed in parallel.  How many creations
+and starts may run at the same time is set with configure_pool().
 """
 
 import os
-import pwd, grp
+import time
 import threading
 import subprocess
+import collections
 
 import logger
 import tools
+import pwcache
 
 
 # shell path -> account class association
@@ -39,9 +41,10 @@ shell_acct_class = {}
 # account type -> account class association
 type_acct_class = {}
 
-# these semaphores are acquired before creating/destroying an account
+# these semaphores are acquired before creating/destroying/starting an account
 create_sem = threading.Semaphore(1)
 destroy_sem = threading.Semaphore(1)
+start_sem = threading.Semaphore(4)
 
 def register_class(acct_class):
     """
@@ -58,7 +61,7 @@ name_worker_lock = threading.Lock()
 name_worker = {}
 
 def allpwents():
-    return [pw_ent for pw_ent in pwd.getpwall() if pw_ent[6] in shell_acct_class]
+    return [pw_ent for pw_ent in pwcache.getpwall() if pw_ent[6] in shell_acct_class]
 
 def all():
     """Return the names of all accounts on the system with recognized shells."""
@@ -78,6 +81,183 @@ def get(name):
         name_worker_lock.release()
 
 
+class Job:
+    """
+    An operation submitted to the WorkerPool.
+    """
+
+    def __init__(self, name, label, function, args, background):
+        self.name = name
+        self.label = label
+        self.function = function
+        self.args = args
+        # nobody waits for background jobs, so they log their own errors
+        self.background = background
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.result = self.function(*self.args)
+        except BaseException as e:
+            self.error = e
+            if self.background:
+                logger.log_exc("account: {} failed".format(self.label), name=self.name)
+        finally:
+            self.finished = time.time()
+            self.event.set()
+
+    def wait(self):
+        """wait for the job to complete, and return its result or raise its exception"""
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PoolStats:
+    """
+    Queue depth and latency figures for the WorkerPool
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        # label -> [count, total wait, max wait, total run, max run]
+        self.latencies = {}
+
+    def queued(self, depth):
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+
+    def done(self, job):
+        wait = job.started - job.submitted
+        run = job.finished - job.started
+        with self.lock:
+            figures = self.latencies.setdefault(job.label, [0, 0., 0., 0., 0.])
+            figures[0] += 1
+            figures[1] += wait
+            figures[2] = max(figures[2], wait)
+            figures[3] += run
+            figures[4] = max(figures[4], run)
+
+    def summary(self, depth):
+        with self.lock:
+            parts = ["depth {} (max {})".format(depth, self.max_depth)]
+            for label, (count, wait, max_wait, run, max_run) in sorted(self.latencies.items()):
+                parts.append("{} x{} wait {:.2f}/{:.2f}s run {:.2f}/{:.2f}s"
+                             .format(label, count, wait / count, max_wait, run / count, max_run))
+        return " - ".join(parts)
+
+
+class WorkerPool:
+    """
+    A bounded pool of threads to run the operations on accounts.
+    Jobs for a given account name are run one at a time, in submission order;
+    jobs for different names run in parallel, up to the number of threads.
+    With threads set to 0, jobs are run right away by the submitting thread.
+    """
+
+    def __init__(self, threads=8):
+        self.threads = threads
+        self.cond = threading.Condition()
+        self.idle = threading.Condition(self.cond)
+        # name -> deque of pending jobs; present while it has jobs or is busy
+        self.queues = {}
+        # names that have pending jobs and that no thread is working on
+        self.ready = collections.deque()
+        self.busy = set()
+        self.running_threads = 0
+        # called each time the pool runs out of work
+        self.idle_hooks = []
+        self.stats = PoolStats()
+        self.local = threading.local()
+
+    def current(self):
+        """the account name the calling thread is working on, if it belongs to the pool"""
+        return getattr(self.local, 'name', None)
+
+    def depth(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, name, label, function, args=(), background=False):
+        job = Job(name, label, function, args, background)
+        if self.threads <= 0:
+            job.run()
+            self.stats.done(job)
+            return job
+        with self.cond:
+            queue = self.queues.setdefault(name, collections.deque())
+            queue.append(job)
+            if len(queue) == 1 and name not in self.busy:
+                self.ready.append(name)
+            self.stats.queued(sum(len(queue) for queue in self.queues.values()))
+            while self.running_threads < self.threads:
+                self.running_threads += 1
+                tools.as_daemon_thread(self._run)
+            self.cond.notify()
+        return job
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                name = self.ready.popleft()
+                self.busy.add(name)
+                job = self.queues[name].popleft()
+            self.local.name = name
+            job.run()
+            self.local.name = None
+            self.stats.done(job)
+            with self.cond:
+                self.busy.discard(name)
+                if self.queues[name]:
+                    self.ready.append(name)
+                    self.cond.notify()
+                else:
+                    del self.queues[name]
+                idle = not self.queues
+                if idle:
+                    self.idle.notify_all()
+            if idle:
+                logger.verbose("account: worker pool idle - {}".format(self.stats.summary(0)))
+                for hook in self.idle_hooks:
+                    try:
+                        hook()
+                    except:
+                        logger.log_exc("account: worker pool idle hook failed")
+
+    def wait_idle(self, timeout=None):
+        """wait until all submitted jobs are done; returns False on timeout"""
+        with self.cond:
+            return self.idle.wait_for(lambda: not self.queues, timeout)
+
+
+pool = WorkerPool()
+
+def configure_pool(threads=None, creates=None, starts=None):
+    """
+    Set the number of threads in the pool, and how many accounts may be
+    created and started at the same time; to be called before the pool is used.
+    """
+    global create_sem, start_sem
+    if threads is not None:
+        pool.threads = threads
+    if creates is not None:
+        create_sem = threading.Semaphore(max(1, creates))
+    if starts is not None:
+        start_sem = threading.Semaphore(max(1, starts))
+    logger.log("account: worker pool with {} threads, creates={} starts={}"
+               .format(pool.threads, creates, starts))
+
+
 class Account:
     """
     Base class for all types of account
@@ -105,8 +285,8 @@ class Account:
         logger.verbose('account: configuring {} with {} keys'.format(self.name, nb_keys))
         if new_keys != self.keys:
             # get the unix account info
-            gid = grp.getgrnam("slices")[2]
-            pw_info = pwd.getpwnam(self.name)
+            gid = pwcache.getgrnam("slices")[2]
+            pw_info = pwcache.getpwnam(self.name)
             uid = pw_info[2]
             pw_dir = pw_info[5]
 
@@ -141,6 +321,15 @@ class Account:
         pass
     def is_running(self):
         pass
+
+    @classmethod
+    def running_names(cls, accounts):
+        """
+        The names of all the running slivers of that class, in one go;
+        accounts maps names to account classes, as found in the password database.
+        None means the class cannot tell, and each sliver gets asked in turn.
+        """
+        return None
     def needs_reimage(self, target_slicefamily):
         stampname = "/vservers/{}/etc/slicefamily".format(self.name)
         try:
@@ -201,12 +390,67 @@ class Account:
             logger.log_exc("_manage_ssh_dir failed : {}".format(e), name=slicename)
 
 class Worker:
+    """
+    The operations on an account; they all go through the pool, so that
+    they get serialized with the ones submitted in the background.
+    """
 
     def __init__(self, name):
         self.name = name  # username
         self._acct = None  # the account object currently associated with this worker
 
+    def _submit(self, label, function, *args):
+        """queue function in the background; returns the Job"""
+        return pool.submit(self.name, label, function, args, background=True)
+
+    def _call(self, label, function, *args):
+        """run function in the pool and wait for its outcome"""
+        if pool.current() == self.name:
+            # already working for that account, e.g. ensure_created calling start
+            return function(*args)
+        return pool.submit(self.name, label, function, args).wait()
+
     def ensure_created(self, rec):
+        return self._call('ensure_created', self._ensure_created, rec)
+
+    def apply(self, action):
+        """queue the work for a planner.Action; returns the Job, or None"""
+        if action.kind == 'noop':
+            return None
+        return self._submit(action.kind, self._apply, action)
+
+    def _apply(self, action):
+        if action.kind == 'destroy':
+            self._ensure_destroyed()
+            return
+        rec = action.rec
+        curr_class = self._get_class()
+        next_class = type_acct_class[rec['type']]
+        if (action.kind == 'create') == (next_class == curr_class):
+            # the account has changed since the plan was made,
+            # typically because of jobs that were still pending
+            logger.verbose("account.Worker.apply: {} - outdated {}, checking again"
+                           .format(self.name, action.kind))
+            self._ensure_created(rec)
+            return
+        if action.kind == 'create':
+            self._create(curr_class, next_class, rec)
+        if not isinstance(self._acct, next_class):
+            self._acct = next_class(rec)
+        logger.verbose("account.Worker.apply: {} {} ({})"
+                       .format(action.kind, self.name, action.reason))
+        if action.start:
+            self.start(rec)
+        else:
+            self.configure(rec)
+
+    def _create(self, curr_class, next_class, rec):
+        self._destroy(curr_class)
+        create_sem.acquire()
+        try: next_class.create(self.name, rec)
+        finally: create_sem.release()
+
+    def _ensure_created(self, rec):
         """
         Check account type is still valid.  If not, recreate sliver.
         If still valid, check if running and configure/start if not.
@@ -216,10 +460,7 @@ class Worker:
         curr_class = self._get_class()
         next_class = type_acct_class[rec['type']]
         if next_class != curr_class:
-            self._destroy(curr_class)
-            create_sem.acquire()
-            try: next_class.create(self.name, rec)
-            finally: create_sem.release()
+            self._create(curr_class, next_class, rec)
         if not isinstance(self._acct, next_class):
             self._acct = next_class(rec)
         logger.verbose("account.Worker.ensure_created: {}, running={}"
@@ -247,17 +488,33 @@ class Worker:
                 self.configure(rec)
 
     def ensure_destroyed(self):
+        return self._call('ensure_destroyed', self._ensure_destroyed)
+
+    def _ensure_destroyed(self):
         self._destroy(self._get_class())
 
     # take rec as an arg here for api_calls
     def start(self, rec, d = 0):
-        self._acct.configure(rec)
-        self._acct.start(delay=d)
+        return self._call('start', self._start, rec, d)
+
+    def _start(self, rec, d):
+        start_sem.acquire()
+        try:
+            self._acct.configure(rec)
+            self._acct.start(delay=d)
+        finally:
+            start_sem.release()
 
     def configure(self, rec):
+        return self._call('configure', self._acct_configure, rec)
+
+    def _acct_configure(self, rec):
         self._acct.configure(rec)
 
     def stop(self):
+        return self._call('stop', self._stop)
+
+    def _stop(self):
         self._acct.stop()
 
     def is_running(self):
@@ -294,8 +551,36 @@ class Worker:
 
     def _get_class(self):
         try:
-            shell = pwd.getpwnam(self.name)[6]
+            shell = pwcache.getpwnam(self.name)[6]
         except KeyError:
             return None
         return shell_acct_class[shell]
 
+
+
+# a little self-test of the pool
+if __name__ == '__main__':
+    test_pool = WorkerPool(threads=4)
+    order = []
+    def step(name, i):
+        time.sleep(0.05)
+        order.append((name, i))
+        return i
+    beg = time.time()
+    jobs = [test_pool.submit(name, 'step', step, (name, i))
+            for i in range(3) for name in ['a', 'b', 'c', 'd']]
+    assert test_pool.wait_idle(5)
+    # 4 names in parallel, 3 steps each
+    assert time.time() - beg < 0.5
+    for name in 'abcd':
+        assert [i for (n, i) in order if n == name] == [0, 1, 2]
+    assert [job.wait() for job in jobs] == [i for i in range(3) for name in 'abcd']
+    def fail():
+        raise KeyError('boom')
+    try:
+        test_pool.submit('a', 'fail', fail).wait()
+        assert False
+    except KeyError:
+        pass
+    print(test_pool.stats.summary(test_pool.depth()))
+    print("account: OK")
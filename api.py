@@ -13,15 +13,16 @@ import xmlrpc.server
 import socketserver
 import errno
 import os
-import pwd
 import socket
 import struct
 import threading
 import xmlrpc.client
 import sys
+import copy
 
 import database
 import tools
+import pwcache
 from api_calls import *
 import logger
 
@@ -36,13 +37,20 @@ except:
 API_SERVER_PORT = 812
 UNIX_ADDR = '/tmp/nodemanager.api'
 
+# anyone can call these
+OPEN_METHODS = ('Help', 'Ticket', 'GetXIDs', 'GetSSHKeys', 'GetBandwidthRates')
+# only root can call these
+ROOT_METHODS = ('SyncNow',)
+
 class APIRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
     # overriding _dispatch to achieve this effect is officially deprecated,
     # but I can't figure out how to get access to .request without
     # duplicating SimpleXMLRPCServer code here, which is more likely to
     # change than the deprecated behavior is to be broken
 
-    @database.synchronized
+    # calls do not take the database lock: records come from the
+    # latest snapshot, so they do not wait behind a sync; the few
+    # calls that change the database lock it themselves, briefly
     def _dispatch(self, method_name_unicode, args):
         method_name = str(method_name_unicode)
         try: method = api_method_dict[method_name]
@@ -62,13 +70,19 @@ class APIRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
             sizeof_struct_ucred = 12
             ucred = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, sizeof_struct_ucred)
             xid = struct.unpack('3i', ucred)[1]
-            caller_name = pwd.getpwuid(xid)[0]
+            caller_name = pwcache.getpwuid(xid)[0]
             # Special case : the sfa component manager
             if caller_name == PLC_SLICE_PREFIX+"_sfacm":
                 try: result = method(*args)
                 except Exception as err: raise xmlrpc.client.Fault(104, 'Error in call: %s' %err)
             # Anyone can call these functions
-            elif method_name in ('Help', 'Ticket', 'GetXIDs', 'GetSSHKeys'):
+            elif method_name in OPEN_METHODS:
+                try: result = method(*args)
+                except Exception as err: raise xmlrpc.client.Fault(104, 'Error in call: %s' %err)
+            # Only root can call these
+            elif method_name in ROOT_METHODS:
+                if caller_name != 'root':
+                    raise xmlrpc.client.Fault(108, '%s: Permission denied.' % caller_name)
                 try: result = method(*args)
                 except Exception as err: raise xmlrpc.client.Fault(104, 'Error in call: %s' %err)
             else: # Execute anonymous call.
@@ -78,8 +92,10 @@ class APIRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
                 else:
                     target_name = args[0]
 
-                # Gather target slice's object.
-                target_rec = database.db.get(target_name)
+                # Gather target slice's object - a private copy
+                target_rec = database.db.snapshot().get(target_name)
+                if target_rec is not None:
+                    target_rec = copy.deepcopy(dict(target_rec))
 
                 # only work on slivers or self. Sanity check.
                 if not (target_rec and target_rec['type'].startswith('sliver.')):
@@ -110,3 +126,24 @@ def start():
     serv2 = APIServer_UNIX(UNIX_ADDR, requestHandler=APIRequestHandler, logRequests=0)
     tools.as_daemon_thread(serv2.serve_forever)
     os.chmod(UNIX_ADDR, 0o666)
+
+
+# a little self-test of the dispatching, as seen from a made-up caller
+if __name__ == '__main__':
+    # the other calls take the target sliver as their first argument,
+    # except for GetRecord that is about the caller
+    for (method_name, nargs) in nargs_dict.items():
+        assert nargs > 0 or method_name in OPEN_METHODS + ROOT_METHODS + ('GetRecord',), \
+            "%s takes no argument, but is left to the sliver check" % method_name
+
+    class FakeRequest:
+        def __init__(self, uid):
+            self.uid = uid
+        def getsockopt(self, level, option, size):
+            return struct.pack('3i', os.getpid(), self.uid, 0)
+
+    handler = APIRequestHandler.__new__(APIRequestHandler)
+    handler.request = FakeRequest(os.getuid())
+    rates = handler._dispatch('GetBandwidthRates', ())
+    assert isinstance(rates, dict), rates
+    print("api: OK")
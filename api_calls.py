@@ -13,7 +13,6 @@ import xmlrpc.server
 import socketserver
 import errno
 import os
-import pwd
 import socket
 import struct
 import threading
@@ -29,6 +28,7 @@ except:
 
 import account
 import logger
+import pwcache
 
 # TODO: These try/excepts are a hack to allow doc/DocBookLocal.py to
 # import this file in order to extract the documentation from each
@@ -38,6 +38,7 @@ try: import database
 except: import logger as database
 import ticket as ticket_module
 import tools
+import trigger
 
 deliver_ticket = None  # set in slivermanager.start()
 
@@ -119,7 +120,7 @@ def Ticket(ticket):
         if data != None:
             deliver_ticket(data)
         logger.log('api_calls: Ticket delivered for %s' % name)
-        Create(database.db.get(name))
+        Create(database.db.snapshot().get(name))
     except Exception as err:
         raise xmlrpc.client.Fault(102, 'Ticket error: ' + str(err))
 
@@ -135,7 +136,7 @@ def AdminTicket(ticket):
         if data != None:
             deliver_ticket(data)
         logger.log('api_calls: Admin Ticket delivered for %s' % name)
-        Create(database.db.get(name))
+        Create(database.db.snapshot().get(name))
     except Exception as err:
         raise xmlrpc.client.Fault(102, 'Ticket error: ' + str(err))
 
@@ -146,7 +147,7 @@ def AdminTicket(ticket):
 @export_to_api(0)
 def GetXIDs():
     """Return an dictionary mapping Slice names to XIDs"""
-    return dict([(pwent[0], pwent[2]) for pwent in pwd.getpwall() if pwent[6] == slivermanager.sliver_password_shell])
+    return dict([(pwent[0], pwent[2]) for pwent in pwcache.getpwall() if pwent[6] == slivermanager.sliver_password_shell])
 
 @export_to_docbook(roles=['self'],
                    accepts=[],
@@ -155,12 +156,36 @@ def GetXIDs():
 def GetSSHKeys():
     """Return an dictionary mapping slice names to SSH keys"""
     keydict = {}
-    for rec in database.db.values():
+    for rec in database.db.snapshot().values():
         if 'keys' in rec:
             keydict[rec['name']] = rec['keys']
     return keydict
 
 
+@export_to_docbook(roles=['self'],
+                   accepts=[],
+                   returns={ 'sliver_name' : Parameter(dict, 'the current rates, in bit/s')})
+@export_to_api(0)
+def GetBandwidthRates():
+    """Return a dictionary mapping slice names to their current bandwidth use,
+    as sampled by bwmon every few seconds: 'rate' is the average over the
+    last minute, 'ewma' a moving average, and 'p95' the 95th percentile,
+    all in bit/s; the 'i2' variants are for the exempt class."""
+    import bwmon
+    return bwmon.get_rates()
+
+
+@export_to_docbook(roles=['root'],
+                   accepts=[],
+                   returns=Parameter(int, '1 if successful'))
+@export_to_api(0)
+def SyncNow():
+    """Hint the Node Manager that it should sync with PLC shortly,
+    rather than wait for its next periodic poll. Hints are coalesced,
+    and are ignored unless nodemanager runs with --hints."""
+    trigger.hint("SyncNow API call")
+
+
 @export_to_docbook(roles=['nm-controller', 'self'],
                     accepts=[Parameter(str, 'A sliver/slice name.')],
                    returns=Parameter(int, '1 if successful'))
@@ -281,8 +306,14 @@ def SetLoans(sliver_name, loans):
     rec = sliver_name
     if not validate_loans(loans):
         raise xmlrpc.client.Fault(102, 'Invalid argument: the second argument must be a well-formed loan specification')
-    rec['_loans'] = loans
-    database.db.sync()
+    # rec is a copy, the change goes to the live record
+    with database.db_lock:
+        live_rec = database.db.get(rec['name'])
+        if live_rec is None:
+            raise xmlrpc.client.Fault(102, 'Invalid argument: %s has vanished' % rec['name'])
+        live_rec['_loans'] = loans
+        snapshot = database.db.prepare_sync()
+    database.db.execute_sync(snapshot)
 
 @export_to_docbook(roles=['nm-controller', 'self'],
                    returns=Parameter(dict, 'Record dictionary'))
@@ -16,18 +16,26 @@
 #
 
 import os
-import sys
 import time
-import pickle
 import socket
-import copy
 import threading
 
-import plnode.bwlimit as bwlimit
+try:
+    import plnode.bwlimit as bwlimit
+except ImportError:
+    # off a node, e.g. under bwsim, that plugs in its own - see use_kernel()
+    bwlimit = None
 
 import logger
+import mailqueue
 import tools
 import database
+import bwstate
+import expiry
+import capengine
+import pwcache
+import tcbackend
+import timeseries
 from config import Config
 
 priority = 20
@@ -38,16 +46,43 @@ DEBUG = False
 # Set ENABLE to False to setup buckets, but not limit.
 ENABLE = True
 
+STATE_FILE = "/var/lib/nodemanager/bwmon.state"
+# where the state used to be pickled, imported once into STATE_FILE
 DB_FILE = "/var/lib/nodemanager/bwmon.pickle"
 
+# How to talk to tc: 'netlink', 'shell', or 'auto' for netlink when it works; see tcbackend
+BACKEND = 'auto'
+
+# The HTB byte counters get sampled every SAMPLE_INTERVAL seconds, on top of the
+# runs that follow database syncs; the last SAMPLE_COUNT samples are kept
+SAMPLE_INTERVAL = 10
+SAMPLE_COUNT = 360
+# the rates reported by get_rates() are averaged over that many seconds
+RATE_WINDOW = 60
+
 # Constants
 seconds_per_day = 24 * 60 * 60
 bits_per_byte = 8
 
-dev_default = tools.get_default_if()
+# probed on first use, see init_defaults()
+dev_default = None
+backend = None
+# what time it is; bwsim runs bwmon in virtual time
+clock = time.time
+# the bwstate.Store; it keeps the slices in memory from one run to the next
+state = None
+# slice name -> when it leaves deaddb; built again from each deaddb
+# that state.load() reads from the file, i.e. the one kept below
+dead_expiry = expiry.ExpiryIndex()
+dead_expiry_deaddb = None
+# xid -> byte counters in the low and high bandwidth classes, see sample()
+series = timeseries.Series(SAMPLE_COUNT)
+i2series = timeseries.Series(SAMPLE_COUNT)
+# xid -> (usedbytes, usedi2bytes) past which an uncapped slice needs capping
+thresholds = {}
 # Burst to line rate (or node cap).  Set by NM. in KBit/s
-default_MaxRate = int(bwlimit.get_bwcap(dev_default) / 1000)
-default_Maxi2Rate = int(bwlimit.bwmax / 1000)
+default_MaxRate = None
+default_Maxi2Rate = None
 # 5.4 Gbyte per day. 5.4 * 1024 k * 1024M * 1024G
 # 5.4 Gbyte per day max allowed transfered per recording period
 # 5.4 Gbytes per day is aprox 512k/s for 24hrs (approx because original math was wrong
@@ -131,41 +166,12 @@ def format_period(seconds):
     else:
         return "%.0f seconds" % seconds
 
-def slicemail(slice, subject, body):
+def slicemail(slice, subject, body, key = None):
     '''
-    Front end to sendmail.  Sends email to slice alias with given subject and body.
+    Front end to the mail queue.  Sends email to slice alias with given subject and body,
+    in the background; a key that was used already within the same period is ignored.
     '''
-    config = Config()
-    sendmail = os.popen("/usr/sbin/sendmail -N never -t -f%s" % config.PLC_MAIL_SUPPORT_ADDRESS, "w")
-
-    # Parsed from MyPLC config
-    to = [config.PLC_MAIL_MOM_LIST_ADDRESS]
-
-    if slice is not None and slice != "root":
-        to.append(config.PLC_MAIL_SLICE_ADDRESS.replace("SLICE", slice))
-
-    header = {'from': "%s Support <%s>" % (config.PLC_NAME,
-                                           config.PLC_MAIL_SUPPORT_ADDRESS),
-              'to': ", ".join(to),
-              'version': sys.version.split(" ")[0],
-              'subject': subject}
-
-    # Write headers
-    sendmail.write(
-"""
-Content-type: text/plain
-From: %(from)s
-Reply-To: %(from)s
-To: %(to)s
-X-Mailer: Python/%(version)s
-Subject: %(subject)s
-
-""".lstrip() % header)
-
-    # Write body
-    sendmail.write(body)
-    # Done
-    sendmail.close()
+    mailqueue.queue.put(slice, subject, body, key)
 
 
 class Slice:
@@ -189,6 +195,11 @@ class Slice:
 
     """
 
+    __slots__ = ['xid', 'name', 'time', 'bytes', 'i2bytes',
+                 'MaxRate', 'MinRate', 'Maxi2Rate', 'Mini2Rate',
+                 'MaxKByte', 'ThreshKByte', 'Maxi2KByte', 'Threshi2KByte',
+                 'Share', 'Sharei2', 'emailed', 'capped']
+
     def __init__(self, xid, name, rspec):
         self.xid = xid
         self.name = name
@@ -209,7 +220,7 @@ class Slice:
         self.capped = False
 
         self.updateSliceTags(rspec)
-        bwlimit.set(
+        backend.set(
             xid=self.xid, dev=dev_default,
             minrate=self.MinRate * 1000,
             maxrate=self.MaxRate * 1000,
@@ -220,6 +231,14 @@ class Slice:
     def __repr__(self):
         return self.name
 
+    def __setstate__(self, state):
+        # the objects in a legacy bwmon.pickle have a plain __dict__
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        for (attribute, value) in state.items():
+            if attribute in self.__slots__:
+                setattr(self, attribute, value)
+
     def updateSliceTags(self, rspec):
         '''
         Use respects from GetSlivers to PLC to populate slice object.  Also
@@ -293,7 +312,7 @@ class Slice:
         self.updateSliceTags(rspec)
 
         # Reset baseline time
-        self.time = time.time()
+        self.time = clock()
 
         # Reset baseline byte coutns
         self.bytes = runningrates.get('usedbytes', 0)
@@ -318,7 +337,7 @@ class Slice:
                            (self.name,
                             bwlimit.format_tc_rate(maxrate),
                             bwlimit.format_tc_rate(maxi2rate)))
-            bwlimit.set(xid = self.xid, dev = dev_default,
+            backend.set(xid = self.xid, dev = dev_default,
                 minrate = self.MinRate * 1000,
                 maxrate = self.MaxRate * 1000,
                 maxexemptrate = self.Maxi2Rate * 1000,
@@ -334,7 +353,7 @@ class Slice:
         params = {'slice': self.name, 'hostname': socket.gethostname(),
                   'since': time.asctime(time.gmtime(self.time)) + " GMT",
                   'until': time.asctime(time.gmtime(self.time + period)) + " GMT",
-                  'date': time.asctime(time.gmtime()) + " GMT",
+                  'date': time.asctime(time.gmtime(clock())) + " GMT",
                   'period': format_period(period)}
 
         if new_maxrate != (self.MaxRate * 1000):
@@ -367,7 +386,8 @@ class Slice:
             else:
                 self.emailed = True
                 logger.log("bwmon: Emailing %s" % self.name)
-                slicemail(self.name, subject, message + (footer % params))
+                slicemail(self.name, subject, message + (footer % params),
+                          key = "bwcap %s %d" % (self.name, self.time))
 
 
     def update(self, runningrates, rspec):
@@ -375,6 +395,16 @@ class Slice:
         Update byte counts and check if byte thresholds have been
         exceeded. If exceeded, cap to remaining bytes in limit over remaining time in period.
         Recalculate every time module runs.
+        This is for one slice; sync() does all slices as one capengine.Batch.
+        """
+        batch = capengine.Batch()
+        self.prepare(batch, runningrates, rspec)
+        for result in batch.compute(clock(), period):
+            self.apply(result, runningrates)
+
+    def prepare(self, batch, runningrates, rspec):
+        """
+        First half of update(): refresh the limits, and add the slice to batch.
         """
         # cache share for later comparison
         runningrates['share'] = self.Share
@@ -382,78 +412,110 @@ class Slice:
         # Query Node Manager for max rate overrides
         self.updateSliceTags(rspec)
 
-        usedbytes = runningrates['usedbytes']
-        usedi2bytes = runningrates['usedi2bytes']
-
-        # Check limits.
-        if usedbytes >= (self.bytes + (self.ThreshKByte * 1024)):
-            sum = self.bytes + (self.ThreshKByte * 1024)
-            maxbyte = self.MaxKByte * 1024
-            bytesused = usedbytes - self.bytes
-            timeused = int(time.time() - self.time)
-            # Calcuate new rate. in bit/s
-            new_maxrate = int(((maxbyte - bytesused) * 8)
-                              / (period - timeused))
-            # Never go under MinRate
-            if new_maxrate < (self.MinRate * 1000):
-                new_maxrate = self.MinRate * 1000
-            # State information.  I'm capped.
-            self.capped += True
-        else:
-            # Sanity Check
-            new_maxrate = self.MaxRate * 1000
-            self.capped += False
-
-        if usedi2bytes >= (self.i2bytes + (self.Threshi2KByte * 1024)):
-            maxi2byte = self.Maxi2KByte * 1024
-            i2bytesused = usedi2bytes - self.i2bytes
-            timeused = int(time.time() - self.time)
-            # Calcuate New Rate.
-            new_maxi2rate = int(((maxi2byte - i2bytesused) * 8)
-                                /(period - timeused))
-            # Never go under MinRate
-            if new_maxi2rate < (self.Mini2Rate * 1000):
-                new_maxi2rate = self.Mini2Rate * 1000
-            # State information.  I'm capped.
-            self.capped += True
-        else:
-            # Sanity
-            new_maxi2rate = self.Maxi2Rate * 1000
-            self.capped += False
+        batch.add(self, self.time,
+                  (runningrates['usedbytes'], self.bytes, self.ThreshKByte, self.MaxKByte,
+                   self.MinRate, self.MaxRate),
+                  (runningrates['usedi2bytes'], self.i2bytes, self.Threshi2KByte, self.Maxi2KByte,
+                   self.Mini2Rate, self.Maxi2Rate),
+                  (runningrates['maxrate'], runningrates['minrate'], runningrates['maxexemptrate'],
+                   runningrates.get('minexemptrate'), runningrates['share']),
+                  self.Share)
+
+    def apply(self, result, runningrates):
+        """
+        Second half of update(): apply the capengine.Result computed for the slice.
+        """
+        # State information.  Am I capped?
+        self.capped += result.capped
+        self.capped += result.i2capped
 
         # Check running values against newly calculated values so as not to run tc
         # unnecessarily
-        if (runningrates['maxrate'] != new_maxrate) or \
-        (runningrates['minrate'] != self.MinRate * 1000) or \
-        (runningrates['maxexemptrate'] != new_maxi2rate) or \
-        ('minexemptrate' in runningrates and runningrates['minexemptrate'] != self.Mini2Rate * 1000) or \
-        (runningrates['share'] != self.Share):
+        if result.changed:
             # Apply parameters
-            bwlimit.set(xid = self.xid, dev = dev_default,
+            backend.set(xid = self.xid, dev = dev_default,
                 minrate = self.MinRate * 1000,
-                maxrate = new_maxrate,
+                maxrate = result.maxrate,
                 minexemptrate = self.Mini2Rate * 1000,
-                maxexemptrate = new_maxi2rate,
+                maxexemptrate = result.maxexemptrate,
                 share = self.Share)
 
         # Notify slice
         if self.capped == True:
-            self.notify(new_maxrate, new_maxi2rate, usedbytes, usedi2bytes)
+            self.notify(result.maxrate, result.maxexemptrate,
+                        runningrates['usedbytes'], runningrates['usedi2bytes'])
+
+
+def init_defaults():
+    """
+    Probe the default interface and its bandwidth cap.
+    This is done on first use rather than when the module gets imported,
+    so that loading nodemanager - or running a single module - stays cheap.
+    """
+    global dev_default, default_MaxRate, default_Maxi2Rate, backend
+    if dev_default is None:
+        dev_default = tools.get_default_if()
+    if default_MaxRate is None:
+        default_MaxRate = int(bwlimit.get_bwcap(dev_default) / 1000)
+        default_Maxi2Rate = int(bwlimit.bwmax / 1000)
+    if backend is None:
+        backend = tcbackend.get_backend(BACKEND, dev_default)
+        logger.verbose("bwmon: using the %s backend" % backend.name)
+
+
+def use_kernel(limits, kernel):
+    """
+    Have bwmon talk to kernel, that implements the tcbackend interface,
+    rather than to tc; limits stands for plnode.bwlimit, i.e. provides
+    its constants, get_bwcap(), get_xid(), format_tc_rate() and tc().
+    This is how bwsim runs bwmon against a fake kernel.
+    """
+    global bwlimit, backend
+    bwlimit = limits
+    backend = kernel
 
 
-def gethtbs(root_xid, default_xid):
+class XidMap:
+    """
+    xid <-> slice name, as bwlimit.get_xid() and bwlimit.get_slice() would
+    answer, but from a single scan of the password database.
+    Build one per run, since accounts come and go between runs.
+    users are (name, uid) pairs, the password database by default.
+    """
+
+    def __init__(self, users = None):
+        self.root = bwlimit.get_xid("root")
+        self.default = bwlimit.get_xid("default")
+        self.by_name = {"root": self.root, "default": self.default}
+        self.by_xid = {self.root: "root", self.default: "default"}
+        if users is None:
+            users = [(pw_ent.pw_name, pw_ent.pw_uid) for pw_ent in pwcache.getpwall()]
+        for (name, uid) in users:
+            self.by_name.setdefault(name, uid)
+            self.by_xid.setdefault(uid, name)
+
+    def xid(self, name):
+        return self.by_name.get(name)
+
+    def name(self, xid):
+        return self.by_xid.get(xid)
+
+
+def gethtbs(xids):
     """
     Return dict {xid: {*rates}} of running htbs as reported by tc that have names.
     Turn off HTBs without names.
     """
+    root_xid = xids.root
+    default_xid = xids.default
     livehtbs = {}
-    for params in bwlimit.get(dev = dev_default):
+    for params in backend.dump(dev_default):
         (xid, share,
          minrate, maxrate,
          minexemptrate, maxexemptrate,
          usedbytes, usedi2bytes) = params
 
-        name = bwlimit.get_slice(xid)
+        name = xids.name(xid)
 
         if (name is None) \
         and (xid != root_xid) \
@@ -461,7 +523,7 @@ def gethtbs(root_xid, default_xid):
             # Orphaned (not associated with a slice) class
             name = "%d?" % xid
             logger.log("bwmon: Found orphaned HTB %s. Removing." %name)
-            bwlimit.off(xid, dev = dev_default)
+            backend.off(xid, dev = dev_default)
 
         livehtbs[xid] = {'share': share,
             'minrate': minrate,
@@ -474,14 +536,15 @@ def gethtbs(root_xid, default_xid):
 
     return livehtbs
 
-def sync(nmdbcopy):
+def sync(nmdbcopy, xids = None):
     """
-    Syncs tc, db, and bwmon.pickle.
+    Syncs tc, db, and the bwmon state file.
     Then, starts new slices, kills old ones, and updates byte accounts for each running slice.
     Sends emails and caps those that went over their limit.
     """
     # Defaults
-    global DB_FILE, \
+    global state, \
+        dead_expiry_deaddb, \
         period, \
         default_MaxRate, \
         default_Maxi2Rate, \
@@ -490,6 +553,7 @@ def sync(nmdbcopy):
         default_Share, \
         dev_default
 
+    init_defaults()
     # All slices
     names = []
     # In case the limits have changed.
@@ -500,26 +564,29 @@ def sync(nmdbcopy):
     if default_MaxRate == -1:
         default_MaxRate = 1000000
 
-    # xxx $Id$
-    # with svn we used to have a trick to detect upgrades of this file
-    # this has gone with the move to git, without any noticeable effect on operations though
+    if state is None:
+        state = bwstate.Store(STATE_FILE, Slice, legacy = DB_FILE)
     try:
-        f = open(DB_FILE, "r+")
-        logger.verbose("bwmon: Loading %s" % DB_FILE)
-        (version, slices, deaddb) = pickle.load(f)
-        f.close()
-        # Check version of data file
-        if version != "$Id$":
-            logger.log("bwmon: Not using old version '%s' data file %s" % (version, DB_FILE))
-            raise Exception
+        logger.verbose("bwmon: Loading %s" % STATE_FILE)
+        (slices, deaddb) = state.load()
     except Exception:
-        version = "$Id$"
-        slices = {}
-        deaddb = {}
+        logger.log_exc("bwmon: could not load %s - starting over" % STATE_FILE)
+        if os.path.exists(STATE_FILE):
+            os.unlink(STATE_FILE)
+        (slices, deaddb) = state.load()
+    if deaddb is not dead_expiry_deaddb:
+        # first run, or the file was read again, e.g. after a failed run
+        # that already updated the index
+        dead_expiry.clear()
+        for (name, dead) in deaddb.items():
+            dead_expiry.set(name, dead['slice'].time + period)
+        dead_expiry_deaddb = deaddb
 
     # Get/set special slice IDs
-    root_xid = bwlimit.get_xid("root")
-    default_xid = bwlimit.get_xid("default")
+    if xids is None:
+        xids = XidMap()
+    root_xid = xids.root
+    default_xid = xids.default
 
     # Since root is required for sanity, its not in the API/plc database, so pass {}
     # to use defaults.
@@ -536,14 +603,14 @@ def sync(nmdbcopy):
     # Get running slivers that should be on this node (from plc). {xid: name}
     # db keys on name, bwmon keys on xid.  db doesnt have xid either.
     for plcSliver in list(nmdbcopy.keys()):
-        live[bwlimit.get_xid(plcSliver)] = nmdbcopy[plcSliver]
+        live[xids.xid(plcSliver)] = nmdbcopy[plcSliver]
 
     logger.verbose("bwmon: Found %s instantiated slices" % list(live.keys()).__len__())
     logger.verbose("bwmon: Found %s slices in dat file" % list(slices.values()).__len__())
 
     # Get actual running values from tc.
     # Update slice totals and bandwidth. {xid: {values}}
-    kernelhtbs = gethtbs(root_xid, default_xid)
+    kernelhtbs = gethtbs(xids)
     logger.verbose("bwmon: Found %s running HTBs" % list(kernelhtbs.keys()).__len__())
 
     # The dat file has HTBs for slices, but the HTBs aren't running
@@ -580,14 +647,14 @@ def sync(nmdbcopy):
         # instantiated yet.
         if newslice != None and ('_rspec' in live[newslice]) == True:
             # Check to see if we recently deleted this slice.
-            if live[newslice]['name'] not in list(deaddb.keys()):
+            if live[newslice]['name'] not in deaddb:
                 logger.log( "bwmon: new slice %s" % live[newslice]['name'] )
                 # _rspec is the computed rspec:  NM retrieved data from PLC, computed loans
                 # and made a dict of computed values.
                 slices[newslice] = Slice(newslice, live[newslice]['name'], live[newslice]['_rspec'])
                 slices[newslice].reset( {}, live[newslice]['_rspec'] )
             # Double check time for dead slice in deaddb is within 24hr recording period.
-            elif (time.time() <= (deaddb[live[newslice]['name']]['slice'].time + period)):
+            elif (clock() <= (deaddb[live[newslice]['name']]['slice'].time + period)):
                 deadslice = deaddb[live[newslice]['name']]
                 logger.log("bwmon: Reinstantiating deleted slice %s" % live[newslice]['name'])
                 slices[newslice] = deadslice['slice']
@@ -604,11 +671,12 @@ def sync(nmdbcopy):
                 slices[newslice].update(newvals, live[newslice]['_rspec'])
                 # Since the slice has been reinitialed, remove from dead database.
                 del deaddb[deadslice['slice'].name]
+                dead_expiry.discard(deadslice['slice'].name)
                 del newvals
         else:
             logger.log("bwmon: Slice %s doesn't have xid.  Skipping." % live[newslice]['name'])
 
-    # Move dead slices that exist in the pickle file, but
+    # Move dead slices that exist in the state file, but
     # aren't instantiated by PLC into the dead dict until
     # recording period is over.  This is to avoid the case where a slice is dynamically created
     # and destroyed then recreated to get around byte limits.
@@ -622,31 +690,32 @@ def sync(nmdbcopy):
             # add slice (by name) to deaddb
             logger.log("bwmon: Saving bandwidth totals for %s." % slices[deadxid].name)
             deaddb[slices[deadxid].name] = {'slice': slices[deadxid], 'htb': kernelhtbs[deadxid]}
+            dead_expiry.set(slices[deadxid].name, slices[deadxid].time + period)
             del slices[deadxid]
         if deadxid in kernelhtbs:
             logger.verbose("bwmon: Removing HTB for %s." % deadxid)
-            bwlimit.off(deadxid, dev = dev_default)
+            backend.off(deadxid, dev = dev_default)
 
     # Clean up deaddb
-    for deadslice in list(deaddb.keys()):
-        if (time.time() >= (deaddb[deadslice]['slice'].time + period)):
-            logger.log("bwmon: Removing dead slice %s from dat." \
-                        % deaddb[deadslice]['slice'].name)
+    for deadslice in dead_expiry.expired(clock()):
+        if deadslice in deaddb:
+            logger.log("bwmon: Removing dead slice %s from dat." % deadslice)
             del deaddb[deadslice]
 
     # Get actual running values from tc since we've added and removed buckets.
     # Update slice totals and bandwidth. {xid: {values}}
-    kernelhtbs = gethtbs(root_xid, default_xid)
+    kernelhtbs = gethtbs(xids)
     logger.verbose("bwmon: now %s running HTBs" % list(kernelhtbs.keys()).__len__())
 
-    # Update all byte limites on all slices
+    # Update all byte limites on all slices, computing the caps in one go
+    batch = capengine.Batch()
     for (xid, slice) in slices.items():
         # Monitor only the specified slices
         if xid == root_xid or xid == default_xid: continue
         if names and name not in names:
             continue
 
-        if (time.time() >= (slice.time + period)) or \
+        if (clock() >= (slice.time + period)) or \
             (kernelhtbs[xid]['usedbytes'] < slice.bytes) or \
             (kernelhtbs[xid]['usedi2bytes'] < slice.i2bytes):
             # Reset to defaults every 24 hours or if it appears
@@ -657,16 +726,25 @@ def sync(nmdbcopy):
         elif ENABLE:
             logger.verbose("bwmon: Updating slice %s" % slice.name)
             # Update byte counts
-            slice.update(kernelhtbs[xid], live[xid]['_rspec'])
+            slice.prepare(batch, kernelhtbs[xid], live[xid]['_rspec'])
+    for result in batch.compute(clock(), period):
+        result.key.apply(result, kernelhtbs[result.key.xid])
+
+    backend.commit()
 
-    logger.verbose("bwmon: Saving %s slices in %s" % (list(slices.keys()).__len__(), DB_FILE))
-    f = open(DB_FILE, "w")
-    pickle.dump((version, slices, deaddb), f)
-    f.close()
+    # let the sampler wake us up as soon as a slice needs capping
+    global thresholds
+    thresholds = {xid: (slice.bytes + slice.ThreshKByte * 1024,
+                        slice.i2bytes + slice.Threshi2KByte * 1024)
+                  for (xid, slice) in slices.items()
+                  if xid != root_xid and xid != default_xid and not slice.capped}
+
+    logger.verbose("bwmon: Saving %s slices in %s" % (list(slices.keys()).__len__(), STATE_FILE))
+    state.save(slices, deaddb)
 
 # doesnt use generic default interface because this runs as its own thread.
 # changing the config variable will not have an effect since GetSlivers: pass
-def getDefaults(nmdbcopy):
+def getDefaults(nmdbcopy, xids = None):
     '''
     Get defaults from default slice's slice attributes.
     '''
@@ -675,47 +753,120 @@ def getDefaults(nmdbcopy):
     dfltslice = nmdbcopy.get(Config().PLC_SLICE_PREFIX+"_default")
     if dfltslice:
         if dfltslice['rspec']['net_max_rate'] == -1:
-            allOff()
+            allOff(xids)
             status = False
     return status
 
 
-def allOff():
+def allOff(xids = None):
     """
     Turn off all slice HTBs
     """
-    # Get/set special slice IDs
-    root_xid = bwlimit.get_xid("root")
-    default_xid = bwlimit.get_xid("default")
-    kernelhtbs = gethtbs(root_xid, default_xid)
+    init_defaults()
+    if xids is None:
+        xids = XidMap()
+    kernelhtbs = gethtbs(xids)
     if len(kernelhtbs):
         logger.log("bwmon: Disabling all running HTBs.")
-        for htb in list(kernelhtbs.keys()): bwlimit.off(htb, dev = dev_default)
+        for htb in list(kernelhtbs.keys()): backend.off(htb, dev = dev_default)
+        backend.commit()
 
 
 lock = threading.Event()
 def run():
     """
-    When run as a thread, wait for event, lock db, deep copy it, release it,
+    When run as a thread, wait for event, grab the latest database snapshot,
     run bwmon.GetSlivers(), then go back to waiting.
     """
     logger.verbose("bwmon: Thread started")
     while True:
         lock.wait()
         logger.verbose("bwmon: Event received.  Running.")
-        database.db_lock.acquire()
-        nmdbcopy = copy.deepcopy(database.db)
-        database.db_lock.release()
+        nmdbcopy = database.db.snapshot()
         try:
-            if getDefaults(nmdbcopy) and len(bwlimit.tc("class show dev %s" % dev_default)) > 0:
+            init_defaults()
+            # one passwd scan for the whole run
+            xids = XidMap()
+            if getDefaults(nmdbcopy, xids) and len(bwlimit.tc("class show dev %s" % dev_default)) > 0:
                 # class show to check if net:InitNodeLimit:bwlimit.init has run.
-                sync(nmdbcopy)
+                sync(nmdbcopy, xids)
             else: logger.log("bwmon: BW limits DISABLED.")
-        except: logger.log_exc("bwmon failed")
+        except:
+            logger.log_exc("bwmon failed")
+            # the slices in memory may be half-updated, the file is not
+            if state is not None:
+                state.invalidate()
         lock.clear()
 
+def sample(sampler):
+    """
+    Record the current byte counters, and trigger a run
+    if a slice went past its threshold since the last one.
+    """
+    now = clock()
+    counters = {}
+    i2counters = {}
+    for (xid, share, minrate, maxrate, minexemptrate, maxexemptrate,
+         usedbytes, usedi2bytes) in sampler.dump(dev_default):
+        counters[xid] = usedbytes
+        i2counters[xid] = usedi2bytes
+    series.record(now, counters)
+    i2series.record(now, i2counters)
+    over = [xid for (xid, (limit, i2limit)) in list(thresholds.items())
+            if counters.get(xid, 0) >= limit or i2counters.get(xid, 0) >= i2limit]
+    if over:
+        for xid in over:
+            thresholds.pop(xid, None)
+        logger.log("bwmon: %d slice(s) went past their threshold - running now" % len(over))
+        lock.set()
+
+def run_sampler():
+    """
+    When run as a thread, sample the counters every SAMPLE_INTERVAL seconds.
+    Uses its own backend, so as not to get in the way of the changes that
+    sync() has pending.
+    """
+    logger.verbose("bwmon: Sampler started")
+    sampler = None
+    failing = False
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        try:
+            init_defaults()
+            if sampler is None:
+                sampler = tcbackend.get_backend(BACKEND, dev_default)
+            sample(sampler)
+            failing = False
+        except:
+            # once is enough
+            if not failing:
+                logger.log_exc("bwmon: sampling failed")
+            failing = True
+
+def get_rates(window = RATE_WINDOW):
+    """
+    slice name -> its current bandwidth use as seen by the sampler, in bit/s:
+    average over the window, moving average, and 95th percentile,
+    for the low and high bandwidth classes
+    """
+    def rates(ring):
+        return [(value or 0) * bits_per_byte
+                for value in (ring.rate(window), ring.ewma, ring.percentile(95, window))]
+    low = series.query(rates)
+    high = i2series.query(rates)
+    xids = XidMap()
+    result = {}
+    for (xid, (rate, ewma, p95)) in low.items():
+        (i2rate, i2ewma, i2p95) = high.get(xid, (0, 0, 0))
+        name = xids.name(xid) or "%d?" % xid
+        result[name] = {'rate': rate, 'ewma': ewma, 'p95': p95,
+                        'i2rate': i2rate, 'i2ewma': i2ewma, 'i2p95': i2p95}
+    return result
+
 def start(*args):
+    mailqueue.start()
     tools.as_daemon_thread(run)
+    tools.as_daemon_thread(run_sampler)
 
 def GetSlivers(*args):
     logger.verbose ("bwmon: triggering dummy GetSlivers")
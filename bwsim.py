@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+"""
+Offline simulator for bwmon, to run and benchmark it without a node.
+
+bwmon gets plugged, through bwmon.use_kernel(), into a FakeKernel that
+keeps HTB classes and their byte counters in memory, and into
+FakeLimits that stands for plnode.bwlimit. A Simulation then replays a
+Trace - for each slice, the load it offers over time - through days of
+virtual time: the fake kernel moves as many bytes as the class ceilings
+allow, bwmon.sample() runs every sample interval, and bwmon.sync() runs
+every sync interval, or earlier when the sampler asks for it, as on a
+node.
+
+It reports
+  (*) the wall-clock time each sync takes;
+  (*) the tc operations each sync issues: dumps, sets, offs and commits;
+  (*) whether the caps are right: after each sync, the ceiling of each
+      class must be what capengine.cap_rate() makes of the counters, and
+      no slice may send more than its volume in a recording period,
+      give or take what it can send within one sample interval.
+The exit status is 1 if any cap was found wrong, so that this can be run
+as a regression benchmark on bwmon changes.
+
+Only the class ceilings are modelled: there is no contention between
+slices, so rates and shares are not.
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+import logger
+import bwmon
+import capengine
+import mailqueue
+
+DEV = 'sim0'
+ROOT_XID = 0
+DEFAULT_XID = 0xfff
+# the fake kernel is not bound to 12-bit xids like HTB minors are
+FIRST_XID = 10000
+# when virtual time starts
+EPOCH = 1500000000.
+
+
+class FakeLimits:
+    """What bwmon uses of plnode.bwlimit, with the same constants"""
+
+    bwmin = 1000
+    bwmax = 1000 * 1000 * 1000
+    quantum = 1600
+    default_minor = 0x1000
+    exempt_minor = 0x2000
+
+    def __init__(self, bwcap=100 * 1000 * 1000):
+        self.bwcap = bwcap
+        self.kernel = None
+
+    def get_bwcap(self, dev=None):
+        return self.bwcap
+
+    def get_xid(self, name):
+        return {'root': ROOT_XID, 'default': DEFAULT_XID}.get(name)
+
+    def format_tc_rate(self, rate):
+        for (unit, suffix) in ((1000000000, 'gbit'), (1000000, 'mbit'), (1000, 'kbit')):
+            if rate >= unit and rate % unit == 0:
+                return "%.0f%s" % (rate / unit, suffix)
+        return "%.0fbit" % rate
+
+    def tc(self, command):
+        """only 'class show' makes sense here"""
+        if self.kernel is None or not command.startswith("class show"):
+            return []
+        return ["class htb 1:%x" % (self.default_minor | xid) for xid in self.kernel.classes]
+
+
+class FakeKernel:
+    """
+    HTB classes in memory, behind the same interface as the tcbackend backends.
+    classes maps xid -> [share, minrate, maxrate, minexemptrate, maxexemptrate,
+    bytes, exemptbytes], and ops counts the calls to each method.
+    """
+
+    name = 'fake'
+
+    def __init__(self, limits):
+        self.limits = limits
+        limits.kernel = self
+        self.classes = {}
+        # as bwlimit.init() leaves things
+        for xid in (ROOT_XID, DEFAULT_XID):
+            self.classes[xid] = [1, limits.bwmin, limits.bwcap, limits.bwmin, limits.bwmax, 0, 0]
+        self.ops = dict.fromkeys(['dump', 'set', 'off', 'commit'], 0)
+
+    def dump(self, dev):
+        self.ops['dump'] += 1
+        return [(xid,) + tuple(htb) for (xid, htb) in self.classes.items()]
+
+    def set(self, xid, dev, share, minrate, maxrate, minexemptrate, maxexemptrate):
+        """with the same sanity checks as bwlimit.on()"""
+        self.ops['set'] += 1
+        limits = self.limits
+        maxrate = min(max(maxrate, limits.bwmin), limits.get_bwcap(dev))
+        minrate = min(max(minrate, limits.bwmin), maxrate)
+        maxexemptrate = min(max(maxexemptrate, limits.bwmin), limits.bwmax)
+        minexemptrate = min(max(minexemptrate, limits.bwmin), maxexemptrate)
+        (usedbytes, usedi2bytes) = self.classes.get(xid, [0] * 7)[5:]
+        self.classes[xid] = [max(1, share), minrate, maxrate, minexemptrate, maxexemptrate,
+                             usedbytes, usedi2bytes]
+
+    def off(self, xid, dev):
+        self.ops['off'] += 1
+        self.classes.pop(xid, None)
+
+    def commit(self):
+        self.ops['commit'] += 1
+
+    def transmit(self, seconds, demand):
+        """demand maps xid -> offered (rate, exemptrate) in bytes/s"""
+        for (xid, (rate, i2rate)) in demand.items():
+            htb = self.classes.get(xid)
+            if htb is None:
+                continue
+            htb[5] += int(min(rate, htb[2] / 8) * seconds)
+            htb[6] += int(min(i2rate, htb[4] / 8) * seconds)
+
+
+class Trace:
+    """
+    For each slice, the load it offers as a step function of time:
+    from when on, rate and i2rate bytes/s, or nothing if rate is None,
+    meaning the sliver is gone. Times are in seconds since the start.
+    In a file, that is one 'when slice rate i2rate' line per step,
+    with '-' for a sliver that is gone.
+    """
+
+    def __init__(self):
+        # name -> ([when], [(rate, i2rate) or None])
+        self.steps = {}
+
+    def add(self, when, name, rate, i2rate=0):
+        (times, loads) = self.steps.setdefault(name, ([], []))
+        index = bisect.bisect_right(times, when)
+        times.insert(index, when)
+        loads.insert(index, None if rate is None else (rate, i2rate))
+
+    def names(self):
+        return sorted(self.steps)
+
+    def at(self, name, when):
+        (times, loads) = self.steps[name]
+        index = bisect.bisect_right(times, when)
+        return loads[index - 1] if index else None
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write("# when slice rate i2rate\n")
+            for (name, (times, loads)) in sorted(self.steps.items()):
+                for (when, load) in zip(times, loads):
+                    if load is None:
+                        f.write("%d %s - -\n" % (when, name))
+                    else:
+                        f.write("%d %s %d %d\n" % ((when, name) + load))
+
+    @staticmethod
+    def load(path):
+        trace = Trace()
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                (when, name, rate, i2rate) = fields
+                if rate == '-':
+                    trace.add(int(when), name, None)
+                else:
+                    trace.add(int(when), name, int(rate), int(i2rate))
+        return trace
+
+
+def synthetic_trace(count, duration, seed=0, churn=0.02):
+    """
+    A made-up trace for count slices: most are light, some are heavy
+    enough to get capped, a few use the exempt class, and each sliver
+    goes away for a while with probability churn at each change.
+    """
+    generator = random.Random(seed)
+    trace = Trace()
+    for index in range(count):
+        name = "sim_%05d" % index
+        kind = generator.random()
+        if kind < .05:
+            base = generator.randint(100000, 2000000)
+        elif kind < .30:
+            base = generator.randint(20000, 150000)
+        else:
+            base = generator.randint(0, 10000)
+        i2base = generator.randint(0, 500000) if generator.random() < .1 else 0
+        when = 0
+        while when < duration:
+            if when and generator.random() < churn:
+                trace.add(when, name, None)
+                when += generator.randint(3600, 12 * 3600)
+            factor = generator.lognormvariate(0, .5)
+            trace.add(when, name, int(base * factor), int(i2base * factor))
+            when += generator.randint(3600, 6 * 3600)
+    return trace
+
+
+class Simulation:
+    """
+    Runs bwmon against a FakeKernel, in virtual time.
+    This takes over bwmon's module globals, so there can be only one per process.
+    """
+
+    def __init__(self, trace, workdir, sync_interval=900, sample_interval=60,
+                 bwcap=100 * 1000 * 1000, rspecs=None):
+        self.trace = trace
+        self.sync_interval = sync_interval
+        self.sample_interval = sample_interval
+        self.rspecs = rspecs or {}
+        self.now = EPOCH
+        self.limits = FakeLimits(bwcap)
+        self.kernel = FakeKernel(self.limits)
+        self.users = [(name, FIRST_XID + index) for (index, name) in enumerate(trace.names())]
+        self.xid = dict(self.users)
+
+        logger.LOG_FILE = os.path.join(workdir, 'bwsim.log')
+        bwmon.use_kernel(self.limits, self.kernel)
+        bwmon.dev_default = DEV
+        bwmon.default_MaxRate = None
+        bwmon.clock = lambda: self.now
+        bwmon.STATE_FILE = os.path.join(workdir, 'bwmon.state')
+        bwmon.DB_FILE = os.path.join(workdir, 'bwmon.pickle')
+        bwmon.state = None
+        bwmon.dead_expiry.clear()
+        bwmon.dead_expiry_deaddb = None
+        bwmon.thresholds = {}
+        bwmon.lock.clear()
+        self.spool = os.path.join(workdir, 'mailqueue')
+        mailqueue.queue = mailqueue.MailQueue(self.spool, clock=bwmon.clock)
+
+        # the slices as of the last sync, to check volumes against
+        self.slices = {}
+        self.times = []
+        self.ops = dict.fromkeys(self.kernel.ops, 0)
+        self.syncs = 0
+        self.early = 0
+        self.wrong = 0
+        self.capped = 0
+        # (xid, start of recording period) of the slices found over quota
+        self.overquota = set()
+        self.worst = 0.
+
+    def live(self):
+        """slice name -> load, for the slivers that exist now"""
+        when = self.now - EPOCH
+        loads = {}
+        for name in self.xid:
+            load = self.trace.at(name, when)
+            if load is not None:
+                loads[name] = load
+        return loads
+
+    def run(self, duration):
+        end = self.now + duration
+        next_sync = self.now
+        while self.now < end:
+            loads = self.live()
+            if self.now >= next_sync or bwmon.lock.is_set():
+                if self.now < next_sync:
+                    self.early += 1
+                else:
+                    next_sync += self.sync_interval
+                self.sync(loads)
+            step = min(self.sample_interval, end - self.now, next_sync - self.now)
+            self.kernel.transmit(step, {self.xid[name]: load for (name, load) in loads.items()})
+            self.now += step
+            bwmon.sample(self.kernel)
+
+    def sync(self, loads):
+        self.check_volumes()
+        nmdb = {name: {'name': name, '_rspec': self.rspecs.get(name, {})} for name in loads}
+        before = dict(self.kernel.ops)
+        started = time.perf_counter()
+        bwmon.sync(nmdb, bwmon.XidMap(self.users))
+        self.times.append(time.perf_counter() - started)
+        for (op, count) in self.kernel.ops.items():
+            self.ops[op] += count - before[op]
+        bwmon.lock.clear()
+        self.syncs += 1
+        self.check_caps()
+
+    def check_caps(self):
+        """the ceilings in the kernel against the reference semantics in capengine"""
+        (self.slices, deaddb) = bwmon.state.load()
+        limits = self.limits
+        for (xid, slice) in self.slices.items():
+            htb = self.kernel.classes.get(xid)
+            if xid in (ROOT_XID, DEFAULT_XID) or htb is None:
+                continue
+            timeused = int(self.now - slice.time)
+            capped = False
+            for (used, baseline, thresh, max_kbyte, min_rate, max_rate, running, ceiling) in (
+                    (htb[5], slice.bytes, slice.ThreshKByte, slice.MaxKByte,
+                     slice.MinRate, slice.MaxRate, htb[2], limits.bwcap),
+                    (htb[6], slice.i2bytes, slice.Threshi2KByte, slice.Maxi2KByte,
+                     slice.Mini2Rate, slice.Maxi2Rate, htb[4], limits.bwmax)):
+                (rate, over) = capengine.cap_rate(used, baseline, thresh, max_kbyte,
+                                                  min_rate, max_rate, timeused, bwmon.period)
+                rate = min(max(rate, limits.bwmin), ceiling)
+                if running != rate:
+                    self.wrong += 1
+                    logger.log("bwsim: %s runs at %d, expected %d" % (slice.name, running, rate))
+                capped = capped or over
+            self.capped += capped
+
+    def check_volumes(self):
+        """what each slice sent in its recording period so far, against its volumes"""
+        for (xid, slice) in self.slices.items():
+            htb = self.kernel.classes.get(xid)
+            if xid in (ROOT_XID, DEFAULT_XID) or htb is None:
+                continue
+            for (used, baseline, max_kbyte, max_rate) in (
+                    (htb[5], slice.bytes, slice.MaxKByte, slice.MaxRate),
+                    (htb[6], slice.i2bytes, slice.Maxi2KByte, slice.Maxi2Rate)):
+                if max_kbyte <= 0:
+                    continue
+                sent = used - baseline
+                self.worst = max(self.worst, sent / (max_kbyte * 1024.))
+                # what can get through at full speed before the sampler notices
+                slack = max_rate * 1000 / 8 * self.sample_interval
+                if sent > max_kbyte * 1024 + slack and (xid, slice.time) not in self.overquota:
+                    self.overquota.add((xid, slice.time))
+                    logger.log("bwsim: %s sent %d bytes, over its %d KByte" % (slice.name, sent, max_kbyte))
+
+    def report(self):
+        times = sorted(self.times) or [0]
+        def percentile(p):
+            return times[min(len(times) - 1, int(p / 100. * len(times)))]
+        mails = len([name for name in os.listdir(self.spool) if name.endswith('.msg')]) \
+            if os.path.isdir(self.spool) else 0
+        return {'slices': len(self.users),
+                'syncs': self.syncs,
+                'early_syncs': self.early,
+                'sync_time': {'mean': sum(times) / len(times), 'p50': percentile(50),
+                              'p95': percentile(95), 'max': times[-1]},
+                'ops': self.ops,
+                'ops_per_sync': {op: count / max(1, self.syncs) for (op, count) in self.ops.items()},
+                'capped': self.capped,
+                'wrong_caps': self.wrong,
+                'over_quota': len(self.overquota),
+                'worst_quota_ratio': self.worst,
+                'mails': mails}
+
+
+def main():
+    parser = ArgumentParser(description="Run bwmon offline against a fake kernel")
+    parser.add_argument('-n', '--slices', action='store', dest='slices', type=int, default=1000,
+                        help='number of slices in the synthetic trace -- default 1000')
+    parser.add_argument('-d', '--days', action='store', dest='days', type=float, default=2,
+                        help='virtual days to simulate -- default 2')
+    parser.add_argument('-t', '--trace', action='store', dest='trace',
+                        help='replay this trace instead of a synthetic one')
+    parser.add_argument('--save-trace', action='store', dest='save_trace',
+                        help='write the trace used to this file')
+    parser.add_argument('-s', '--seed', action='store', dest='seed', type=int, default=0,
+                        help='seed for the synthetic trace -- default 0')
+    parser.add_argument('--churn', action='store', dest='churn', type=float, default=.02,
+                        help='how often slivers go away in the synthetic trace -- default 0.02')
+    parser.add_argument('--sync-interval', action='store', dest='sync_interval', type=int,
+                        default=900, help='seconds between syncs -- default 900')
+    parser.add_argument('--sample-interval', action='store', dest='sample_interval', type=int,
+                        default=60, help='seconds between samples -- default 60')
+    parser.add_argument('--bwcap', action='store', dest='bwcap', type=int,
+                        default=100 * 1000 * 1000, help='node cap in bit/s -- default 100mbit')
+    parser.add_argument('-w', '--workdir', action='store', dest='workdir',
+                        help='where to keep the state, mails and log -- default a temporary directory')
+    parser.add_argument('-j', '--json', action='store', dest='json',
+                        help='also write the report as JSON to this file')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
+                        help='verbose bwmon log')
+    args = parser.parse_args()
+
+    duration = int(args.days * bwmon.seconds_per_day)
+    if args.trace:
+        trace = Trace.load(args.trace)
+    else:
+        trace = synthetic_trace(args.slices, duration, args.seed, args.churn)
+    if args.save_trace:
+        trace.save(args.save_trace)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bwsim')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    if args.verbose:
+        logger.set_level(logger.LOG_VERBOSE)
+
+    try:
+        simulation = Simulation(trace, workdir, args.sync_interval, args.sample_interval, args.bwcap)
+        simulation.run(duration)
+        report = simulation.report()
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    times = report['sync_time']
+    print("bwsim: %d slices, %g days, %d syncs (%d early)"
+          % (report['slices'], args.days, report['syncs'], report['early_syncs']))
+    print("sync time: mean %.4fs p50 %.4fs p95 %.4fs max %.4fs"
+          % (times['mean'], times['p50'], times['p95'], times['max']))
+    print("tc ops per sync: " + " ".join("%s %.2f" % item for item in sorted(report['ops_per_sync'].items())))
+    print("caps: %d capped slice-syncs, %d wrong, %d over quota (worst %.2f of quota), %d mails"
+          % (report['capped'], report['wrong_caps'], report['over_quota'],
+             report['worst_quota_ratio'], report['mails']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['wrong_caps'] or report['over_quota'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+"""
+The bwmon state file.
+
+bwmon used to pickle all its Slice objects into bwmon.pickle after each
+run. Here each slice gets a fixed-width record instead, in a file that is
+memory-mapped:
+  (*) the file starts with a header: magic, schema version, record size,
+      and a generation that each save() bumps;
+  (*) each record holds one slice - live, i.e. in bwmon's slices, or dead,
+      i.e. in its deaddb - and ends with a CRC32 of its contents, so that
+      a torn or corrupted record gets dropped rather than misread;
+  (*) save() only writes the records that have changed since load(),
+      and frees the slots of the slices that are gone;
+  (*) load() keeps what it returns in memory, and only reads the file
+      again once its inode, mtime or generation has changed, or after
+      invalidate() - e.g. when the caller failed half-way through
+      updating the slices.
+
+Files written with an older schema are converted on load through
+MIGRATIONS, which maps a version to a function that turns one of its
+records into a record of the next version, so that no byte accounting
+gets lost on upgrade; only a file with another magic, or a version that
+no chain of MIGRATIONS leads from, gets started over. A legacy
+bwmon.pickle is imported once, if there is no state file yet.
+"""
+
+import os
+import mmap
+import pickle
+import struct
+import zlib
+
+import logger
+
+MAGIC = b'BWMS'
+SCHEMA_VERSION = 1
+
+HEADER = struct.Struct('=4sHHI')
+
+# record states
+FREE = 0
+LIVE = 1
+DEAD = 2
+
+# the Slice attributes that get saved, in record order
+FIELDS = ['time', 'bytes', 'i2bytes',
+          'MaxRate', 'MinRate', 'Maxi2Rate', 'Mini2Rate',
+          'MaxKByte', 'ThreshKByte', 'Maxi2KByte', 'Threshi2KByte',
+          'Share', 'Sharei2']
+# what a dead slice remembers of its htb
+HTB_FIELDS = ['usedbytes', 'usedi2bytes', 'share']
+NAME_SIZE = 64
+
+# state, flags, xid, name, FIELDS, HTB_FIELDS, capped; then the crc
+# capped counts the runs a slice was found capped, see Slice.apply()
+RECORD = struct.Struct('=BBxxI%ds d12q 3q q' % NAME_SIZE)
+CRC = struct.Struct('=I')
+RECORD_SIZE = RECORD.size + CRC.size
+
+EMAILED = 0x1
+# how None gets stored in an integer field
+NONE = -2 ** 63
+
+# version -> function(record bytes) -> record bytes for version + 1;
+# the record comes with its crc, and a converter returns an all-zero
+# record for a corrupted one, to have it dropped
+MIGRATIONS = {}
+
+INITIAL_SLOTS = 64
+
+
+def _int(value):
+    return NONE if value is None else int(value)
+
+
+def _value(stored):
+    return None if stored == NONE else stored
+
+
+def pack(state, slice, htb=None):
+    """the record for slice, with its CRC"""
+    htb = htb or {}
+    flags = EMAILED if slice.emailed else 0
+    record = RECORD.pack(state, flags, slice.xid or 0,
+                         slice.name.encode()[:NAME_SIZE], float(slice.time),
+                         *[_int(getattr(slice, field)) for field in FIELDS[1:]],
+                         *[_int(htb.get(field, 0)) for field in HTB_FIELDS],
+                         int(slice.capped))
+    return record + CRC.pack(zlib.crc32(record))
+
+
+def unpack(raw, slice_class):
+    """(state, slice, htb) for a record, or None if it is free or corrupted"""
+    record = raw[:RECORD.size]
+    if CRC.unpack_from(raw, RECORD.size)[0] != zlib.crc32(record):
+        return None
+    values = RECORD.unpack(record)
+    (state, flags, xid, name) = values[:4]
+    if state == FREE:
+        return None
+    slice = slice_class.__new__(slice_class)
+    slice.xid = xid
+    slice.name = name.rstrip(b'\0').decode()
+    for (field, value) in zip(FIELDS, values[4:4 + len(FIELDS)]):
+        setattr(slice, field, value if field == 'time' else _value(value))
+    slice.emailed = bool(flags & EMAILED)
+    slice.capped = values[-1]
+    htb = {field: _value(value) for (field, value) in zip(HTB_FIELDS, values[4 + len(FIELDS):-1])}
+    return (state, slice, htb)
+
+
+class Store:
+
+    def __init__(self, path, slice_class, legacy=None):
+        self.path = path
+        self.slice_class = slice_class
+        self.legacy = legacy
+        self.file = None
+        self.map = None
+        # key -> slot, with key ('live', xid) or ('dead', name)
+        self.slots = {}
+        # slot -> the record last read or written there
+        self.records = {}
+        self.free = []
+        # what load() returns, and the _stamp() of the file it matches
+        self.loaded = None
+        self.stamp = None
+
+    def _slots(self):
+        return (len(self.map) - HEADER.size) // RECORD_SIZE
+
+    def _create(self, records=()):
+        """a new file with these records, atomically"""
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, SCHEMA_VERSION, RECORD_SIZE, 0))
+            for raw in records:
+                f.write(raw)
+            f.write(b'\0' * RECORD_SIZE * max(INITIAL_SLOTS - len(records), 0))
+        os.replace(self.path + '.tmp', self.path)
+
+    def _open(self):
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def _grow(self):
+        slots = self._slots()
+        self.map.close()
+        self.file.truncate(HEADER.size + 2 * slots * RECORD_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.free += range(2 * slots - 1, slots - 1, -1)
+
+    def _stamp(self):
+        """(inode, mtime, generation) of the file, None if there is none"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        generation = HEADER.unpack_from(self.map, 0)[3] if self.map is not None else None
+        return (stat.st_ino, stat.st_mtime_ns, generation)
+
+    def _migrate(self, version, size):
+        """rewrite the file with the current schema, keeping all its records"""
+        records = []
+        for offset in range(HEADER.size, len(self.map) - size + 1, size):
+            raw = self.map[offset:offset + size]
+            for step in range(version, SCHEMA_VERSION):
+                raw = MIGRATIONS[step](raw)
+            records.append(raw)
+        self.close()
+        logger.log("bwstate: migrating %s from schema %d to %d" % (self.path, version, SCHEMA_VERSION))
+        self._create(records)
+        self._open()
+
+    def _write(self, slot, raw):
+        offset = HEADER.size + slot * RECORD_SIZE
+        self.map[offset:offset + RECORD_SIZE] = raw
+        self.records[slot] = raw
+
+    def load(self):
+        """(slices, deaddb) as bwmon uses them, read again only if the file has changed"""
+        if self.loaded is None or self._stamp() != self.stamp:
+            self.loaded = self._read()
+            self.stamp = self._stamp()
+        return self.loaded
+
+    def invalidate(self):
+        """have the next load() read the file again"""
+        self.loaded = None
+
+    def _read(self):
+        self.close()
+        self.slots = {}
+        self.records = {}
+        self.free = []
+        if not os.path.exists(self.path):
+            self._create()
+            self._open()
+            self.free = list(range(self._slots() - 1, -1, -1))
+            return self._import_legacy()
+        self._open()
+        (magic, version, size, generation) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version > SCHEMA_VERSION \
+           or any(step not in MIGRATIONS for step in range(version, SCHEMA_VERSION)):
+            logger.log("bwstate: unknown format in %s - starting over" % self.path)
+            self.close()
+            self._create()
+            self._open()
+        elif version < SCHEMA_VERSION:
+            self._migrate(version, size)
+        slices = {}
+        deaddb = {}
+        for slot in range(self._slots() - 1, -1, -1):
+            offset = HEADER.size + slot * RECORD_SIZE
+            raw = self.map[offset:offset + RECORD_SIZE]
+            entry = unpack(raw, self.slice_class) if any(raw) else None
+            if entry is None:
+                if any(raw):
+                    logger.log("bwstate: dropping corrupted record %d in %s" % (slot, self.path))
+                    self._write(slot, b'\0' * RECORD_SIZE)
+                    del self.records[slot]
+                self.free.append(slot)
+                continue
+            (state, slice, htb) = entry
+            self.records[slot] = raw
+            if state == LIVE:
+                slices[slice.xid] = slice
+                self.slots[('live', slice.xid)] = slot
+            else:
+                deaddb[slice.name] = {'slice': slice, 'htb': htb}
+                self.slots[('dead', slice.name)] = slot
+        logger.verbose("bwstate: loaded %d slices and %d dead ones from %s"
+                       % (len(slices), len(deaddb), self.path))
+        return (slices, deaddb)
+
+    def _import_legacy(self):
+        slices = {}
+        deaddb = {}
+        if self.legacy and os.path.exists(self.legacy):
+            try:
+                with open(self.legacy, 'rb') as f:
+                    (version, slices, deaddb) = pickle.load(f, encoding='latin1')
+                logger.log("bwstate: imported %d slices from %s" % (len(slices), self.legacy))
+                self.save(slices, deaddb)
+                os.rename(self.legacy, self.legacy + '.imported')
+            except:
+                logger.log_exc("bwstate: could not import %s" % self.legacy)
+                slices = {}
+                deaddb = {}
+        return (slices, deaddb)
+
+    def save(self, slices, deaddb):
+        """write the records that have changed; returns how many were written"""
+        wanted = {}
+        for (xid, slice) in slices.items():
+            wanted[('live', xid)] = pack(LIVE, slice)
+        for (name, dead) in deaddb.items():
+            wanted[('dead', name)] = pack(DEAD, dead['slice'], dead['htb'])
+        written = 0
+        for key in list(self.slots):
+            if key not in wanted:
+                slot = self.slots.pop(key)
+                self._write(slot, b'\0' * RECORD_SIZE)
+                del self.records[slot]
+                self.free.append(slot)
+                written += 1
+        for (key, raw) in wanted.items():
+            slot = self.slots.get(key)
+            if slot is None:
+                if not self.free:
+                    self._grow()
+                slot = self.free.pop()
+                self.slots[key] = slot
+            elif self.records.get(slot) == raw:
+                continue
+            self._write(slot, raw)
+            written += 1
+        if written:
+            (magic, version, size, generation) = HEADER.unpack_from(self.map, 0)
+            HEADER.pack_into(self.map, 0, magic, version, size, (generation + 1) % 2 ** 32)
+            self.map.flush()
+        self.loaded = (slices, deaddb)
+        self.stamp = self._stamp()
+        logger.verbose("bwstate: %d record(s) written to %s" % (written, self.path))
+        return written
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# a little self-test
+if __name__ == '__main__':
+    import tempfile
+
+    class Slice:
+        __slots__ = ['xid', 'name', 'emailed', 'capped'] + FIELDS
+        def __init__(self, xid, name):
+            self.xid = xid
+            self.name = name
+            self.emailed = False
+            self.capped = 2
+            for field in FIELDS:
+                setattr(self, field, 1000 + xid)
+            self.MaxRate = None
+            self.time = 12.5
+
+    def same(a, b):
+        return all(getattr(a, field) == getattr(b, field) for field in Slice.__slots__)
+
+    path = os.path.join(tempfile.mkdtemp(), 'bwmon.state')
+    store = Store(path, Slice)
+    assert store.load() == ({}, {})
+    slices = {xid: Slice(xid, 'slice%d' % xid) for xid in range(100)}
+    deaddb = {'gone': {'slice': Slice(500, 'gone'), 'htb': {'usedbytes': 10, 'usedi2bytes': 2, 'share': 1}}}
+    assert store.save(slices, deaddb) == 101
+    assert store.save(slices, deaddb) == 0, "nothing changed"
+    slices[3].bytes = 42
+    del slices[4]
+    assert store.save(slices, deaddb) == 2
+    store.close()
+
+    store = Store(path, Slice)
+    (loaded, dead) = store.load()
+    assert sorted(loaded) == sorted(slices)
+    assert all(same(loaded[xid], slices[xid]) for xid in slices)
+    assert loaded[3].bytes == 42 and loaded[3].MaxRate is None and loaded[3].capped == 2
+    assert dead['gone']['htb'] == deaddb['gone']['htb'] and same(dead['gone']['slice'], deaddb['gone']['slice'])
+    slices[200] = Slice(200, 'new')
+    assert store.save(slices, deaddb) == 1, "reuses the freed slot"
+    # what was saved is what the next load() returns, without reading the file
+    assert store.load()[0] is slices
+    slices[3].bytes = 43
+    store.invalidate()
+    (loaded, dead) = store.load()
+    assert loaded is not slices and loaded[3].bytes == 42
+    # another writer bumps the generation
+    other = Store(path, Slice)
+    (others, dead) = other.load()
+    others[3].bytes = 44
+    assert other.save(others, dead) == 1
+    other.close()
+    assert store.load()[0][3].bytes == 44
+    store.close()
+
+    # a corrupted record gets dropped
+    with open(path, 'r+b') as f:
+        f.seek(HEADER.size + 10)
+        f.write(b'\xff')
+    store = Store(path, Slice)
+    (loaded, dead) = store.load()
+    assert len(loaded) + len(dead) == len(slices) + len(deaddb) - 1
+    store.close()
+
+    # a file of the previous schema gets converted: pretend that schema
+    # padded each record with 8 bytes, and counted bytes in units of 2
+    (kept, kept_dead) = (loaded, dead)
+    def double_bytes(raw):
+        record = raw[:RECORD.size]
+        if not any(raw) or CRC.unpack_from(raw, RECORD.size)[0] != zlib.crc32(record):
+            return b'\0' * RECORD_SIZE
+        values = list(RECORD.unpack(record))
+        values[FIELDS.index('bytes') + 4] *= 2
+        record = RECORD.pack(*values)
+        return record + CRC.pack(zlib.crc32(record))
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, SCHEMA_VERSION, RECORD_SIZE + 8, 0))
+        for offset in range(HEADER.size, len(data), RECORD_SIZE):
+            f.write(data[offset:offset + RECORD_SIZE] + b'\0' * 8)
+    SCHEMA_VERSION += 1
+    MIGRATIONS[SCHEMA_VERSION - 1] = lambda raw: double_bytes(raw[:RECORD_SIZE])
+    store = Store(path, Slice)
+    (loaded, dead) = store.load()
+    assert sorted(loaded) == sorted(kept) and sorted(dead) == sorted(kept_dead)
+    assert all(loaded[xid].bytes == 2 * kept[xid].bytes for xid in kept)
+    assert dead['gone']['slice'].bytes == 2 * kept_dead['gone']['slice'].bytes and loaded[3].capped == 2
+    store.close()
+    with open(path, 'rb') as f:
+        assert HEADER.unpack(f.read(HEADER.size))[1:3] == (SCHEMA_VERSION, RECORD_SIZE)
+
+    # a file of an unknown schema gets started over
+    with open(path, 'r+b') as f:
+        f.write(HEADER.pack(MAGIC, SCHEMA_VERSION + 1, RECORD_SIZE, 0))
+    store = Store(path, Slice)
+    assert store.load() == ({}, {})
+    store.close()
+    print("bwstate: OK")
@@ -0,0 +1,237 @@
+"""
+Batched computation of the bandwidth caps of all slices.
+
+bwmon used to run Slice.update() on one slice after the other. The cap
+arithmetic now lives here: a Batch is filled with one row per slice,
+made of its baselines, limits, current HTB counters and current tc
+parameters, and compute() then works out, for all rows at once
+  (*) the new maxrate and maxexemptrate, in bit/s;
+  (*) whether each class went past its threshold, i.e. got capped;
+  (*) whether the tc parameters need to change at all.
+With numpy this is a handful of vector operations on columns; without it
+each row goes through cap_rate() and needs_change(), that are the
+reference semantics - those of the former Slice.update() - and that the
+numpy code must match exactly.
+
+All rates are passed as slices store them, i.e. in kbit/s, except for
+the running tc parameters that are in bit/s; counters are in bytes.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def cap_rate(used, baseline, thresh_kbyte, max_kbyte, min_rate, max_rate, timeused, period):
+    """(new max rate in bit/s, capped) for one class of one slice"""
+    if used >= baseline + thresh_kbyte * 1024:
+        # what is left of the volume, over what is left of the period
+        new_rate = int(((max_kbyte * 1024 - (used - baseline)) * 8) / (period - timeused))
+        # never go under MinRate
+        if new_rate < min_rate * 1000:
+            new_rate = min_rate * 1000
+        return (new_rate, True)
+    return (max_rate * 1000, False)
+
+
+def needs_change(running, new_maxrate, min_rate, new_maxexemptrate, min_exempt_rate, share):
+    """whether the running tc parameters differ from the wanted ones"""
+    (run_maxrate, run_minrate, run_maxexemptrate, run_minexemptrate, run_share) = running
+    return run_maxrate != new_maxrate \
+        or run_minrate != min_rate * 1000 \
+        or run_maxexemptrate != new_maxexemptrate \
+        or (run_minexemptrate is not None and run_minexemptrate != min_exempt_rate * 1000) \
+        or run_share != share
+
+
+# the columns of a Batch; low_* are for the capped class, high_* for the exempt one
+COLUMNS = ['start',
+           'low_used', 'low_baseline', 'low_thresh', 'low_max_kbyte', 'low_min', 'low_max',
+           'high_used', 'high_baseline', 'high_thresh', 'high_max_kbyte', 'high_min', 'high_max',
+           'run_maxrate', 'run_minrate', 'run_maxexemptrate', 'run_minexemptrate', 'run_share',
+           'share']
+
+
+class Result:
+
+    __slots__ = ['key', 'maxrate', 'maxexemptrate', 'capped', 'i2capped', 'changed']
+
+    def __init__(self, key, maxrate, maxexemptrate, capped, i2capped, changed):
+        self.key = key
+        self.maxrate = maxrate
+        self.maxexemptrate = maxexemptrate
+        self.capped = capped
+        self.i2capped = i2capped
+        self.changed = changed
+
+    def __repr__(self):
+        return "<Result %s %s/%s%s%s%s>" % (self.key, self.maxrate, self.maxexemptrate,
+                                           " capped" if self.capped else "",
+                                           " i2capped" if self.i2capped else "",
+                                           " changed" if self.changed else "")
+
+
+class Batch:
+
+    def __init__(self, vectorised=None):
+        # use numpy when available, unless told otherwise
+        self.vectorised = numpy is not None if vectorised is None else vectorised
+        self.keys = []
+        self.columns = {column: [] for column in COLUMNS}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, start, low, high, running, share):
+        """
+        low and high  : (used, baseline, thresh_kbyte, max_kbyte, min_rate, max_rate)
+        running       : (maxrate, minrate, maxexemptrate, minexemptrate or None, share)
+        """
+        self.keys.append(key)
+        values = [start] + list(low) + list(high) + list(running) + [share]
+        if self.vectorised and not all(isinstance(value, int)
+                                       for value in values[1:] if value is not None):
+            # the int64 columns would silently truncate that row
+            self.vectorised = False
+        for (column, value) in zip(COLUMNS, values):
+            self.columns[column].append(value)
+
+    def compute(self, now, period):
+        """a list of Results, in the order of add()"""
+        if not self.keys:
+            return []
+        if self.vectorised:
+            return self._compute_numpy(now, period)
+        return self._compute_rows(now, period)
+
+    def _compute_rows(self, now, period):
+        results = []
+        columns = [self.columns[column] for column in COLUMNS]
+        for (key, row) in zip(self.keys, zip(*columns)):
+            (start,
+             low_used, low_baseline, low_thresh, low_max_kbyte, low_min, low_max,
+             high_used, high_baseline, high_thresh, high_max_kbyte, high_min, high_max,
+             run_maxrate, run_minrate, run_maxexemptrate, run_minexemptrate, run_share,
+             share) = row
+            timeused = int(now - start)
+            (maxrate, capped) = cap_rate(low_used, low_baseline, low_thresh, low_max_kbyte,
+                                         low_min, low_max, timeused, period)
+            (maxexemptrate, i2capped) = cap_rate(high_used, high_baseline, high_thresh, high_max_kbyte,
+                                                 high_min, high_max, timeused, period)
+            changed = needs_change((run_maxrate, run_minrate, run_maxexemptrate,
+                                    run_minexemptrate, run_share),
+                                   maxrate, low_min, maxexemptrate, high_min, share)
+            results.append(Result(key, maxrate, maxexemptrate, capped, i2capped, changed))
+        return results
+
+    def _compute_numpy(self, now, period):
+        def column(name, dtype=numpy.int64):
+            return numpy.array(self.columns[name], dtype=dtype)
+        # like int(now - start), that truncates towards zero
+        timeused = numpy.trunc(now - column('start', numpy.float64)).astype(numpy.int64)
+        remaining = period - timeused
+
+        def cap(prefix):
+            used = column(prefix + '_used')
+            baseline = column(prefix + '_baseline')
+            min_rate = column(prefix + '_min') * 1000
+            over = used >= baseline + column(prefix + '_thresh') * 1024
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                left = (column(prefix + '_max_kbyte') * 1024 - (used - baseline)) * 8
+                # the rows that are not over their threshold are discarded below
+                rate = numpy.trunc(left / numpy.where(over, remaining, 1))
+            rate = numpy.maximum(rate.astype(numpy.int64), min_rate)
+            return (numpy.where(over, rate, column(prefix + '_max') * 1000), over)
+
+        (maxrate, capped) = cap('low')
+        (maxexemptrate, i2capped) = cap('high')
+        has_minexempt = numpy.array([value is not None for value in self.columns['run_minexemptrate']])
+        run_minexempt = numpy.array([-1 if value is None else value
+                                     for value in self.columns['run_minexemptrate']], dtype=numpy.int64)
+        changed = (column('run_maxrate') != maxrate) \
+            | (column('run_minrate') != column('low_min') * 1000) \
+            | (column('run_maxexemptrate') != maxexemptrate) \
+            | (has_minexempt & (run_minexempt != column('high_min') * 1000)) \
+            | (column('run_share') != column('share'))
+        return [Result(key, int(maxrate[i]), int(maxexemptrate[i]),
+                       bool(capped[i]), bool(i2capped[i]), bool(changed[i]))
+                for (i, key) in enumerate(self.keys)]
+
+
+# a little self-test: both paths against the formula, then numpy against the per-row code
+if __name__ == '__main__':
+    import random
+
+    period = 86400
+    now = 1000000.5
+    # 1 Mbit/s for a day, 80% threshold
+    max_kbyte = 10546875
+    thresh = int(.8 * max_kbyte)
+    (rate, capped) = cap_rate(thresh * 1024, 0, thresh, max_kbyte, 8, 1000, 43200, period)
+    assert capped and rate == int(((max_kbyte - thresh) * 1024 * 8) / 43200)
+    assert cap_rate(thresh * 1024 - 1, 0, thresh, max_kbyte, 8, 1000, 43200, period) == (1000000, False)
+    assert cap_rate(max_kbyte * 2048, 0, thresh, max_kbyte, 8, 1000, 43200, period) == (8000, True)
+
+    # hand-picked rows and their caps, worked out from the formula, for both paths
+    # key: (start, low, high, running, share), (maxrate, maxexemptrate, capped, i2capped, changed)
+    under = (0, 0, thresh, max_kbyte, 8, 100000)
+    fixed = {
+        'under': ((now - 43200, (thresh * 1024 - 1, 0, thresh, max_kbyte, 8, 1000), under,
+                   (1000000, 8000, 100000000, None, 1), 1),
+                  (1000000, 100000000, False, False, False)),
+        'capped': ((now - 43200, (thresh * 1024, 0, thresh, max_kbyte, 8, 1000), under,
+                    (1000000, 8000, 100000000, 8000, 1), 1),
+                   (400000, 100000000, True, False, True)),
+        # over the whole volume of the exempt class: MinRate
+        'both': ((now - 43200, (10 ** 12 + thresh * 1024, 10 ** 12, thresh, max_kbyte, 8, 1000),
+                  (5 * 10 ** 11 + max_kbyte * 2048, 5 * 10 ** 11, thresh, max_kbyte, 100, 100000),
+                  (400000, 8000, 100000, 100000, 1), 1),
+                 (400000, 100000, True, True, False)),
+        # 7.7s used truncates to 7, and 8192000 / 86393 to 94
+        'truncated': ((now - 7.7, (5, 5, 0, 1000, 0, 1000), under,
+                       (94, 0, 100000000, 8000, 2), 1),
+                      (94, 100000000, True, False, True)),
+        'minexempt': ((now - 43200, (0, 0, thresh, max_kbyte, 8, 1000), under,
+                       (1000000, 8000, 100000000, 100000, 1), 1),
+                      (1000000, 100000000, False, False, True)),
+    }
+    for vectorised in (False, True) if numpy is not None else (False,):
+        rows = Batch(vectorised)
+        for (key, (row, expected)) in fixed.items():
+            rows.add(key, *row)
+        for result in rows.compute(now, period):
+            assert (result.maxrate, result.maxexemptrate, result.capped, result.i2capped, result.changed) \
+                == fixed[result.key][1], (vectorised, result)
+
+    generator = random.Random(42)
+    def batch(vectorised):
+        generator.seed(42)
+        result = Batch(vectorised)
+        for key in range(2000):
+            start = now - generator.uniform(0, period - 1)
+            def limits():
+                max_kbyte = generator.choice([10546875, 31640625, generator.randrange(1, 10 ** 8)])
+                thresh = int(.8 * max_kbyte)
+                baseline = generator.randrange(0, 10 ** 12)
+                used = baseline + generator.randrange(0, 2 * max_kbyte * 1024)
+                return (used, baseline, thresh, max_kbyte,
+                        generator.choice([8, 100]), generator.choice([1000, 100000]))
+            (low, high) = (limits(), limits())
+            running = (generator.choice([low[5] * 1000, 12345]), 8000,
+                       generator.choice([high[5] * 1000, 54321]),
+                       generator.choice([None, 8000, 100000]), 1)
+            result.add(key, start, low, high, running, generator.choice([1, 1, 2]))
+        return result
+
+    rows = batch(False).compute(now, period)
+    assert any(result.capped for result in rows) and not all(result.changed for result in rows)
+    if numpy is not None:
+        vector = batch(True).compute(now, period)
+        for (a, b) in zip(rows, vector):
+            assert (a.maxrate, a.maxexemptrate, a.capped, a.i2capped, a.changed) \
+                == (b.maxrate, b.maxexemptrate, b.capped, b.i2capped, b.changed), (a, b)
+        print("capengine: numpy and per-row results agree on %d slices" % len(rows))
+    else:
+        print("capengine: numpy not available, per-row code only")
+    print("capengine: OK")
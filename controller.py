@@ -2,12 +2,10 @@
 """Delegate accounts are used to provide secure access to the XMLRPC API.
 They are normal Unix accounts with a shell that tunnels XMLRPC requests to the API server."""
 
-from pwd import getpwnam
-from grp import getgrnam
-
 import logger
 import tools
 import account
+import pwcache
 
 class Controller(account.Account):
     SHELL = '/usr/bin/forward_api_calls'  # tunneling shell
@@ -16,15 +14,23 @@ class Controller(account.Account):
     @staticmethod
     def create(name, vref = None):
         add_shell(Controller.SHELL)
-        group = getgrnam("slices")[2]
+        group = pwcache.getgrnam("slices")[2]
         logger.log_call(['/usr/sbin/useradd', '-p', '*', '-g', str(group), '-s', Controller.SHELL, name, ])
+        pwcache.invalidate()
 
     @staticmethod
-    def destroy(name): logger.log_call(['/usr/sbin/userdel', '-r', name, ])
+    def destroy(name):
+        logger.log_call(['/usr/sbin/userdel', '-r', name, ])
+        pwcache.invalidate()
 
     def is_running(self):
         logger.verbose("controller: is_running:  %s" % self.name)
-        return getpwnam(self.name)[6] == self.SHELL
+        return pwcache.getpwnam(self.name)[6] == self.SHELL
+
+    @classmethod
+    def running_names(cls, accounts):
+        # running just means having the right shell
+        return {name for (name, acct_class) in accounts.items() if acct_class is cls}
 
 
 def add_shell(shell):
@@ -3,6 +3,7 @@
 """
 
 import logger
+import topology
 import os
 
 glo_coresched_simulate = False
@@ -39,25 +40,8 @@ class CoreSched:
         if filename==None:
             filename="/dev/cgroup/" + name
 
-        data = open(filename).readline().strip()
-
-        if not data:
-           return []
-
-        units = []
-
-        # cpuset.cpus could be something as arbitrary as:
-        #    0,1,2-3,4,5-6
-        # deal with commas and ranges
-        for part in data.split(","):
-            unitRange = part.split("-")
-            if len(unitRange) == 1:
-                unitRange = (unitRange[0], unitRange[0])
-            for i in range(int(unitRange[0]), int(unitRange[1])+1):
-                if not i in units:
-                    units.append(i)
-
-        return units
+        # read each time, unlike the topology: cpusets can change at any time
+        return topology.read_list(filename)
 
     def get_cpus(self):
         """ return a list of available cpu identifiers: [0,1,2,3...]
@@ -70,9 +54,10 @@ class CoreSched:
 
         self.cpus = self.get_cgroup_var(self.cgroup_var_name)
 
+        siblings = topology.get().core_siblings
         self.cpu_siblings = {}
         for item in self.cpus:
-           self.cpu_siblings[item] = self.get_core_siblings(item)
+           self.cpu_siblings[item] = siblings.get(item, [])
 
         return self.cpus
 
@@ -242,7 +227,7 @@ class CoreSched:
             if glo_coresched_simulate:
                 print("R", "/dev/cgroup/" + cgroup + "/" + var_name, self.listToRange(cpus))
             else:
-                with opwn("/dev/cgroup/{}/{}".format(cgroup, var_name), "w") as f:
+                with open("/dev/cgroup/{}/{}".format(cgroup, var_name), "w") as f:
                     f.write( self.listToRange(cpus) + "\n" )
 
     def reserveDefault (self, var_name, cpus):
@@ -317,31 +302,14 @@ class CoreSched:
         """ for a given memory node, return the CPUs that it is associated
             with.
         """
-        fn = "/sys/devices/system/node/node" + str(index) + "/cpulist"
-        if not os.path.exists(fn):
-            logger.log("CoreSched: failed to locate memory node" + fn)
+        cpus = topology.get().node_cpus.get(index)
+        if cpus is None:
+            logger.log("CoreSched: failed to locate memory node " + str(index))
             return []
-
-        return self.get_cgroup_var(filename=fn)
+        return cpus
 
     def get_core_siblings(self, index):
-        # use core_siblings rather than core_siblings_list, as it's compatible
-        # with older kernels
-        fn = "/sys/devices/system/cpu/cpu" + str(index) + "/topology/core_siblings"
-        if not os.path.exists(fn):
-            return []
-        siblings = []
-
-        with open(fn, "rt") as f:
-            x = int(f.readline().strip(), 16)
-        cpuid = 0
-        while (x>0):
-            if (x&1)!=0:
-                siblings.append(cpuid)
-            x = x >> 1
-            cpuid += 1
-
-        return siblings
+        return topology.get().core_siblings.get(index, [])
 
 
 # a little self-test
@@ -10,19 +10,28 @@ computed locally is stored under keys that begin with an underscore,
 and data from PLC is stored under keys that don't.
 
 In order to maintain service when the node reboots during a network
-partition, the database is constantly being dumped to disk.
+partition, the database is constantly being dumped to disk: what changes
+at each sync is appended to a journal, that gets compacted into a full
+dump from time to time.
 """
 
+import os
 import sys
 
+import copy
 import pickle
 import threading
 import time
+from collections.abc import Mapping
+from types import MappingProxyType
 
 import account
 import logger
 import tools
 import bwmon
+import expiry
+import planner
+from journal import Journal
 
 # hopefully temporary
 # is there a good reason to have this done here and not in a plugin ?
@@ -42,15 +51,30 @@ MINIMUM_ALLOCATION = {'cpu_pct': 0,
 LOANABLE_RESOURCES = list(MINIMUM_ALLOCATION.keys())
 
 DB_FILE = '/var/lib/nodemanager/database.pickle'
+JOURNAL_FILE = '/var/lib/nodemanager/database.journal'
+# rewrite DB_FILE and start over with an empty journal past that size
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
 
 
 # database object and associated lock
 db_lock = threading.RLock()
 db = None
 
+# name -> when the record expires, and name -> its timestamp, so that
+# expired and stale records can be found without scanning the database;
+# kept up to date by deliver_record(), and rebuilt by start()
+expires_index = expiry.ExpiryIndex()
+timestamps_index = expiry.ExpiryIndex()
+
+# serializes execute_sync(), that runs without db_lock
+execute_lock = threading.Lock()
+executed_version = 0
+
 # these are used in tandem to request a database dump from the dumper daemon
 db_cond = threading.Condition(db_lock)
 dump_requested = False
+# the changes that the dumper daemon has yet to write in the journal
+pending_ops = []
 
 # decorator that acquires and releases the database lock before and after the decorated operation
 # XXX - replace with "with" statements once we switch to 2.5
@@ -64,9 +88,108 @@ def synchronized(fn):
     return sync_fn
 
 
+class Snapshot(Mapping):
+    """An immutable view of the database, as of a given version.
+Records are read-only mappings; the values they hold are private copies,
+that are shared with the next snapshots for as long as they do not change.
+Readers must not modify them."""
+
+    def __init__(self, records, version, min_timestamp=0):
+        self._records = records
+        self.version = version
+        self.min_timestamp = min_timestamp
+
+    def __getitem__(self, name):
+        return self._records[name]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __repr__(self):
+        return "<Snapshot v{} with {} records>".format(self.version, len(self))
+
+
+EMPTY_SNAPSHOT = Snapshot({}, 0)
+
+
+def _freeze(rec, previous):
+    """A frozen copy of rec; reuse what is unchanged from previous, a frozen record or None"""
+    if previous is not None and len(previous) == len(rec) \
+       and all(key in previous and previous[key] == value for key, value in rec.items()):
+        return previous
+    frozen = {}
+    for key, value in rec.items():
+        if previous is not None and key in previous and previous[key] == value:
+            frozen[key] = previous[key]
+        else:
+            frozen[key] = copy.deepcopy(value)
+    return MappingProxyType(frozen)
+
+
 class Database(dict):
     def __init__(self):
         self._min_timestamp = 0
+        self._snapshot = EMPTY_SNAPSHOT
+
+    def __getstate__(self):
+        # snapshots are rebuilt on the fly, and cannot be pickled anyway
+        state = self.__dict__.copy()
+        state.pop('_snapshot', None)
+        return state
+
+    def snapshot(self):
+        """The latest published snapshot; does not need the lock."""
+        return getattr(self, '_snapshot', EMPTY_SNAPSHOT)
+
+    def _publish_snapshot(self, journal=True):
+        """Publish a snapshot of the current contents; to be called with the lock held.
+Unless journal is False, the changes since the previous snapshot are queued
+for the dumper daemon, as a list of operations:
+ * ('put', name, {key: value}, [removed keys])
+ * ('del', name)
+ * ('min_timestamp', ts)"""
+        previous = self.snapshot()
+        records = {}
+        ops = []
+        for name, rec in self.items():
+            old = previous._records.get(name)
+            frozen = _freeze(rec, old)
+            records[name] = frozen
+            if frozen is old:
+                continue
+            if old is None:
+                ops.append(('put', name, dict(frozen), []))
+            else:
+                changed = {key: value for key, value in frozen.items()
+                           if key not in old or old[key] is not value}
+                removed = [key for key in old if key not in frozen]
+                ops.append(('put', name, changed, removed))
+        for name in previous:
+            if name not in records:
+                ops.append(('del', name))
+        if self._min_timestamp != previous.min_timestamp:
+            ops.append(('min_timestamp', self._min_timestamp))
+        self._snapshot = Snapshot(records, previous.version + 1, self._min_timestamp)
+        if journal:
+            pending_ops.extend(ops)
+
+    def replay(self, ops):
+        """Apply operations as produced by _publish_snapshot"""
+        for op in ops:
+            if op[0] == 'put':
+                (_, name, changed, removed) = op
+                rec = self.setdefault(name, {})
+                rec.update(changed)
+                for key in removed:
+                    rec.pop(key, None)
+            elif op[0] == 'del':
+                self.pop(op[1], None)
+            elif op[0] == 'min_timestamp':
+                self._min_timestamp = op[1]
+
 
     def _compute_effective_rspecs(self):
         """Calculate the effects of loans and store the result in field _rspec.
@@ -105,94 +228,162 @@ keys."""
                 if not key.startswith('_'):
                     del old_rec[key]
             old_rec.update(rec)
+        else:
+            return
+        _index(name, rec)
 
     def set_min_timestamp(self, ts):
         """The ._min_timestamp member is the timestamp on the last comprehensive update.
 We use it to determine if a record is stale.
 This method should be called whenever new GetSlivers() data comes in."""
         self._min_timestamp = ts
-        for name, rec in list(self.items()):
-            if rec['timestamp'] < ts: del self[name]
+        for name in timestamps_index.expired(ts, strict=True):
+            if name in self and self[name]['timestamp'] < ts:
+                del self[name]
+                expires_index.discard(name)
 
     def sync(self):
         """Synchronize reality with the database contents.  This
 method does a lot of things, and it's currently called after every
 single batch of database changes (a GetSlivers(), a loan, a record).
-It may be necessary in the future to do something smarter."""
+It may be necessary in the future to do something smarter.
+Only the bookkeeping in prepare_sync() is done with the lock held;
+callers that already hold it should rather call prepare_sync() and
+release the lock before calling execute_sync()."""
+        with db_lock:
+            snapshot = self.prepare_sync()
+        self.execute_sync(snapshot)
 
+    def prepare_sync(self):
+        """The critical section of sync(): drop expired records, compute
+effective rspecs, publish and return a snapshot.  Quick, and to be
+called with the lock held."""
         # delete expired records
         now = time.time()
-        for name, rec in list(self.items()):
-            if rec.get('expires', now) < now: del self[name]
+        for name in expires_index.expired(now, strict=True):
+            if name in self and self[name].get('expires', now) < now:
+                del self[name]
+                timestamps_index.discard(name)
 
         self._compute_effective_rspecs()
+        self._publish_snapshot()
+
+        global dump_requested
+        dump_requested = True
+        db_cond.notify()
+        return self.snapshot()
+
+    def execute_sync(self, snapshot):
+        """Apply snapshot to the system; does not need the lock, as
+it only reads the snapshot."""
+        global executed_version
+        with execute_lock:
+            # two syncs may prepare and execute in a different order
+            if snapshot.version < executed_version:
+                snapshot = self.snapshot()
+            executed_version = snapshot.version
+            self._execute_sync(snapshot)
 
+    def _execute_sync(self, snapshot):
         try:
             coresched = CoreSched()
-            coresched.adjustCores(self)
+            coresched.adjustCores(snapshot)
         except:
             logger.log_exc("database: exception while doing core sched")
 
-        # create and destroy accounts as needed
-        logger.verbose("database: sync : fetching accounts")
-        existing_acct_names = account.all()
-        for name in existing_acct_names:
-            if name not in self:
-                logger.verbose("database: sync : ensure_destroy'ing %s"%name)
-                account.get(name).ensure_destroyed()
-        for name, rec in self.items():
-            # protect this; if anything fails for a given sliver
-            # we still need the other ones to be handled
+        logger.verbose("database: sync : worker pool {}"
+                       .format(account.pool.stats.summary(account.pool.depth())))
+
+        # create and destroy accounts as needed: figure out what to do,
+        # and have the account worker pool do it
+        plan = planner.make_plan(snapshot, planner.observe())
+        logger.log("database: sync : plan is {}".format(plan.summary() or "empty"))
+        for action in plan:
+            logger.verbose("database: sync : {}".format(action))
             try:
-                sliver = account.get(name)
-                logger.verbose("database: sync : looping on %s (shell account class from pwd %s)" %(name, sliver._get_class()))
-                # Make sure we refresh accounts that are running
-                if rec['instantiation'] == 'plc-instantiated':
-                    logger.verbose ("database: sync : ensure_create'ing 'instantiation' sliver %s"%name)
-                    sliver.ensure_created(rec)
-                elif rec['instantiation'] == 'nm-controller':
-                    logger.verbose ("database: sync : ensure_create'ing 'nm-controller' sliver %s"%name)
-                    sliver.ensure_created(rec)
-                # Back door to ensure PLC overrides Ticket in delegation.
-                elif rec['instantiation'] == 'delegated' and sliver._get_class() != None:
-                    # if the ticket has been delivered and the nm-controller started the slice
-                    # update rspecs and keep them up to date.
-                    if sliver.is_running():
-                        logger.verbose ("database: sync : ensure_create'ing 'delegated' sliver %s"%name)
-                        sliver.ensure_created(rec)
+                account.get(action.name).apply(action)
             except SystemExit as e:
                 sys.exit(e)
             except:
-                logger.log_exc("database: sync failed to handle sliver", name=name)
+                logger.log_exc("database: sync failed to handle sliver", name=action.name)
 
-        # Wake up bwmom to update limits.
+        # Wake up bwmom to update limits; the pool does it again
+        # once the slivers are created and started
         bwmon.lock.set()
-        global dump_requested
-        dump_requested = True
-        db_cond.notify()
+
+
+def _index(name, rec):
+    expires_index.set(name, rec.get('expires'))
+    timestamps_index.set(name, rec['timestamp'])
+
+
+def _reindex(database):
+    expires_index.clear()
+    timestamps_index.clear()
+    for name, rec in database.items():
+        _index(name, rec)
+
+
+def _expire():
+    """Called by the expiry timer as soon as a record expires"""
+    with db_lock:
+        logger.verbose("database: expiring records")
+        snapshot = db.prepare_sync()
+    db.execute_sync(snapshot)
+
+
+def _snapshot_to_database(snapshot):
+    """a plain Database with the contents of snapshot - for dumping"""
+    dump = Database()
+    dump._min_timestamp = snapshot.min_timestamp
+    for name, rec in snapshot.items():
+        dump[name] = dict(rec)
+    return dump
+
+
+def _compact(journal, snapshot):
+    """Write a full dump of snapshot, and truncate the journal"""
+    dump = _snapshot_to_database(snapshot)
+    # make sure the dump is on disk before we trash the journal
+    temporary = DB_FILE + '.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump(dump, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, DB_FILE)
+    journal.truncate()
+    logger.log_database(dump)
 
 
 def start():
     """The database dumper daemon.
-When it starts up, it populates the database with the last dumped database.
+When it starts up, it populates the database with the last dumped database,
+and replays the journal on top of that.
 It proceeds to handle dump requests forever."""
+    journal = Journal(JOURNAL_FILE)
     def run():
-        global dump_requested
+        global dump_requested, pending_ops
         while True:
             db_lock.acquire()
             while not dump_requested: db_cond.wait()
-            db_pickle = pickle.dumps(db, pickle.HIGHEST_PROTOCOL)
+            ops, pending_ops = pending_ops, []
+            snapshot = db.snapshot()
             dump_requested = False
             db_lock.release()
             try:
-                tools.write_file(
-                    DB_FILE, lambda f: f.write(db_pickle), binary=True)
-                logger.log_database(db)
+                journal.append(ops)
+                if journal.size() > JOURNAL_COMPACT_SIZE:
+                    logger.verbose("database: compacting journal into %s"%DB_FILE)
+                    _compact(journal, snapshot)
             except:
-                logger.log_exc("database.start: failed to pickle/dump")
+                logger.log_exc("database.start: failed to journal - trying a full dump")
+                try:
+                    _compact(journal, snapshot)
+                except:
+                    logger.log_exc("database.start: failed to pickle/dump")
     global db
     try:
-        f = open(DB_FILE)
+        f = open(DB_FILE, 'rb')
         try: db = pickle.load(f)
         finally: f.close()
     except IOError:
@@ -201,5 +392,19 @@ It proceeds to handle dump requests forever."""
     except:
         logger.log_exc("database: failed in start")
         db = Database()
+    try:
+        batches = journal.replay()
+        for ops in batches:
+            db.replay(ops)
+        logger.log("database: replayed %d journal entries from %s"%(len(batches), JOURNAL_FILE))
+    except:
+        logger.log_exc("database: failed to replay journal")
+    _reindex(db)
+    # don't journal what was just read back
+    db._publish_snapshot(journal=False)
+    # have bwmon pick up the slivers the pool is done creating
+    account.pool.idle_hooks.append(bwmon.lock.set)
     logger.log('database.start')
     tools.as_daemon_thread(run)
+    # sync as soon as a record expires, rather than on the next GetSlivers()
+    tools.as_daemon_thread(lambda: expiry.run_timer(expires_index, _expire))
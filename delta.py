@@ -0,0 +1,231 @@
+"""
+Structural diff between two successive GetSlivers payloads.
+
+Most cycles bring no change at all from PLC, yet every plugin used to walk
+the whole 'slivers' list and redo its filesystem checks. Modules that set
+
+    incremental = True
+
+receive instead a shallow copy of data where 'slivers' only holds the
+slivers that were added or modified since the previous cycle, together with
+  (*) data['_delta']        : the Delta object for this cycle
+  (*) data['_full_resync']  : True when 'slivers' is the complete list
+
+A full resync is performed on the first cycle, every N cycles, and whenever
+a top-level key other than 'slivers' (e.g. 'hostname', 'xmpp', 'accounts')
+has changed, as incremental plugins may depend on these.
+
+A plugin that could not handle a sliver yet (typically because the sliver
+has not been created) calls retry(data, slicename) so the sliver is passed
+again on the next cycle, changed or not. The slivers to retry are only
+taken off the list once the plugin has run through, see Differ.done().
+
+The Differ also computes a hash of the whole payload, so that nodemanager
+can tell cycles where nothing at all has changed; modules that set
+
+    idempotent = True
+
+are not run at all on such cycles, unless it is time for a full resync.
+"""
+
+import json
+import hashlib
+
+import logger
+from tagindex import get_index, INDEX_KEY
+
+# these are expected to change on every cycle and carry no information
+IGNORED_KEYS = ['timestamp', INDEX_KEY]
+
+
+def _fingerprint(value):
+    """a canonical, comparable form for a piece of the GetSlivers payload"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _tag_fingerprints(sliver):
+    """tagname -> fingerprint of all the values for that tag"""
+    tags = {}
+    for attribute in sliver.get('attributes', []):
+        # for legacy, try the old-fashioned 'name' as well
+        name = attribute.get('tagname', attribute.get('name', ''))
+        tags.setdefault(name, []).append(attribute.get('value'))
+    return {name: _fingerprint(values) for name, values in tags.items()}
+
+
+class Delta:
+
+    def __init__(self):
+        self.added = set()
+        self.removed = set()
+        # slicename -> set of tagnames (or sliver fields) that have changed
+        self.modified = {}
+        # top-level keys that have changed
+        self.keys = set()
+
+    def changed(self):
+        """names of the slivers that plugins need to look at"""
+        return self.added | set(self.modified)
+
+    def empty(self):
+        return not (self.added or self.removed or self.modified or self.keys)
+
+    def __repr__(self):
+        return "<Delta +{} -{} ~{} keys={}>".format(
+            len(self.added), len(self.removed), len(self.modified),
+            ",".join(sorted(self.keys)) or "none")
+
+
+class Differ:
+
+    def __init__(self, resync_cycles=6):
+        self.resync_cycles = max(1, int(resync_cycles))
+        # slicename -> (sliver fingerprint, {tagname: fingerprint})
+        self.slivers = None
+        # top-level key -> fingerprint
+        self.keys = {}
+        self.cycle = 0
+        self.delta = None
+        self.full = True
+        # module name -> slicenames to pass again on the next cycle
+        self.retries = {}
+        # sha256 of the canonical payload, and whether it is the same as last cycle
+        self.hash = None
+        self.unchanged = False
+        self.unchanged_cycles = 0
+        self.unchanged_streak = 0
+
+    def update(self, data):
+        """
+        compare data with what was seen on the previous call;
+        returns the Delta, also available as self.delta
+        """
+        delta = Delta()
+        keys = {key: _fingerprint(value) for key, value in data.items()
+                if key != 'slivers' and key not in IGNORED_KEYS}
+        for key in set(keys) | set(self.keys):
+            if keys.get(key) != self.keys.get(key):
+                delta.keys.add(key)
+
+        slivers = {}
+        for sliver in data.get('slivers', []):
+            fields = {key: value for key, value in sliver.items() if key != 'attributes'}
+            slivers[sliver['name']] = (_fingerprint(fields), _tag_fingerprints(sliver))
+
+        previous = self.slivers or {}
+        for name, (fields, tags) in slivers.items():
+            if name not in previous:
+                delta.added.add(name)
+                continue
+            (old_fields, old_tags) = previous[name]
+            changes = {tagname for tagname in set(tags) | set(old_tags)
+                       if tags.get(tagname) != old_tags.get(tagname)}
+            if fields != old_fields:
+                changes.add('_fields')
+            if changes:
+                delta.modified[name] = changes
+        delta.removed = set(previous) - set(slivers)
+
+        digest = hashlib.sha256()
+        for key in sorted(keys):
+            digest.update("{}={}\n".format(key, keys[key]).encode())
+        for sliver in data.get('slivers', []):
+            (fields, tags) = slivers[sliver['name']]
+            digest.update("{}\n".format(fields).encode())
+            for tagname in sorted(tags):
+                digest.update("{}={}\n".format(tagname, tags[tagname]).encode())
+        payload_hash = digest.hexdigest()
+        self.unchanged = payload_hash == self.hash
+        self.hash = payload_hash
+        if self.unchanged:
+            self.unchanged_cycles += 1
+            self.unchanged_streak += 1
+        else:
+            self.unchanged_streak = 0
+
+        self.full = self.slivers is None \
+            or self.cycle % self.resync_cycles == 0 \
+            or bool(delta.keys)
+        self.cycle += 1
+        self.slivers = slivers
+        self.keys = keys
+        self.delta = delta
+        logger.verbose("delta: cycle {} - {}{}"
+                       .format(self.cycle, delta, " - full resync" if self.full else ""))
+        return delta
+
+    def metrics(self):
+        return "{} unchanged cycle(s) in a row, {}/{} overall".format(
+            self.unchanged_streak, self.unchanged_cycles, self.cycle)
+
+    def view(self, data, module_name):
+        """the data to pass to an incremental module"""
+        if self.delta is None or 'slivers' not in data:
+            return data
+        retries = self.retries.get(module_name, set())
+        view = dict(data)
+        if not self.full:
+            wanted = self.delta.changed() | retries
+            view['slivers'] = [sliver for sliver in data['slivers']
+                               if sliver['name'] in wanted]
+            view[INDEX_KEY] = get_index(data).subset(wanted)
+        view['_delta'] = self.delta
+        view['_full_resync'] = self.full
+        view['_retry'] = set()
+        return view
+
+    def done(self, module_name, view):
+        """
+        to be called once the module has run on view without failing;
+        until then, the slivers it asked to retry before are kept
+        """
+        if '_retry' in view:
+            self.retries[module_name] = view['_retry']
+
+
+def retry(data, slicename):
+    """have slicename passed again to the calling plugin on next cycle"""
+    if '_retry' in data:
+        data['_retry'].add(slicename)
+
+
+# a little self-test
+if __name__ == '__main__':
+    def sliver(name, **tags):
+        return {'name': name, 'expires': 0,
+                'attributes': [{'tagname': tag, 'value': value} for tag, value in tags.items()]}
+    differ = Differ(resync_cycles=3)
+    data = {'hostname': 'node', 'timestamp': 1,
+            'slivers': [sliver('a', vref='f'), sliver('b', vsys='x')]}
+    differ.update(data)
+    assert differ.full and differ.delta.added == {'a', 'b'}
+    data = {'hostname': 'node', 'timestamp': 2,
+            'slivers': [sliver('a', vref='f'), sliver('b', vsys='y'), sliver('c')]}
+    differ.update(data)
+    assert not differ.full
+    assert differ.delta.added == {'c'} and differ.delta.modified == {'b': {'vsys'}}
+    view = differ.view(data, 'plugin')
+    assert [s['name'] for s in view['slivers']] == ['b', 'c']
+    retry(view, 'a')
+    differ.done('plugin', view)
+    differ.update(data)
+    view = differ.view(data, 'plugin')
+    assert [s['name'] for s in view['slivers']] == ['a'], "retried"
+    # the plugin failed, without done(): 'a' is not lost
+    assert differ.retries['plugin'] == {'a'}
+    view = differ.view(data, 'plugin')
+    assert [s['name'] for s in view['slivers']] == ['a'], "retried again"
+    differ.done('plugin', view)
+    assert differ.retries['plugin'] == set()
+    data = {'hostname': 'node', 'timestamp': 3, 'slivers': [sliver('a', vref='f'), sliver('b', vsys='y')]}
+    differ.update(data)
+    assert differ.full, "resync every 3 cycles"
+    assert differ.delta.removed == {'c'}
+    data['hostname'] = 'other'
+    differ.update(data)
+    assert differ.full and differ.delta.keys == {'hostname'}
+    differ.update(data)
+    assert differ.unchanged and differ.delta.empty()
+    view = differ.view(data, 'plugin')
+    assert [s['name'] for s in view['slivers']] == []
+    print("delta: OK")
@@ -0,0 +1,180 @@
+"""
+An index of things that expire, e.g. database records or bwmon's dead slices.
+
+Instead of scanning all of them on each run to find the expired ones,
+an ExpiryIndex keeps their deadlines in a heap: set() and discard() are
+O(log n), and expired() is O(expired log n). Outdated heap entries -
+left behind by discard() or by a new deadline for the same key - are
+skipped when they surface, and the heap gets rebuilt once they make up
+most of it.
+
+run_timer() calls back as soon as a deadline is due, so that expiry
+can happen on time rather than on the next periodic run.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+import logger
+
+# sleep at most that long, in case the clock jumps
+MAX_SLEEP = 3600
+# and at least that long between two callbacks, twice as long after
+# each failed one in a row, up to MAX_SLEEP
+MIN_SLEEP = 1
+
+
+class ExpiryIndex:
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # (deadline, seq, key) - seq so that keys never get compared
+        self.heap = []
+        self.deadlines = {}
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def set(self, key, deadline):
+        """key expires at deadline; None means never"""
+        with self.cond:
+            if deadline is None:
+                self._discard(key)
+                return
+            if self.deadlines.get(key) == deadline:
+                return
+            earliest = self.heap[0][0] if self.heap else None
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.seq), key))
+            self._compact()
+            if earliest is None or deadline < earliest:
+                # a timer may have to wake up sooner
+                self.cond.notify_all()
+
+    def discard(self, key):
+        with self.cond:
+            self._discard(key)
+
+    def _discard(self, key):
+        if self.deadlines.pop(key, None) is not None:
+            self._compact()
+
+    def _compact(self):
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, next(self.seq), key) for (key, deadline) in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def _prune(self):
+        """drop the outdated entries at the top of the heap"""
+        while self.heap:
+            (deadline, seq, key) = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self.heap)
+
+    def next_deadline(self):
+        with self.cond:
+            self._prune()
+            return self.heap[0][0] if self.heap else None
+
+    def expired(self, now, strict=False):
+        """
+        remove and return the keys whose deadline is past now,
+        or equal to now unless strict
+        """
+        result = []
+        with self.cond:
+            while True:
+                self._prune()
+                if not self.heap:
+                    break
+                deadline = self.heap[0][0]
+                if deadline > now or (strict and deadline == now):
+                    break
+                (deadline, seq, key) = heapq.heappop(self.heap)
+                del self.deadlines[key]
+                result.append(key)
+        return result
+
+    def clear(self):
+        with self.cond:
+            self.heap = []
+            self.deadlines = {}
+
+
+def run_timer(index, callback, clock=time.time):
+    """
+    When run as a thread, call callback() whenever a deadline in index is due.
+    callback is expected to remove the expired keys, e.g. through expired();
+    while it keeps failing, it gets called less and less often.
+    """
+    failures = 0
+    while True:
+        with index.cond:
+            deadline = index.next_deadline()
+            now = clock()
+            if deadline is None or deadline > now:
+                index.cond.wait(MAX_SLEEP if deadline is None else min(deadline - now, MAX_SLEEP))
+                continue
+        try:
+            callback()
+            failures = 0
+        except:
+            failures += 1
+            logger.log_exc("expiry: callback failed %d time(s) in a row" % failures)
+        time.sleep(min(MIN_SLEEP * 2 ** failures, MAX_SLEEP))
+
+
+# a little self-test
+if __name__ == '__main__':
+    import os
+
+    index = ExpiryIndex()
+    for i in range(1000):
+        index.set(i, 1000 + i)
+    index.set(5, 5000)
+    index.set(7, None)
+    for i in range(500, 1000):
+        index.discard(i)
+    assert len(index) == 499 and 7 not in index and index.get(5) == 5000
+    assert index.expired(1009) == [0, 1, 2, 3, 4, 6, 8, 9]
+    assert index.expired(1010, strict=True) == []
+    assert index.expired(1010) == [10]
+    assert index.next_deadline() == 1011
+    assert len(index.heap) < 2 * len(index) + 64 + 1, "compacted"
+    assert index.expired(4999) == list(range(11, 500))
+    assert index.expired(10 ** 6) == [5] and index.next_deadline() is None
+    # the timer wakes up early when a sooner deadline comes in
+    calls = []
+    index = ExpiryIndex()
+    def callback():
+        calls.append(index.expired(time.time()))
+    index.set('far', time.time() + 100)
+    threading.Thread(target=run_timer, args=(index, callback), daemon=True).start()
+    time.sleep(0.1)
+    index.set('soon', time.time() + 0.2)
+    time.sleep(0.6)
+    assert calls == [['soon']], calls
+    # a callback that keeps failing gets backed off
+    logger.LOG_FILE = os.devnull
+    MIN_SLEEP = 0.05
+    failures = []
+    def failing():
+        failures.append(time.time())
+        raise RuntimeError("no luck")
+    index = ExpiryIndex()
+    index.set('stuck', time.time())
+    threading.Thread(target=run_timer, args=(index, failing), daemon=True).start()
+    time.sleep(1)
+    # at 0, .1, .3, .7 rather than every .05s
+    assert 3 <= len(failures) <= 5, failures
+    print("expiry: OK")
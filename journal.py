@@ -0,0 +1,112 @@
+"""
+An append-only journal of pickled entries.
+
+Each entry is stored as a 4-byte big-endian length, followed by the pickle.
+Appending costs one write and one fsync, whatever the size of what the
+entries describe. On replay, a truncated or otherwise unreadable tail -
+as left behind by a crash in the middle of an append - is dropped.
+"""
+
+import os
+import pickle
+import struct
+
+import logger
+
+HEADER = struct.Struct('>I')
+
+
+class Journal:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def replay(self):
+        """
+        Return the list of entries found in the journal;
+        the file gets truncated after the last valid entry.
+        """
+        entries = []
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return entries
+        with f:
+            offset = 0
+            while True:
+                header = f.read(HEADER.size)
+                if not header:
+                    break
+                try:
+                    if len(header) != HEADER.size:
+                        raise EOFError("truncated header")
+                    (length,) = HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) != length:
+                        raise EOFError("truncated entry")
+                    entries.append(pickle.loads(payload))
+                except Exception as e:
+                    logger.log("journal: dropping corrupt tail of {} at offset {} ({})"
+                               .format(self.filename, offset, e))
+                    os.truncate(self.filename, offset)
+                    break
+                offset += HEADER.size + length
+        return entries
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.filename, 'ab')
+        return self.file
+
+    def append(self, *entries):
+        """write entries, and make sure they hit the disk before returning"""
+        if not entries:
+            return
+        f = self._open()
+        chunks = []
+        for entry in entries:
+            payload = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            chunks.append(HEADER.pack(len(payload)))
+            chunks.append(payload)
+        f.write(b''.join(chunks))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.filename)
+        except OSError:
+            return 0
+
+    def truncate(self):
+        f = self._open()
+        f.truncate(0)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# a little self-test
+if __name__ == '__main__':
+    import tempfile
+    filename = os.path.join(tempfile.mkdtemp(), 'test.journal')
+    journal = Journal(filename)
+    journal.append(['one'], ['two'])
+    journal.append({'three': 3})
+    journal.close()
+    assert Journal(filename).replay() == [['one'], ['two'], {'three': 3}]
+    # simulate a crash in the middle of an append
+    size = os.path.getsize(filename)
+    with open(filename, 'ab') as f:
+        f.write(HEADER.pack(100) + b'garbage')
+    assert Journal(filename).replay() == [['one'], ['two'], {'three': 3}]
+    assert os.path.getsize(filename) == size
+    journal = Journal(filename)
+    journal.truncate()
+    assert journal.replay() == []
+    print("journal: OK")
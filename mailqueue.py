@@ -0,0 +1,250 @@
+"""
+Queue for the mails that nodemanager sends to slices, e.g. bwmon's
+over-quota notices.
+
+bwmon used to fork sendmail right away for each capped slice, re-reading
+the PLC config each time, and from within its sync loop. Mails now go
+through a queue instead:
+  (*) put() writes each message as a file in SPOOL_DIR, so that queued
+      mails survive a restart, and returns right away;
+  (*) messages carry a key, and a key that was queued or sent within
+      DEDUP_TTL is dropped - bwmon uses one key per slice and period;
+  (*) a sender thread wakes up every FLUSH_INTERVAL seconds, or when
+      asked to, and sends one digest per recipient with all the messages
+      for that recipient, at most MAX_PER_HOUR mails per hour - the rest
+      waits for the next rounds;
+  (*) the actual sending is up to a transport: SendmailTransport pipes
+      into sendmail as before, SMTPTransport talks to an SMTP server,
+      e.g. a local stand-in for tests.
+"""
+
+import os
+import sys
+import json
+import time
+import smtplib
+import threading
+import subprocess
+import email.message
+
+import logger
+import tools
+from config import Config
+
+SPOOL_DIR = '/var/lib/nodemanager/mailqueue'
+# where the keys of the messages already sent are remembered
+SENT_FILE = 'sent.json'
+DEDUP_TTL = 2 * 24 * 60 * 60
+FLUSH_INTERVAL = 60
+MAX_PER_HOUR = 60
+
+SENDMAIL = '/usr/sbin/sendmail'
+
+
+class SendmailTransport:
+
+    def send(self, sender, recipients, message):
+        process = subprocess.Popen([SENDMAIL, '-N', 'never', '-t', '-f%s' % sender],
+                                   stdin=subprocess.PIPE)
+        process.communicate(message.as_bytes())
+        if process.returncode != 0:
+            raise Exception("sendmail returned %d" % process.returncode)
+
+
+class SMTPTransport:
+
+    def __init__(self, host='localhost', port=25):
+        self.host = host
+        self.port = port
+
+    def send(self, sender, recipients, message):
+        with smtplib.SMTP(self.host, self.port) as smtp:
+            smtp.send_message(message, sender, recipients)
+
+
+class MailQueue:
+
+    def __init__(self, spool_dir=SPOOL_DIR, transport=None, config=Config,
+                 max_per_hour=MAX_PER_HOUR, clock=time.time):
+        self.spool_dir = spool_dir
+        self.transport = transport or SendmailTransport()
+        # called on each flush, so config changes get noticed
+        self.config = config
+        self.max_per_hour = max_per_hour
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # when the last mails were sent, for the rate limiting
+        self.sent_times = []
+        self.seq = 0
+        self.sent = None
+
+    def _sent_keys(self):
+        """key -> when it was queued, loaded on first use"""
+        if self.sent is None:
+            try:
+                with open(os.path.join(self.spool_dir, SENT_FILE)) as f:
+                    self.sent = json.load(f)
+            except (IOError, ValueError):
+                self.sent = {}
+        now = self.clock()
+        for (key, when) in list(self.sent.items()):
+            if now - when > DEDUP_TTL:
+                del self.sent[key]
+        return self.sent
+
+    def _write(self, name, contents):
+        path = os.path.join(self.spool_dir, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(contents, f)
+        os.replace(path + '.tmp', path)
+
+    def _pending(self):
+        """the queued messages, oldest first, as (filename, message)"""
+        pending = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.msg'):
+                continue
+            try:
+                with open(os.path.join(self.spool_dir, name)) as f:
+                    pending.append((name, json.load(f)))
+            except (IOError, ValueError):
+                logger.log("mailqueue: dropping unreadable %s" % name)
+                os.unlink(os.path.join(self.spool_dir, name))
+        return pending
+
+    def put(self, slice, subject, body, key=None):
+        """queue a mail for slice; returns False if key was seen already"""
+        with self.lock:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            sent = self._sent_keys()
+            if key is not None:
+                if key in sent:
+                    logger.verbose("mailqueue: %s already queued - skipped" % key)
+                    return False
+                sent[key] = self.clock()
+                self._write(SENT_FILE, sent)
+            self.seq += 1
+            name = "%017.6f-%d.msg" % (self.clock(), self.seq)
+            self._write(name, {'slice': slice, 'subject': subject, 'body': body})
+        self.wakeup.set()
+        return True
+
+    def recipients(self, config, slice):
+        to = [config.PLC_MAIL_MOM_LIST_ADDRESS]
+        if slice is not None and slice != "root":
+            to.append(config.PLC_MAIL_SLICE_ADDRESS.replace("SLICE", slice))
+        return to
+
+    def digest(self, config, recipient, messages):
+        """one mail for recipient, out of the messages meant for it"""
+        mail = email.message.EmailMessage()
+        mail['From'] = "%s Support <%s>" % (config.PLC_NAME, config.PLC_MAIL_SUPPORT_ADDRESS)
+        mail['Reply-To'] = mail['From']
+        mail['To'] = recipient
+        mail['X-Mailer'] = "Python/%s" % sys.version.split(" ")[0]
+        if len(messages) == 1:
+            mail['Subject'] = messages[0]['subject']
+        else:
+            mail['Subject'] = "%s (and %d more)" % (messages[0]['subject'], len(messages) - 1)
+        mail.set_content("\n".join(message['body'] for message in messages))
+        return mail
+
+    def flush(self):
+        """send what the rate limit allows; returns the number of mails sent"""
+        with self.lock:
+            if not os.path.isdir(self.spool_dir):
+                return 0
+            pending = self._pending()
+            if not pending:
+                return 0
+            now = self.clock()
+            self.sent_times = [when for when in self.sent_times if now - when < 3600]
+            budget = self.max_per_hour - len(self.sent_times)
+            if budget <= 0:
+                logger.verbose("mailqueue: rate limit reached, %d message(s) wait" % len(pending))
+                return 0
+            config = self.config()
+            # recipient -> [(filename, message)], in order of first appearance
+            digests = {}
+            for (name, message) in pending:
+                for recipient in self.recipients(config, message['slice']):
+                    if recipient not in message.setdefault('done', []):
+                        digests.setdefault(recipient, []).append((name, message))
+            count = 0
+            for (recipient, entries) in list(digests.items())[:budget]:
+                mail = self.digest(config, recipient, [message for (name, message) in entries])
+                try:
+                    self.transport.send(config.PLC_MAIL_SUPPORT_ADDRESS, [recipient], mail)
+                except:
+                    logger.log_exc("mailqueue: could not send to %s" % recipient)
+                    continue
+                self.sent_times.append(now)
+                count += 1
+                for (name, message) in entries:
+                    message['done'].append(recipient)
+            # a message goes away once all its recipients have got it
+            for (name, message) in pending:
+                if all(recipient in message['done']
+                       for recipient in self.recipients(config, message['slice'])):
+                    os.unlink(os.path.join(self.spool_dir, name))
+                elif message['done']:
+                    self._write(name, message)
+            logger.verbose("mailqueue: sent %d mail(s) for %d message(s)" % (count, len(pending)))
+            return count
+
+    def run(self):
+        """When run as a thread, flush the queue from time to time"""
+        while True:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except:
+                logger.log_exc("mailqueue: flush failed")
+
+
+queue = MailQueue()
+
+
+def start():
+    tools.as_daemon_thread(queue.run)
+
+
+# a little self-test, with a made-up config and a transport that collects the mails
+if __name__ == '__main__':
+    import tempfile
+
+    class FakeConfig:
+        PLC_NAME = 'Test'
+        PLC_MAIL_SUPPORT_ADDRESS = 'support@example.org'
+        PLC_MAIL_MOM_LIST_ADDRESS = 'mom@example.org'
+        PLC_MAIL_SLICE_ADDRESS = 'SLICE@slices.example.org'
+
+    class ListTransport:
+        def __init__(self):
+            self.mails = []
+        def send(self, sender, recipients, message):
+            self.mails.append((recipients, message))
+
+    spool = tempfile.mkdtemp()
+    transport = ListTransport()
+    q = MailQueue(spool, transport, FakeConfig, max_per_hour=2)
+    assert q.put('a', 'capped a', 'body a', key='a:1')
+    assert not q.put('a', 'capped a again', 'body a', key='a:1'), "duplicate"
+    assert q.put('b', 'capped b', 'body b', key='b:1')
+    # survives a restart, duplicates included
+    q = MailQueue(spool, transport, FakeConfig, max_per_hour=2)
+    assert not q.put('b', 'capped b', 'body b', key='b:1')
+    assert q.flush() == 2, "mom's digest, then a's"
+    (recipients, mail) = transport.mails[0]
+    assert recipients == ['mom@example.org'] and mail['Subject'] == 'capped a (and 1 more)'
+    assert 'body a' in mail.get_content() and 'body b' in mail.get_content()
+    assert transport.mails[1][0] == ['a@slices.example.org']
+    assert q.flush() == 0, "rate limited"
+    q.sent_times = []
+    assert q.flush() == 1
+    assert transport.mails[2][0] == ['b@slices.example.org']
+    assert q.flush() == 0 and not [name for name in os.listdir(spool) if name.endswith('.msg')]
+    print("mailqueue: OK")
@@ -17,8 +17,6 @@ import tools
 # we can't do anything without a network
 priority = 1
 
-dev_default = tools.get_default_if()
-
 
 def start():
     logger.log("net: plugin starting up...")
@@ -47,7 +45,7 @@ def GetSlivers(data, config, plc):
     if 'OVERRIDES' in dir(config):
         if config.OVERRIDES.get('net_max_rate') == '-1':
             logger.log("net: Slice and node BW Limits disabled.")
-            if len(bwlimit.tc("class show dev %s" % dev_default)):
+            if len(bwlimit.tc("class show dev %s" % tools.get_default_if())):
                 logger.verbose("net: *** DISABLING NODE BW LIMITS ***")
                 bwlimit.stop()
         else:
@@ -136,21 +134,26 @@ def InitNAT(plc, data):
         macs[sioc.gifhwaddr(dev).lower()] = dev
 
     ipt = iptables.IPTables()
-    for interface in data[KEY_NAME]:
-        # Get interface name preferably from MAC address, falling
-        # back on IP address.
-        hwaddr=interface['mac']
-        if hwaddr != None: hwaddr=hwaddr.lower()
-        if hwaddr in macs:
-            dev = macs[interface['mac']]
-        elif interface['ip'] in ips:
-            dev = ips[interface['ip']]
-        else:
-            logger.log('net: %s: no such interface with address %s/%s' % (interface['hostname'], interface['ip'], interface['mac']))
-            continue
+    # fetch the tags of all interfaces at once
+    lookups = []
+    with plc.batch() as batch:
+        for interface in data[KEY_NAME]:
+            # Get interface name preferably from MAC address, falling
+            # back on IP address.
+            hwaddr=interface['mac']
+            if hwaddr != None: hwaddr=hwaddr.lower()
+            if hwaddr in macs:
+                dev = macs[interface['mac']]
+            elif interface['ip'] in ips:
+                dev = ips[interface['ip']]
+            else:
+                logger.log('net: %s: no such interface with address %s/%s' % (interface['hostname'], interface['ip'], interface['mac']))
+                continue
+            lookups.append((dev, batch.GetInterfaceTags({'interface_tag_id': interface['interface_tag_ids']})))
 
+    for (dev, lookup) in lookups:
         try:
-            settings = plc.GetInterfaceTags({'interface_tag_id': interface['interface_tag_ids']})
+            settings = lookup.result()
         except:
             continue
 
@@ -21,9 +21,15 @@ from argparse import ArgumentParser
 
 import logger
 import tools
+import account
 
 from config import Config
 from plcapi import PLCAPI
+from safexmlrpc import TRANSPORTS
+from scheduler import ModuleScheduler
+from delta import Differ
+from tagindex import get_index, without_index
+import trigger
 
 
 class NodeManager:
@@ -36,11 +42,20 @@ class NodeManager:
     # NOTE: modules listed here will also be loaded in this order
     # once loaded, they get re-ordered after their priority (lower comes first)
     # for determining the runtime order
+    # a module can also list the modules it depends upon in its 'after' attribute,
+    # in which case it only waits for these; see scheduler.py
     core_modules = ['net', 'conf_files', 'slivermanager', 'bwmon']
 
     default_period = 600
     default_random = 301
     default_priority = 100
+    default_jobs = 4
+    default_resync_cycles = 6
+    default_transport = 'curl'
+    default_pool_size = 4
+    default_sliver_workers = 8
+    default_max_creates = 1
+    default_max_starts = 4
 
     def __init__ (self):
 
@@ -71,6 +86,49 @@ class NodeManager:
             '-v', '--verbose', action='store_true', dest='verbose',
             default=False,
             help='more verbose log')
+        parser.add_argument(
+            '-j', '--jobs', action='store', dest='jobs', type=int,
+            default=NodeManager.default_jobs,
+            help='Max number of modules run concurrently -- default {}'
+                 .format(NodeManager.default_jobs))
+        parser.add_argument(
+            '-R', '--resync-cycles', action='store', dest='resync_cycles', type=int,
+            default=NodeManager.default_resync_cycles,
+            help='Pass all slivers to incremental modules every that many cycles -- default {}'
+                 .format(NodeManager.default_resync_cycles))
+        parser.add_argument(
+            '-H', '--hints', action='store_true', dest='hints',
+            default=False,
+            help='also sync with PLC shortly after receiving a hint, e.g. the SyncNow API call')
+        parser.add_argument(
+            '-T', '--transport', action='store', dest='transport',
+            choices=TRANSPORTS, default=NodeManager.default_transport,
+            help='How to talk to PLC -- default {}'
+                 .format(NodeManager.default_transport))
+        parser.add_argument(
+            '--pool-size', action='store', dest='pool_size', type=int,
+            default=NodeManager.default_pool_size,
+            help='Max number of idle connections to PLC kept with the pooled transport -- default {}'
+                 .format(NodeManager.default_pool_size))
+        parser.add_argument(
+            '--sliver-workers', action='store', dest='sliver_workers', type=int,
+            default=NodeManager.default_sliver_workers,
+            help='Number of threads that create, start and destroy slivers, 0 to do it inline -- default {}'
+                 .format(NodeManager.default_sliver_workers))
+        parser.add_argument(
+            '--max-creates', action='store', dest='max_creates', type=int,
+            default=NodeManager.default_max_creates,
+            help='Max number of slivers being created at the same time -- default {}'
+                 .format(NodeManager.default_max_creates))
+        parser.add_argument(
+            '--max-starts', action='store', dest='max_starts', type=int,
+            default=NodeManager.default_max_starts,
+            help='Max number of slivers being started at the same time -- default {}'
+                 .format(NodeManager.default_max_starts))
+        parser.add_argument(
+            '-n', '--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='print what would be done to the slivers, and exit')
         parser.add_argument(
             '-P', '--path', action='store', dest='path',
             default=NodeManager.PLUGIN_PATH,
@@ -98,6 +156,9 @@ class NodeManager:
             self.modules = [self.options.user_module]
             logger.verbose('nodemanager: Running single module {}'.format(self.options.user_module))
 
+        # figures what has changed from one cycle to the other, for incremental modules
+        self.differ = Differ(self.options.resync_cycles)
+
 
     def GetSlivers(self, config, plc):
         """
@@ -111,10 +172,17 @@ class NodeManager:
             self.getPLCDefaults(data, config)
             # tweak the 'vref' attribute from GetSliceFamily
             self.setSliversVref(data)
-            # dump it too, so it can be retrieved later in case of comm. failure
-            self.dumpSlivers(data)
-            # log it for debug purposes, no matter what verbose is
-            logger.log_slivers(data)
+            # compare with the previous cycle
+            self.differ.update(data)
+            unchanged = self.differ.unchanged
+            if unchanged:
+                logger.log("nodemanager: GetSlivers unchanged (sha256 {}) - {}"
+                           .format(self.differ.hash[:16], self.differ.metrics()))
+            else:
+                # dump it too, so it can be retrieved later in case of comm. failure
+                self.dumpSlivers(data)
+                # log it for debug purposes, no matter what verbose is
+                logger.log_slivers(without_index(data))
             logger.verbose("nodemanager: Sync w/ PLC done")
             last_data = data
         except:
@@ -122,39 +190,50 @@ class NodeManager:
             # XXX So some modules can at least boostrap.
             logger.log("nodemanager:  Can't contact PLC to GetSlivers().  Continuing.")
             data = {}
+            unchanged = False
             # for modules that request it though the 'persistent_data' property
             last_data = self.loadSlivers()
 
         #  Invoke GetSlivers() functions from the callback modules
-        for module in self.loaded_modules:
+        exits = []
+        def run_module(module):
+            if unchanged and not self.differ.full and getattr(module, 'idempotent', False):
+                logger.verbose('nodemanager: skipping {}.GetSlivers - nothing has changed'
+                               .format(module.__name__))
+                return
             logger.verbose('nodemanager: triggering {}.GetSlivers'.format(module.__name__))
             try:
                 callback = getattr(module, 'GetSlivers')
                 module_data = data
                 if getattr(module, 'persistent_data', False):
                     module_data = last_data
-                callback(data, config, plc)
+                if getattr(module, 'incremental', False):
+                    module_view = self.differ.view(data, module.__name__)
+                    callback(module_view, config, plc)
+                    self.differ.done(module.__name__, module_view)
+                else:
+                    callback(data, config, plc)
             except SystemExit as e:
-                sys.exit(e)
+                exits.append(e)
             except:
                 logger.log_exc("nodemanager: GetSlivers failed to run callback for module {}"
                                .format(module))
+        report = self.scheduler.run(run_module)
+        report.log()
+        if exits:
+            sys.exit(exits[0])
 
 
     def getPLCDefaults(self, data, config):
         """
         Get PLC wide defaults from _default system slice.  Adds them to config class.
         """
-        for slice in data.get('slivers'):
-            if slice['name'] == config.PLC_SLICE_PREFIX + "_default":
-                attr_dict = {}
-                for attr in slice.get('attributes'):
-                    attr_dict[attr['tagname']] = attr['value']
-                if attr_dict:
-                    logger.verbose("nodemanager: Found default slice overrides.\n {}"
-                                   .format(attr_dict))
-                    config.OVERRIDES = attr_dict
-                    return
+        attr_dict = get_index(data).as_dict(config.PLC_SLICE_PREFIX + "_default")
+        if attr_dict:
+            logger.verbose("nodemanager: Found default slice overrides.\n {}"
+                           .format(attr_dict))
+            config.OVERRIDES = attr_dict
+            return
         # NOTE: if an _default slice existed, it would have been found above and
         #           the routine would return.  Thus, if we've gotten here, then no default
         #           slice is bound to this node.
@@ -168,15 +247,17 @@ class NodeManager:
         """
         # GetSlivers exposes the result of GetSliceFamily() as an separate key in data
         # It is safe to override the attributes with this, as this method has the right logic
+        tags = get_index(data)
         for sliver in data.get('slivers'):
             try:
                 slicefamily = sliver.get('GetSliceFamily')
-                for att in sliver['attributes']:
-                    if att['tagname'] == 'vref':
-                        att['value'] = slicefamily
-                        continue
-                sliver['attributes'].append(
-                    {'tagname': 'vref', 'value': slicefamily})
+                vrefs = tags.get_attributes(sliver['name'], 'vref')
+                for att in vrefs:
+                    att['value'] = slicefamily
+                if not vrefs:
+                    att = {'tagname': 'vref', 'value': slicefamily}
+                    sliver['attributes'].append(att)
+                    tags.add_attribute(sliver['name'], att)
             except Exception:
                 logger.log_exc(
                     "nodemanager: Could not overwrite 'vref' attribute from 'GetSliceFamily'",
@@ -187,7 +268,7 @@ class NodeManager:
         with open(NodeManager.DB_FILE, "wb") as feed:
             logger.log ("nodemanager: saving successfully fetched GetSlivers in {}"
                         .format(NodeManager.DB_FILE))
-            pickle.dump(slivers, feed)
+            pickle.dump(without_index(slivers), feed)
 
 
     def loadSlivers (self):
@@ -202,6 +283,40 @@ class NodeManager:
                        .format(NodeManager.DB_FILE))
             return {}
 
+    def log_startup_times(self, startup_times, total):
+        """
+        Report how long each module took to import and to start, slowest first
+        """
+        logger.log("nodemanager: loaded {} modules in {:.2f} s"
+                   .format(len(startup_times), total))
+        for name, (import_time, start_time) in sorted(
+                startup_times.items(), key=lambda item: -sum(item[1])):
+            logger.log("nodemanager: {} - import {:.3f} s - start {:.3f} s"
+                       .format(name, import_time, start_time))
+
+
+    def dry_run(self, config):
+        """print the plan that the next sync would apply to the slivers"""
+        if os.path.exists(self.options.session):
+            with open(self.options.session) as feed:
+                session = feed.read().strip()
+        else:
+            session = None
+        plc = PLCAPI(config.plc_api_uri, config.cacert, session,
+                     transport=self.options.transport)
+        try:
+            data = plc.GetSlivers()
+            self.getPLCDefaults(data, config)
+            self.setSliversVref(data)
+        except:
+            logger.log_exc("nodemanager: dry run could not GetSlivers - using the last dump")
+            data = self.loadSlivers()
+        import slivermanager
+        plan = slivermanager.dry_run(data)
+        for action in plan.work():
+            print(action)
+        print("{} slivers - {}".format(len(plan), plan.summary() or "nothing to do"))
+
     def run(self):
         # make sure to create /etc/planetlab/virt so others can read that
         # used e.g. in vsys-scripts's sliceip
@@ -218,6 +333,10 @@ class NodeManager:
             # Load /etc/planetlab/plc_config
             config = Config(self.options.config)
 
+            if self.options.dry_run:
+                self.dry_run(config)
+                return
+
             try:
                 other_pid = tools.pid_file()
                 if other_pid is not None:
@@ -228,16 +347,25 @@ If this is not the case, please remove the pid file {}. -- exiting"""
             except OSError as err:
                 print("Warning while writing PID file:", err)
 
+            account.configure_pool(self.options.sliver_workers,
+                                   self.options.max_creates, self.options.max_starts)
+
             # load modules
             self.loaded_modules = []
+            # module name -> (import time, start time)
+            startup_times = {}
+            startup_beg = time.time()
             for module in self.modules:
                 try:
+                    import_beg = time.time()
                     m = __import__(module)
+                    start_beg = time.time()
                     logger.verbose("nodemanager: triggering {}.start".format(m.__name__))
                     try:
                         m.start()
                     except Exception:
                         logger.log("WARNING: module {} did not start".format(m.__name__))
+                    startup_times[module] = (start_beg - import_beg, time.time() - start_beg)
                     self.loaded_modules.append(m)
                 except Exception:
                     if module not in NodeManager.core_modules:
@@ -247,17 +375,22 @@ If this is not the case, please remove the pid file {}. -- exiting"""
                         logger.log("FATAL : failed to start core module {}".format(module))
                         sys.exit(1)
 
-            # sort on priority (lower first)
-            def module_priority(module):
-                return getattr(module, 'priority', NodeManager.default_priority)
-            self.loaded_modules.sort(key=module_priority)
+            self.log_startup_times(startup_times, time.time() - startup_beg)
+
+            # sort on priority (lower first), and figure dependencies
+            self.scheduler = ModuleScheduler(self.loaded_modules,
+                                             NodeManager.default_priority,
+                                             self.options.jobs)
+            self.loaded_modules = self.scheduler.ordered()
 
-            logger.log('ordered modules:')
+            logger.log('ordered modules (running up to {} at a time):'
+                       .format(self.scheduler.max_workers))
             for module in self.loaded_modules:
-                logger.log('{}: {}'
-                           .format(getattr(module, 'priority',
-                                           NodeManager.default_priority),
-                                   module.__name__))
+                logger.log('{}: {} - after {}'
+                           .format(self.scheduler.priority(module),
+                                   module.__name__,
+                                   ", ".join(sorted(self.scheduler.deps[module.__name__]))
+                                   or "nothing"))
 
             # Load /etc/planetlab/session
             if os.path.exists(self.options.session):
@@ -272,7 +405,8 @@ If this is not the case, please remove the pid file {}. -- exiting"""
             irandom = int(self.options.random)
 
             # Initialize XML-RPC client
-            plc = PLCAPI(config.plc_api_uri, config.cacert, session, timeout=iperiod/2)
+            plc = PLCAPI(config.plc_api_uri, config.cacert, session, timeout=iperiod/2,
+                         transport=self.options.transport, pool_size=self.options.pool_size)
 
             #check auth
             logger.log("nodemanager: Checking Auth.")
@@ -298,7 +432,13 @@ If this is not the case, please remove the pid file {}. -- exiting"""
                 work_duration = int(work_end-work_beg)
                 logger.log('nodemanager: mainloop has worked for {} s - sleeping for {} s'
                            .format(work_duration, delay))
-                time.sleep(delay)
+                if self.options.hints:
+                    reasons = trigger.trigger.wait(delay)
+                    if reasons:
+                        logger.log('nodemanager: woken up early by {} hint(s): {}'
+                                   .format(len(reasons), ", ".join(sorted(set(reasons)))))
+                else:
+                    time.sleep(delay)
         except SystemExit:
             pass
         except:
@@ -110,21 +110,37 @@ rm -rf $RPM_BUILD_ROOT
 %{_datadir}/NodeManager/api.*
 %{_datadir}/NodeManager/api_calls.*
 %{_datadir}/NodeManager/bwmon.*
+%{_datadir}/NodeManager/bwsim.*
+%{_datadir}/NodeManager/bwstate.*
+%{_datadir}/NodeManager/capengine.*
 %{_datadir}/NodeManager/conf_files.*
 %{_datadir}/NodeManager/config.*
 %{_datadir}/NodeManager/controller.*
 %{_datadir}/NodeManager/curlwrapper.*
 %{_datadir}/NodeManager/database.*
+%{_datadir}/NodeManager/delta.*
+%{_datadir}/NodeManager/expiry.*
 %{_datadir}/NodeManager/initscript.*
 %{_datadir}/NodeManager/iptables.*
+%{_datadir}/NodeManager/journal.*
 %{_datadir}/NodeManager/logger.*
+%{_datadir}/NodeManager/mailqueue.*
 %{_datadir}/NodeManager/net.*
 %{_datadir}/NodeManager/nodemanager.*
+%{_datadir}/NodeManager/planner.*
 %{_datadir}/NodeManager/plcapi.*
+%{_datadir}/NodeManager/pwcache.*
+%{_datadir}/NodeManager/restarter.*
 %{_datadir}/NodeManager/safexmlrpc.*
+%{_datadir}/NodeManager/scheduler.*
 %{_datadir}/NodeManager/slivermanager.*
+%{_datadir}/NodeManager/tagindex.*
+%{_datadir}/NodeManager/tcbackend.*
 %{_datadir}/NodeManager/ticket.*
+%{_datadir}/NodeManager/timeseries.*
 %{_datadir}/NodeManager/tools.*
+%{_datadir}/NodeManager/topology.*
+%{_datadir}/NodeManager/trigger.*
 %{_datadir}/NodeManager/plugins/__init__.*
 %{_datadir}/NodeManager/plugins/hostmap.*
 %{_datadir}/NodeManager/plugins/interfaces.*
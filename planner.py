@@ -0,0 +1,208 @@
+"""
+Reconciliation planner for the slivers.
+
+Database.sync used to walk the records and, for each of them, probe
+the system (getpwnam, is_running, the slicefamily stamp) right before
+acting. The planner instead
+  (*) observes the system in one bulk pass: one scan of the password
+      database, one listing of the running domains per account class,
+      one sweep of the /vservers directory;
+  (*) diffs that against the desired state, i.e. a database snapshot;
+  (*) and emits a Plan, a list of Actions:
+        create    : the account does not exist, or has the wrong class;
+                    the sliver then gets started, unless it is on a
+                    reservable node without the lease
+        start     : the sliver is not running, or needs a reimage
+        configure : the sliver runs fine, refresh its keys and rspec
+        destroy   : the account is no longer in the database
+        noop      : nothing to do, e.g. a delegated sliver not started yet
+The plan is then applied by the account workers, see Worker.apply().
+"""
+
+import os
+
+import logger
+import account
+import pwcache
+
+VSERVERS_DIR = '/vservers'
+
+KINDS = ['create', 'start', 'configure', 'destroy', 'noop']
+
+
+class Observed:
+    """What the system looks like, as of observe()"""
+
+    def __init__(self):
+        # name -> account class, for the accounts with a known shell
+        self.accounts = {}
+        # account class -> set of names of the running slivers, or None if unknown
+        self.running = {}
+        # name -> contents of its slicefamily stamp
+        self.slicefamily = {}
+
+    def is_running(self, name, acct_class):
+        running = self.running.get(acct_class)
+        if running is not None:
+            return name in running
+        # no bulk probe for that class; ask the worker
+        return account.get(name).is_running()
+
+    def needs_reimage(self, name, target_slicefamily):
+        # a missing stamp means we cannot tell, so it is left as-is
+        slicefamily = self.slicefamily.get(name)
+        return slicefamily is not None and slicefamily != target_slicefamily
+
+
+def observe():
+    """Gather the current state of the slivers in one pass"""
+    observed = Observed()
+    for pw_ent in pwcache.getpwall():
+        acct_class = account.shell_acct_class.get(pw_ent[6])
+        if acct_class is not None:
+            observed.accounts[pw_ent[0]] = acct_class
+
+    for acct_class in set(account.shell_acct_class.values()):
+        try:
+            observed.running[acct_class] = acct_class.running_names(observed.accounts)
+        except:
+            logger.log_exc("planner: could not list running slivers of class {}"
+                           .format(acct_class.__name__))
+            observed.running[acct_class] = None
+
+    try:
+        entries = list(os.scandir(VSERVERS_DIR))
+    except OSError:
+        entries = []
+    for entry in entries:
+        if entry.name not in observed.accounts:
+            continue
+        try:
+            with open(os.path.join(entry.path, 'etc', 'slicefamily')) as f:
+                observed.slicefamily[entry.name] = f.read().strip()
+        except IOError:
+            pass
+    return observed
+
+
+class Action:
+
+    def __init__(self, kind, name, rec=None, reason='', start=None):
+        self.kind = kind
+        self.name = name
+        self.rec = rec
+        self.reason = reason
+        # whether the sliver gets started, or only configured, once the account is there
+        self.start = kind in ('create', 'start') if start is None else start
+
+    def __repr__(self):
+        return "{:<9} {} - {}".format(self.kind, self.name, self.reason)
+
+
+class Plan(list):
+    """A list of Actions"""
+
+    def counts(self):
+        counts = {kind: 0 for kind in KINDS}
+        for action in self:
+            counts[action.kind] += 1
+        return counts
+
+    def summary(self):
+        return ", ".join("{} {}".format(kind, count)
+                         for (kind, count) in self.counts().items() if count)
+
+    def work(self):
+        """the actions that do change something"""
+        return [action for action in self if action.kind != 'noop']
+
+
+def _decide(name, rec, observed):
+    curr_class = observed.accounts.get(name)
+    next_class = account.type_acct_class[rec['type']]
+    if next_class != curr_class:
+        reason = "no account" if curr_class is None \
+            else "{} -> {}".format(curr_class.__name__, next_class.__name__)
+        # on reservable nodes, only the sliver that has the lease may run
+        if 'reservation_alive' in rec and not rec['reservation_alive']:
+            return Action('create', name, rec, reason + ", no lease", start=False)
+        return Action('create', name, rec, reason)
+
+    running = observed.is_running(name, curr_class)
+    # reservation_alive is set on reservable nodes, and its value is a boolean
+    if 'reservation_alive' in rec:
+        if rec['reservation_alive'] and not running:
+            return Action('start', name, rec, "has the lease")
+        return Action('configure', name, rec,
+                      "has the lease" if rec['reservation_alive'] else "no lease")
+    if not running:
+        return Action('start', name, rec, "not running")
+    if observed.needs_reimage(name, rec['vref']):
+        return Action('start', name, rec, "needs reimage to {}".format(rec['vref']))
+    return Action('configure', name, rec, "running")
+
+
+def make_plan(snapshot, observed):
+    """The Plan that brings the system to what snapshot describes"""
+    plan = Plan()
+    for name in sorted(observed.accounts):
+        if name not in snapshot:
+            plan.append(Action('destroy', name, reason="not in the database"))
+    for name in sorted(snapshot):
+        rec = snapshot[name]
+        # protect this; if anything fails for a given sliver
+        # we still need the other ones to be handled
+        try:
+            instantiation = rec['instantiation']
+            if instantiation in ('plc-instantiated', 'nm-controller'):
+                plan.append(_decide(name, rec, observed))
+            # Back door to ensure PLC overrides Ticket in delegation:
+            # once the nm-controller started the slice, keep it up to date
+            elif instantiation == 'delegated':
+                curr_class = observed.accounts.get(name)
+                if curr_class is not None and observed.is_running(name, curr_class):
+                    plan.append(_decide(name, rec, observed))
+                else:
+                    plan.append(Action('noop', name, rec, "delegated, not started"))
+            else:
+                plan.append(Action('noop', name, rec, "instantiation {}".format(instantiation)))
+        except:
+            logger.log_exc("planner: could not plan sliver", name=name)
+    return plan
+
+
+# a little self-test, with made-up account classes and observations
+if __name__ == '__main__':
+    class Sliver(account.Account):
+        SHELL = '/bin/sliver'
+        TYPE = 'sliver.Test'
+    class Other(account.Account):
+        SHELL = '/bin/other'
+        TYPE = 'sliver.Other'
+    account.register_class(Sliver)
+    account.register_class(Other)
+    observed = Observed()
+    observed.accounts = {'up': Sliver, 'down': Sliver, 'old': Sliver,
+                         'moved': Other, 'gone': Sliver, 'deleg': Sliver}
+    observed.running = {Sliver: {'up', 'old', 'deleg'}, Other: set()}
+    observed.slicefamily = {'old': 'f8', 'up': 'f12'}
+    def rec(name, instantiation='plc-instantiated', **kwds):
+        return dict(name=name, type='sliver.Test', vref='f12',
+                    instantiation=instantiation, **kwds)
+    snapshot = {name: rec(name) for name in ['up', 'down', 'old', 'moved', 'new']}
+    snapshot['deleg'] = rec('deleg', 'delegated')
+    snapshot['pending'] = rec('pending', 'delegated')
+    snapshot['leased'] = rec('leased', reservation_alive=True)
+    snapshot['unleased'] = rec('unleased', reservation_alive=False)
+    plan = make_plan(snapshot, observed)
+    kinds = {action.name: action.kind for action in plan}
+    assert kinds == {'gone': 'destroy', 'up': 'configure', 'down': 'start', 'old': 'start',
+                     'moved': 'create', 'new': 'create', 'deleg': 'configure',
+                     'pending': 'noop', 'leased': 'create', 'unleased': 'create'}, kinds
+    assert plan.counts()['create'] == 4
+    starts = {action.name: action.start for action in plan if action.kind == 'create'}
+    assert starts == {'moved': True, 'new': True, 'leased': True, 'unleased': False}, starts
+    for action in plan:
+        print(action)
+    print(plan.summary())
+    print("planner: OK")
@@ -1,5 +1,6 @@
 import safexmlrpc
 import hmac
+import xmlrpc.client
 try:
     from hashlib import sha1 as sha
 except ImportError:
@@ -20,10 +21,12 @@ class PLCAPI:
     the new session-based method, respectively.
     """
 
-    def __init__(self, uri, cacert, auth, timeout = 90, **kwds):
+    def __init__(self, uri, cacert, auth, timeout = 90, transport = 'curl', pool_size = 4, **kwds):
         self.uri = uri
         self.cacert = cacert
         self.timeout = timeout
+        self.transport = transport
+        self.pool_size = pool_size
 
         if isinstance(auth, (tuple, list)):
             (self.node_id, self.key) = auth
@@ -34,7 +37,9 @@ class PLCAPI:
         else:
             self.node_id = self.key = self.session = None
 
-        self.server = safexmlrpc.ServerProxy(self.uri, self.cacert, self.timeout, allow_none = 1, **kwds)
+        self.server = safexmlrpc.ServerProxy(self.uri, self.cacert, self.timeout,
+                                             transport = transport, pool_size = pool_size,
+                                             allow_none = 1, **kwds)
 
 
     def update_session(self, f="/usr/boot/plnode.txt"):
@@ -46,7 +51,7 @@ class PLCAPI:
                 return None
 
         auth = (int(plnode("NODE_ID")), plnode("NODE_KEY"))
-        plc = PLCAPI(self.uri, self.cacert, auth, self.timeout)
+        plc = PLCAPI(self.uri, self.cacert, auth, self.timeout, self.transport, self.pool_size)
         open("/etc/planetlab/session", 'w').write(plc.GetSession().strip())
         self.session = open("/etc/planetlab/session").read().strip()
 
@@ -61,10 +66,9 @@ class PLCAPI:
         return authstatus
 
 
-    def add_auth(self, function):
+    def auth(self, params):
         """
-        Returns a wrapper which adds an Auth struct as the first
-        argument when the function is called.
+        Returns the Auth struct to pass along with these parameters.
         """
 
         def canonicalize(args):
@@ -92,37 +96,272 @@ class PLCAPI:
 
             return values
 
+        if self.session is not None:
+            # Use session authentication
+            return {'AuthMethod': "session",
+                    'session': self.session}
+
+        # Yes, this is the "canonicalization" method used.
+        args = canonicalize(params)
+        args.sort()
+        msg = "[" + "".join(args) + "]"
+
+        # We encode in UTF-8 before calculating the HMAC, which is
+        # an 8-bit algorithm.
+        digest = hmac.new(self.key, msg.encode('utf-8'), sha).hexdigest()
+
+        return {'AuthMethod': "hmac",
+                'node_id': self.node_id,
+                'value': digest}
+
+    def add_auth(self, function):
+        """
+        Returns a wrapper which adds an Auth struct as the first
+        argument when the function is called.
+        """
+
         def wrapper(*params):
             """
             Adds an Auth struct as the first argument when the
             function is called.
             """
 
-            if self.session is not None:
-                # Use session authentication
-                auth = {'AuthMethod': "session",
-                        'session': self.session}
-            else:
-                # Yes, this is the "canonicalization" method used.
-                args = canonicalize(params)
-                args.sort()
-                msg = "[" + "".join(args) + "]"
-
-                # We encode in UTF-8 before calculating the HMAC, which is
-                # an 8-bit algorithm.
-                digest = hmac.new(self.key, msg.encode('utf-8'), sha).hexdigest()
-
-                auth = {'AuthMethod': "hmac",
-                        'node_id': self.node_id,
-                        'value': digest}
-
             # Automagically add auth struct to every call
-            params = (auth,) + params
+            params = (self.auth(params),) + params
 
             return function(*params)
 
         return wrapper
 
+    def batch(self):
+        """
+        Returns a Batch for queueing calls, typically used as
+
+        with plc.batch() as batch:
+            futures = [ batch.GetSliceTags(...) for ... ]
+        for future in futures:
+            tags = future.result()
+        """
+        return Batch(self)
+
     def __getattr__(self, methodname):
         function = getattr(self.server, methodname)
         return self.add_auth(function)
+
+
+class Future:
+    """
+    The eventual outcome of a call queued in a Batch.
+    """
+
+    def __init__(self, methodname, params):
+        self.methodname = methodname
+        self.params = params
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done = True
+
+    def set_error(self, error):
+        self.error = error
+        self.done = True
+
+    def result(self):
+        """returns the value, or raises the exception, of the call"""
+        if not self.done:
+            raise RuntimeError("plcapi: %s has not been sent yet" % self.methodname)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Batch:
+    """
+    Queues calls to PLCAPI, and sends them all at once on flush(),
+    or when leaving the 'with' block.
+
+    Get* calls that only differ by the values in their filter
+    (e.g. one GetInterfaceTags per interface) are merged into a single
+    call that filters on the lists of values; the rows that come back
+    are then dispatched to each caller.
+    Other calls are grouped into system.multicall requests, where each
+    call still gets its own Auth struct.
+    """
+
+    # the calls that can be merged, as long as the rows they return
+    # have the fields used in the filter
+    COALESCE = ['GetInterfaceTags', 'GetSliceTags', 'GetNodeTags',
+                'GetInterfaces', 'GetNodes', 'GetSlices']
+    # keep requests to a reasonable size
+    MAX_MULTICALL = 100
+
+    def __init__(self, plc):
+        self.plc = plc
+        self.futures = []
+
+    def __getattr__(self, methodname):
+        if methodname.startswith('_'):
+            raise AttributeError(methodname)
+        return lambda *params: self.queue(methodname, *params)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def queue(self, methodname, *params):
+        future = Future(methodname, params)
+        self.futures.append(future)
+        return future
+
+    def flush(self):
+        """sends the queued calls; each future then holds its outcome"""
+        (futures, self.futures) = (self.futures, [])
+        groups = {}
+        others = []
+        for future in futures:
+            key = self._coalesce_key(future)
+            if key is None:
+                others.append(future)
+            else:
+                groups.setdefault(key, []).append(future)
+        for key, group in groups.items():
+            if len(group) == 1:
+                others += group
+            else:
+                self._coalesce(group)
+        for i in range(0, len(others), self.MAX_MULTICALL):
+            self._multicall(others[i:i + self.MAX_MULTICALL])
+        logger.verbose("plcapi: batch of %d call(s) sent as %d merged and %d other call(s)"
+                       % (len(futures), len(groups), len(others)))
+
+    def _coalesce_key(self, future):
+        """what calls must have in common to be merged, or None"""
+        if future.methodname not in self.COALESCE or len(future.params) not in (1, 2):
+            return None
+        filter = future.params[0]
+        if not isinstance(filter, dict) or not filter:
+            return None
+        for (field, value) in filter.items():
+            # no operators like '~field' or '-SORT'
+            if not field.isidentifier():
+                return None
+            for v in (value if isinstance(value, list) else [value]):
+                if not isinstance(v, (int, str)):
+                    return None
+                # PLCAPI takes these as patterns, but the values of a list as exact ones
+                if isinstance(v, str) and ('*' in v or '%' in v):
+                    return None
+        return_fields = None
+        if len(future.params) == 2:
+            return_fields = future.params[1]
+            if not isinstance(return_fields, list) or not set(filter) <= set(return_fields):
+                return None
+            return_fields = tuple(return_fields)
+        return (future.methodname, tuple(sorted(filter)), return_fields)
+
+    def _coalesce(self, group):
+        def values(value):
+            return set(value) if isinstance(value, list) else {value}
+        wanted = []
+        merged = {}
+        for future in group:
+            filter = {field: values(value) for (field, value) in future.params[0].items()}
+            if not all(filter.values()):
+                # an empty list matches nothing
+                future.set_result([])
+                continue
+            wanted.append((future, filter))
+            for (field, value) in filter.items():
+                merged.setdefault(field, set()).update(value)
+        if not wanted:
+            return
+        params = ({field: sorted(value, key=str) for (field, value) in merged.items()},) \
+                 + tuple(group[0].params[1:])
+        try:
+            rows = getattr(self.plc, group[0].methodname)(*params)
+        except Exception as e:
+            for (future, filter) in wanted:
+                future.set_error(e)
+            return
+        for (future, filter) in wanted:
+            future.set_result([row for row in rows
+                               if all(row.get(field) in value for (field, value) in filter.items())])
+
+    def _multicall(self, futures):
+        if not futures:
+            return
+        if len(futures) == 1:
+            return self._call(futures[0])
+        calls = [{'methodName': future.methodname,
+                  'params': [self.plc.auth(future.params)] + list(future.params)}
+                 for future in futures]
+        try:
+            results = self.plc.server.system.multicall(calls)
+        except xmlrpc.client.Fault:
+            logger.log_exc("plcapi: system.multicall failed, sending calls one by one")
+            for future in futures:
+                self._call(future)
+            return
+        except Exception as e:
+            for future in futures:
+                future.set_error(e)
+            return
+        for (future, result) in zip(futures, results):
+            if isinstance(result, dict):
+                future.set_error(xmlrpc.client.Fault(result.get('faultCode'),
+                                                     result.get('faultString')))
+            else:
+                future.set_result(result[0])
+
+    def _call(self, future):
+        try:
+            future.set_result(getattr(self.plc, future.methodname)(*future.params))
+        except Exception as e:
+            future.set_error(e)
+
+
+# a little self-test, against a fake server
+if __name__ == '__main__':
+    class FakeServer:
+        def __init__(self):
+            self.calls = []
+            self.system = self
+        def GetSliceTags(self, auth, filter):
+            self.calls.append('GetSliceTags')
+            return [{'name': name, 'tagname': 'hmac', 'slice_tag_id': i}
+                    for (i, name) in enumerate(filter['name'])]
+        def multicall(self, calls):
+            self.calls.append('system.multicall')
+            assert all(call['params'][0]['AuthMethod'] == 'session' for call in calls)
+            return [[call['params'][1]] if call['methodName'] == 'UpdateSliceTag'
+                    else [self.GetSliceTags(*call['params'])] if call['methodName'] == 'GetSliceTags'
+                    else {'faultCode': 100, 'faultString': 'nope'} for call in calls]
+    plc = PLCAPI('https://localhost/PLCAPI/', None, 'session')
+    plc.server = FakeServer()
+    with plc.batch() as batch:
+        tags = [batch.GetSliceTags({'name': name, 'tagname': 'hmac'}) for name in ['a', 'b', 'c']]
+        none = batch.GetSliceTags({'name': [], 'tagname': 'hmac'})
+        updates = [batch.UpdateSliceTag(i, 'value') for i in range(3)]
+        failed = batch.AddSliceTag('a', 'hmac', 'value', 1)
+    assert plc.server.calls == ['GetSliceTags', 'system.multicall']
+    assert [future.result()[0]['name'] for future in tags] == ['a', 'b', 'c']
+    assert none.result() == []
+    assert [future.result() for future in updates] == [0, 1, 2]
+    try:
+        failed.result()
+        assert False
+    except xmlrpc.client.Fault:
+        pass
+    # patterns do not get merged into a list of exact values
+    plc.server.calls = []
+    with plc.batch() as batch:
+        tags = [batch.GetSliceTags({'name': [name], 'tagname': 'ipv6*'}) for name in ['a', 'b']]
+    assert plc.server.calls == ['system.multicall', 'GetSliceTags', 'GetSliceTags']
+    assert [future.result()[0]['name'] for future in tags] == ['a', 'b']
+    print("plcapi: OK")
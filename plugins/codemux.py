@@ -16,6 +16,7 @@ import os
 
 from config import Config
 import slivermanager
+from tagindex import get_index
 
 CODEMUXCONF="/etc/codemux/codemux.conf"
 
@@ -49,39 +50,40 @@ def GetSlivers(data, config, plc = None):
     if 'slivers' not in data:
         logger.log_missing_data("codemux.GetSlivers", 'slivers')
         return
-    for sliver in data['slivers']:
-        for attribute in sliver['attributes']:
-            if attribute['tagname'] == 'codemux':
-                # add to conf.  Attribute is [host, port]
-                parts = attribute['value'].split(",")
-                if len(parts) < 2:
-                    logger.log("codemux: attribute value (%s) for codemux not separated by comma. Skipping."
-                               %attribute['value'])
-                    continue
-                if len(parts) == 3:
-                    ip = parts[2]
-                else:
-                    ip = ""
-                params = {'host': parts[0], 'port': parts[1], 'ip': ip}
-
-                try:
-                    # Check to see if sliver is running.  If not, continue
-                    if slivermanager.is_running(sliver['name']):
-                        # Check if new or needs updating
-                        if (sliver['name'] not in list(slicesinconf.keys())) \
-                        or (params not in slicesinconf.get(sliver['name'], [])):
-                            logger.log("codemux:  Updating slice %s using %s" % \
-                                (sliver['name'], params['host']))
-                            #  Toggle write.
-                            _writeconf = True
-                        # Add to dict of codemuxslices.  Make list to support more than one
-                        # codemuxed host per slice.
-                        codemuxslices.setdefault(sliver['name'], [])
-                        codemuxslices[sliver['name']].append(params)
-                except:
-                    logger.log("codemux:  sliver %s not running yet.  Deferring."
-                                % sliver['name'])
-                    pass
+    tags = get_index(data)
+    for name in tags.slivers_with('codemux'):
+        sliver = tags.sliver(name)
+        for value in tags.get_all(name, 'codemux'):
+            # add to conf.  Attribute is [host, port]
+            parts = value.split(",")
+            if len(parts) < 2:
+                logger.log("codemux: attribute value (%s) for codemux not separated by comma. Skipping."
+                           %value)
+                continue
+            if len(parts) == 3:
+                ip = parts[2]
+            else:
+                ip = ""
+            params = {'host': parts[0], 'port': parts[1], 'ip': ip}
+
+            try:
+                # Check to see if sliver is running.  If not, continue
+                if slivermanager.is_running(sliver['name']):
+                    # Check if new or needs updating
+                    if (sliver['name'] not in list(slicesinconf.keys())) \
+                    or (params not in slicesinconf.get(sliver['name'], [])):
+                        logger.log("codemux:  Updating slice %s using %s" % \
+                            (sliver['name'], params['host']))
+                        #  Toggle write.
+                        _writeconf = True
+                    # Add to dict of codemuxslices.  Make list to support more than one
+                    # codemuxed host per slice.
+                    codemuxslices.setdefault(sliver['name'], [])
+                    codemuxslices[sliver['name']].append(params)
+            except:
+                logger.log("codemux:  sliver %s not running yet.  Deferring."
+                            % sliver['name'])
+                pass
 
     # Remove slices from conf that no longer have the attribute
     for deadslice in set(slicesinconf.keys()) - set(codemuxslices.keys()):
@@ -7,6 +7,7 @@ import shutil
 
 import logger
 import tools
+from tagindex import get_index
 
 
 drl = """<?xml version="1.0" encoding="UTF-8"?>
@@ -70,13 +71,11 @@ def GetSlivers(data, conf = None, plc = None):
         logger.log_missing_data("drl.GetSlivers", 'slivers')
         return
 
-    for sliver in data['slivers']:
-        for attribute in sliver['attributes']:
-            tag = attribute['tagname']
-            value = attribute['value']
-            if tag == 'drl' and value == '1':
-                HAVE_DRL = 1
-                DRL_SLICE_NAME = sliver['name']
+    tags = get_index(data)
+    for name in tags.slivers_with('drl'):
+        if '1' in tags.get_all(name, 'drl'):
+            HAVE_DRL = 1
+            DRL_SLICE_NAME = name
 
     if HAVE_DRL:
         site_id = plc.GetNodes({'node_id': int(node_id) }, ['site_id'])
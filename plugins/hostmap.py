@@ -3,6 +3,8 @@ Update /etc/hosts in slivers to contain the contents of the sliver_hostmap tag.
 """
 
 import logger
+import delta
+from tagindex import get_index
 import os
 import curlwrapper
 import re
@@ -21,6 +23,9 @@ def checksum(path):
     except IOError: 
         return None
 
+# /etc/hosts only needs a refresh for the slivers that have changed
+incremental = True
+
 def start():
     logger.log("interfaces: plugin starting up...")
 
@@ -40,54 +45,54 @@ def GetSlivers(data, config=None, plc=None):
 
     hostname_filter = ".".join(hostname.split(".")[1:])
 
-    for sliver in data['slivers']:
-        slicename = sliver['name']
-        for tag in sliver['attributes']:
-            if tag['tagname'] == 'slice_hostmap':
-                fn = "/vservers/%s/etc/hosts" % slicename
-                if not os.path.exists(fn):
-                    continue
+    tags = get_index(data)
+    for slicename in tags.slivers_with('slice_hostmap'):
+        for value in tags.get_all(slicename, 'slice_hostmap'):
+            fn = "/vservers/%s/etc/hosts" % slicename
+            if not os.path.exists(fn):
+                delta.retry(data, slicename)
+                continue
 
-                with open(fn) as f:
-                    contents = f.read()
+            with open(fn) as f:
+                contents = f.read()
 
-                hostmap = []
-                for index, entry in enumerate(tag["value"].split("\n")):
-                    parts = entry.split(" ")
-                    if len(parts)==2:
-                       line = "%s pvt.%s private%d" % (parts[0], parts[1], index)
+            hostmap = []
+            for index, entry in enumerate(value.split("\n")):
+                parts = entry.split(" ")
+                if len(parts)==2:
+                   line = "%s pvt.%s private%d" % (parts[0], parts[1], index)
 
-                       if (parts[0].startswith("10.")) and (hostname_filter not in parts[1]):
-                           continue
+                   if (parts[0].startswith("10.")) and (hostname_filter not in parts[1]):
+                       continue
 
-                       if (index==0):
-                           line = line + " headnode"
+                   if (index==0):
+                       line = line + " headnode"
 
-                       if parts[1] == hostname:
-                           line = line + " pvt.self"
+                   if parts[1] == hostname:
+                       line = line + " pvt.self"
 
-                       hostmap.append(line)
+                   hostmap.append(line)
 
-                hostmap = "\n".join(hostmap)
-                hostmap = PREFIX + "\n" + hostmap + "\n" + SUFFIX + "\n"
+            hostmap = "\n".join(hostmap)
+            hostmap = PREFIX + "\n" + hostmap + "\n" + SUFFIX + "\n"
 
-                if (hostmap in contents):
-                    # it's already there
-                    continue
+            if (hostmap in contents):
+                # it's already there
+                continue
 
-                # remove anything between PREFIX and SUFFIX from contents
+            # remove anything between PREFIX and SUFFIX from contents
 
-                pattern = PREFIX + ".*" + SUFFIX + "\n"
-                regex = re.compile(pattern, re.DOTALL)
-                if regex.search(contents) != None:
-                    contents = regex.sub(hostmap, contents)
-                else:
-                    contents = contents + hostmap
+            pattern = PREFIX + ".*" + SUFFIX + "\n"
+            regex = re.compile(pattern, re.DOTALL)
+            if regex.search(contents) != None:
+                contents = regex.sub(hostmap, contents)
+            else:
+                contents = contents + hostmap
 
-                try:
-                    with open(fn, "w") as f:
-                        f.write(contents)
-                except:
-                    logger.log_exc("hostmap (%s): failed to write %s" % (slicename, fn))
+            try:
+                with open(fn, "w") as f:
+                    f.write(contents)
+            except:
+                logger.log_exc("hostmap (%s): failed to write %s" % (slicename, fn))
 
 
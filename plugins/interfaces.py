@@ -3,6 +3,7 @@ Configure interfaces inside a container by pulling down files via URL.
 """
 
 import logger
+import delta
 import os
 import curlwrapper
 import xmlrpc.client
@@ -20,6 +21,9 @@ def checksum(path):
     except IOError: 
         return None
 
+# only look at slivers that were added or changed - see delta.py
+incremental = True
+
 def start():
     logger.log("interfaces: plugin starting up...")
 
@@ -37,6 +41,7 @@ def GetSlivers(data, config=None, plc=None):
             # breaks slice creation when sliver_lxc eventually gets around
             # to creating the sliver.
             logger.log("vserver %s does not exist yet. Skipping interfaces." % slicename)
+            delta.retry(data, slicename)
             continue
 
         for tag in sliver['attributes']:
@@ -57,6 +62,7 @@ def GetSlivers(data, config=None, plc=None):
                             contents = curlwrapper.retrieve(url)
                         except xmlrpc.client.ProtocolError as e:
                             logger.log('interfaces (%s): failed to retrieve %s' % (slicename, url))
+                            delta.retry(data, slicename)
                             continue
                     else:
                         # Otherwise generate /etc/sysconfig/network-scripts/ifcfg-<device>
@@ -36,6 +36,7 @@ except:
     logger.log("Could not import 'sliver_lxc' or 'libvirt'.")
 
 priority=4
+after = ['net']
 
 radvd_conf_file = '/etc/radvd.conf'
 sliversipv6prefixtag = 'sliversipv6prefix'
@@ -228,12 +229,16 @@ def GetSlivers(data, config, plc):
 
     interfaces = data['interfaces']
     logger.log(repr(interfaces))
-    for interface in interfaces:
+    # one round trip for the tags of all interfaces
+    lookups = {}
+    with plc.batch() as batch:
+        for (i, interface) in enumerate(interfaces):
+            if 'interface_tag_ids' in interface:
+                lookups[i] = batch.GetInterfaceTags({'interface_tag_id': interface['interface_tag_ids']})
+    for (i, interface) in enumerate(interfaces):
         #logger.log('ipv6: get interface: %r'%(interface))
         if 'interface_tag_ids' in interface:
-            interface_tag_ids = "interface_tag_ids"
-            interface_tag_id = "interface_tag_id"
-            settings = plc.GetInterfaceTags({interface_tag_id:interface[interface_tag_ids]})
+            settings = lookups[i].result()
             is_slivers_ipv6_prefix_set = False
             for setting in settings:
                 if setting['tagname']==sliversipv6prefixtag:
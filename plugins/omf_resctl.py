@@ -12,9 +12,13 @@ import subprocess
 
 import tools
 import logger
+import delta
+from tagindex import get_index
 
 # we need this to run after sliverauth
 priority = 150
+after = ['sliverauth']
+incremental = True
 
 def start():
     pass
@@ -82,14 +86,10 @@ def GetSlivers(data, conf = None, plc = None):
 
     hostname = data['hostname']
 
-    def is_omf_friendly (sliver):
-        for chunk in sliver['attributes']:
-            if chunk['tagname']=='omf_control': return True
-
-    for sliver in data['slivers']:
-        # skip non OMF-friendly slices
-        if not is_omf_friendly (sliver): continue
-        slicename=sliver['name']
+    # only OMF-friendly slices
+    tags = get_index(data)
+    for slicename in tags.slivers_with('omf_control'):
+        sliver = tags.sliver(slicename)
         expires=str(sliver['expires'])
         yaml_template = config_ple_template
         yaml_contents = yaml_template\
@@ -133,5 +133,6 @@ def GetSlivers(data, conf = None, plc = None):
                 traceback.print_exc()
                 logger.log_exc("omf_resctl: WARNING: Could not call trigger script %s"%\
                                    omf_rc_trigger_script, name=slicename)
+                delta.retry(data, slicename)
         else:
             logger.log("omf_resctl: %s: omf_control'ed sliver has no change" % slicename)
@@ -8,8 +8,10 @@ import time
 import tools
 
 import logger
+from tagindex import get_index
 
 priority = 9
+after = ['net']
 
 class OvsException (Exception) :
     def __init__(self, message="no message"):
@@ -178,13 +180,10 @@ def GetSlivers(data, conf = None, plc = None):
         return
 
     valid_bridges = []
-    for sliver in data['slivers']:
-        sliver_name = sliver['name']
-
-        # build a dict of attributes, because it's more convenient
-        attributes = {}
-        for attribute in sliver['attributes']:
-            attributes[attribute['tagname']] = attribute['value']
+    tags = get_index(data)
+    for sliver_name in tags.slivers_with('slice_bridge_name'):
+        sliver = tags.sliver(sliver_name)
+        attributes = tags.as_dict(sliver_name)
 
         bridge_name = attributes.get('slice_bridge_name', None)
         if bridge_name:
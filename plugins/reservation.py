@@ -16,6 +16,7 @@ import database
 
 # there is an implicit assumption that this triggers after slicemanager
 priority = 45
+after = ['slivermanager']
 
 # this instructs nodemanager that we want to use the latest known data in case the plc link is down
 persistent_data = True
@@ -22,6 +22,11 @@ import socket
 
 import logger
 import tools
+import delta
+from tagindex import get_index
+
+# slivers that do not exist yet get passed again until they do
+incremental = True
 
 def start():
     logger.log("sliverauth: (dummy) plugin starting up...")
@@ -36,6 +41,9 @@ def GetSlivers(data, config, plc):
         logger.log_missing_data("sliverauth.GetSlivers", 'slivers')
         return
 
+    tags = get_index(data)
+    # the tags to set in PLC, sent all at once at the end
+    updates = []
     for sliver in data['slivers']:
         path = '/vservers/%s' % sliver['name']
         if not os.path.exists(path):
@@ -43,54 +51,68 @@ def GetSlivers(data, config, plc):
             instantiation = sliver.get('instantiation', '')
             if instantiation == 'plc-instantiated':
                 logger.log("sliverauth: plc-instantiated slice %s does not yet exist. IGNORING!" % sliver['name'])
+                delta.retry(data, sliver['name'])
             continue
 
         system_slice = False
-        for chunk in sliver['attributes']:
-            if chunk['tagname'] == "system":
-                if chunk['value'] in (True, 1, '1') or chunk['value'].lower() == "true":
-                    system_slice = True
+        for value in tags.get_all(sliver['name'], 'system'):
+            if value in (True, 1, '1') or value.lower() == "true":
+                system_slice = True
+
+        if tags.has(sliver['name'], 'enable_hmac') and not system_slice:
+            manage_hmac (sliver, tags, updates)
 
-        for chunk in sliver['attributes']:
-            if chunk['tagname']=='enable_hmac' and not system_slice:
-                manage_hmac (plc, sliver)
+        if tags.has(sliver['name'], 'omf_control'):
+            manage_sshkey (sliver, tags, updates)
 
-            if chunk['tagname']=='omf_control':
-                manage_sshkey (plc, sliver)
+    SetSliverTags(plc, updates)
 
 
-def SetSliverTag(plc, slice, tagname, value):
+def SetSliverTags(plc, updates):
+    """
+    updates is a list of (slicename, tagname, value) tuples;
+    takes two round trips to PLC whatever their number:
+    one to look up the existing tags, one to add or update them
+    """
+    if not updates:
+        return
     node_id = tools.node_id()
-    slivertags=plc.GetSliceTags({"name":slice, "node_id":node_id, "tagname":tagname})
-    if len(slivertags)==0:
-        # looks like GetSlivers reports about delegated/nm-controller slices that do *not* belong to this node
-        # and this is something that AddSliceTag does not like
+    with plc.batch() as batch:
+        lookups = [ batch.GetSliceTags({"name":slice, "node_id":node_id, "tagname":tagname})
+                    for (slice, tagname, value) in updates ]
+    changes = []
+    with plc.batch() as batch:
+        for ((slice, tagname, value), lookup) in zip(updates, lookups):
+            try:
+                slivertags = lookup.result()
+            except:
+                logger.log_exc ("sliverauth.SetSliverTags could not get slice=%(slice)s tag=%(tagname)s"%locals())
+                continue
+            if len(slivertags)==0:
+                # looks like GetSlivers reports about delegated/nm-controller slices that do *not* belong to this node
+                # and this is something that AddSliceTag does not like
+                changes.append( (slice, tagname, True, batch.AddSliceTag(slice, tagname, value, node_id)) )
+            else:
+                slivertag_id=slivertags[0]['slice_tag_id']
+                changes.append( (slice, tagname, False, batch.UpdateSliceTag(slivertag_id, value)) )
+    for (slice, tagname, added, change) in changes:
         try:
-            slivertag_id=plc.AddSliceTag(slice, tagname, value, node_id)
+            change.result()
         except:
-            logger.log_exc ("sliverauth.SetSliverTag (probably delegated) slice=%(slice)s tag=%(tagname)s node_id=%(node_id)d"%locals())
-            pass
-    else:
-        slivertag_id=slivertags[0]['slice_tag_id']
-        plc.UpdateSliceTag(slivertag_id, value)
-
-def find_tag (sliver, tagname):
-    for attribute in sliver['attributes']:
-        # for legacy, try the old-fashioned 'name' as well
-        name = attribute.get('tagname', attribute.get('name', ''))
-        if name == tagname:
-            return attribute['value']
-    return None
-
-def manage_hmac (plc, sliver):
-    hmac = find_tag (sliver, 'hmac')
+            if added:
+                logger.log_exc ("sliverauth.SetSliverTags (probably delegated) slice=%(slice)s tag=%(tagname)s node_id=%(node_id)d"%locals())
+            else:
+                logger.log_exc ("sliverauth.SetSliverTags could not update slice=%(slice)s tag=%(tagname)s"%locals())
+
+def manage_hmac (sliver, tags, updates):
+    hmac = tags.get(sliver['name'], 'hmac')
 
     if not hmac:
         # let python do its thing 
         random.seed()
         d = [random.choice(string.letters) for x in range(32)]
         hmac = "".join(d)
-        SetSliverTag(plc, sliver['name'], 'hmac', hmac)
+        updates.append( (sliver['name'], 'hmac', hmac) )
         logger.log("sliverauth: %s: setting hmac" % sliver['name'])
 
     path = '/vservers/%s/etc/planetlab' % sliver['name']
@@ -122,11 +144,11 @@ def generate_sshkey (sliver):
 
 # a sliver can get created, deleted and re-created
 # the slice having the tag is not sufficient to skip key geneneration
-def manage_sshkey (plc, sliver):
+def manage_sshkey (sliver, tags, updates):
     # regardless of whether the tag is there or not, we need to grab the file
     # if it's lost b/c e.g. the sliver was destroyed we cannot save the tags content
     ssh_key = generate_sshkey(sliver)
-    old_tag = find_tag (sliver, 'ssh_key')
+    old_tag = tags.get(sliver['name'], 'ssh_key')
     if ssh_key != old_tag:
-        SetSliverTag(plc, sliver['name'], 'ssh_key', ssh_key)
+        updates.append( (sliver['name'], 'ssh_key', ssh_key) )
         logger.log ("sliverauth: %s: setting ssh_key" % sliver['name'])
@@ -22,6 +22,9 @@ import tools
 
 # right after conf_files
 priority = 3
+after = ['conf_files']
+# no need to rerun when GetSlivers has not changed
+idempotent = True
 
 def start():
     logger.log("specialaccounts: plugin starting up...")
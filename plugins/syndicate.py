@@ -10,6 +10,7 @@ import tools
 from threading import Thread
 import logger
 import tools
+from tagindex import get_index
 
 def start():
     logger.log('syndicate plugin starting up...')
@@ -74,13 +75,11 @@ def GetSlivers(data, conf = None, plc = None):
         logger.log("Syndicate: unable to get syndicate sliver ip. aborting.")
         return
 
+    tags = get_index(data)
     for sliver in data['slivers']:
         enable_syndicate = False
 
-        # build a dict of attributes, because it's more convenient
-        attributes={}
-        for attribute in sliver['attributes']:
-           attributes[attribute['tagname']] = attribute['value']
+        attributes = tags.as_dict(sliver['name'])
 
         sliver_name = sliver['name']
         syndicate_mountpoint = os.path.join("/vservers", sliver_name, "syndicate")
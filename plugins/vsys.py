@@ -5,6 +5,7 @@ import subprocess
 
 import logger
 import tools
+from tagindex import get_index
 
 VSYSCONF="/etc/vsys.conf"
 VSYSBKEND="/vsys"
@@ -32,15 +33,14 @@ def GetSlivers(data, config=None, plc=None):
     if 'slivers' not in data:
         logger.log_missing_data("vsys.GetSlivers", 'slivers')
         return
-    for sliver in data['slivers']:
-        for attribute in sliver['attributes']:
-            if attribute['tagname'] == 'vsys':
-                if sliver['name'] not in slices:
-                    # add to conf
-                    slices.append(sliver['name'])
-                    _restart = createVsysDir(sliver['name']) or _restart
-                if attribute['value'] in list(scripts.keys()):
-                    scripts[attribute['value']].append(sliver['name'])
+    tags = get_index(data)
+    for name in tags.slivers_with('vsys'):
+        # add to conf
+        slices.append(name)
+        _restart = createVsysDir(name) or _restart
+        for value in tags.get_all(name, 'vsys'):
+            if value in scripts:
+                scripts[value].append(name)
 
     # Write the conf
     _restart = writeConf(slices, parseConf()) or _restart
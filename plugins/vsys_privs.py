@@ -7,8 +7,13 @@ node for the reference of vsys scripts.
 import logger
 import os
 
+from tagindex import get_index
+
 VSYS_PRIV_DIR = "/etc/planetlab/vsys-attributes"
 
+# the files only depend on GetSlivers, skip cycles where it has not changed
+idempotent = True
+
 def start():
     logger.log("vsys_privs: plugin starting")
     if (not os.path.exists(VSYS_PRIV_DIR)):
@@ -28,22 +33,10 @@ def GetSlivers(data, config=None, plc=None):
     if 'slivers' not in data:
         logger.log_missing_data("vsys_privs.GetSlivers", 'slivers')
         return
-    for sliver in data['slivers']:
-        slice = sliver['name']
-        for attribute in sliver['attributes']:
-            tag = attribute['tagname']
-            value = attribute['value']
-            if tag.startswith('vsys_'):
-                if (slice in privs):
-                    slice_priv = privs[slice]
-                    if (tag in slice_priv):
-                        slice_priv[tag].append(value)
-                    else:
-                        slice_priv[tag]=[value]
-
-                    privs[slice] = slice_priv
-                else:
-                    privs[slice] = {tag:[value]}
+    tags = get_index(data)
+    for slice in tags.slivers_with_prefix('vsys_'):
+        privs[slice] = {tag: tags.get_all(slice, tag)
+                        for tag in tags.tagnames(slice) if tag.startswith('vsys_')}
 
     cur_privs = read_privs()
     write_privs(cur_privs, privs)
@@ -4,8 +4,11 @@
 """
 
 import logger
+import delta
 import os
 
+incremental = True
+
 def start():
     logger.log("vsys_sysctl: plugin starting up...")
 
@@ -40,6 +43,7 @@ def GetSlivers(data, config=None, plc=None):
                     result = os.system("lxcsu -r %s :" % slicename)
                     if result != 0:
                         logger.log("vsys_sysctl: failed to lxcsu into %s" % slicename)
+                        delta.retry(data, slicename)
                         continue
 
                     # Store the key name and value inside of /vsys_sysctl in the
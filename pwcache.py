@@ -0,0 +1,120 @@
+"""
+A cache of the password and group databases.
+
+With thousands of slivers, each pwd.getpwall() or getpwnam() call means
+parsing a large /etc/passwd again, and a sync used to do that many times
+over. Here the entries get loaded once, and are reloaded only when the
+(mtime, inode, size) of /etc/passwd or /etc/group changes; an inode
+change catches the rename-into-place that useradd and friends do.
+Code that adds or removes accounts should still call invalidate(),
+since mtime granularity can hide a change made within the same tick.
+
+Entries that come from other NSS sources than the files are cached as
+well, but changes there go unnoticed until the next invalidate().
+
+The functions mimic their pwd/grp counterparts, KeyError included.
+"""
+
+import os
+import pwd
+import grp
+import threading
+
+import logger
+
+PASSWD_FILE = '/etc/passwd'
+GROUP_FILE = '/etc/group'
+
+
+class _Cache:
+
+    def __init__(self, filename, getall):
+        self.filename = filename
+        self.getall = getall
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.entries = []
+        self.by_name = {}
+        self.by_id = {}
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.filename)
+            return (st.st_mtime_ns, st.st_ino, st.st_size)
+        except OSError:
+            return None
+
+    def refresh(self):
+        """reload the entries if the file has changed; returns self"""
+        stamp = self._stamp()
+        with self.lock:
+            if stamp is not None and stamp == self.stamp:
+                return self
+            entries = self.getall()
+            by_name = {}
+            by_id = {}
+            for entry in entries:
+                # like getpwnam/getpwuid, the first one wins
+                by_name.setdefault(entry[0], entry)
+                by_id.setdefault(entry[2], entry)
+            (self.entries, self.by_name, self.by_id) = (entries, by_name, by_id)
+            self.stamp = stamp
+            logger.verbose("pwcache: loaded {} entries from {}"
+                           .format(len(entries), self.filename))
+        return self
+
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+
+
+passwd = _Cache(PASSWD_FILE, pwd.getpwall)
+group = _Cache(GROUP_FILE, grp.getgrall)
+
+
+def getpwall():
+    return list(passwd.refresh().entries)
+
+def getpwnam(name):
+    try:
+        return passwd.refresh().by_name[name]
+    except KeyError:
+        raise KeyError("getpwnam(): name not found: {!r}".format(name))
+
+def getpwuid(uid):
+    try:
+        return passwd.refresh().by_id[uid]
+    except KeyError:
+        raise KeyError("getpwuid(): uid not found: {}".format(uid))
+
+def getgrall():
+    return list(group.refresh().entries)
+
+def getgrnam(name):
+    try:
+        return group.refresh().by_name[name]
+    except KeyError:
+        raise KeyError("getgrnam(): name not found: {!r}".format(name))
+
+def invalidate():
+    """to be called after accounts or groups get added or removed"""
+    passwd.invalidate()
+    group.invalidate()
+
+
+# a little self-test
+if __name__ == '__main__':
+    root = getpwnam('root')
+    assert root.pw_uid == 0 and root == pwd.getpwnam('root')
+    assert getpwuid(0).pw_name == 'root'
+    assert getgrnam(grp.getgrgid(0).gr_name).gr_gid == 0
+    assert passwd.refresh().entries is passwd.refresh().entries, "not reloaded"
+    entries = passwd.entries
+    invalidate()
+    assert passwd.refresh().entries is not entries, "reloaded"
+    try:
+        getpwnam('no-such-user-hopefully')
+        assert False
+    except KeyError:
+        pass
+    print("pwcache: OK")
@@ -0,0 +1,197 @@
+"""
+Restart the slivers that die between two syncs.
+
+A sliver that crashes, or that gets stopped behind nodemanager's back,
+used to stay down until the next GetSlivers cycle noticed it was not
+running. The Restarter listens to the libvirt lifecycle events (see
+sliver_libvirt.add_lifecycle_listener) and schedules a restart as soon as
+a domain goes down without nodemanager having asked for it.
+
+To keep a broken sliver from hogging the node:
+  (*) restarts are delayed with an exponential backoff, from BASE_DELAY
+      up to MAX_DELAY; the delay goes back to BASE_DELAY once a sliver
+      has been up for STABLE seconds;
+  (*) after MAX_RESTARTS restarts within WINDOW seconds, the breaker trips
+      and the sliver is left alone for COOLDOWN seconds.
+The regular reconciliation in database.sync remains the fallback, e.g.
+for slivers whose events were lost, or with the breaker tripped.
+"""
+
+import threading
+import time
+
+import logger
+
+BASE_DELAY = 5
+MAX_DELAY = 300
+MAX_RESTARTS = 5
+WINDOW = 600
+COOLDOWN = 3600
+STABLE = 300
+
+
+def _schedule(delay, function, *args):
+    timer = threading.Timer(delay, function, args=args)
+    timer.daemon = True
+    timer.start()
+
+
+def _wanted(name):
+    """the database record if the sliver should be running, else None"""
+    import database
+    try:
+        rec = database.db.snapshot()[name]
+    except (AttributeError, KeyError):
+        return None
+    if rec.get('instantiation') not in ('plc-instantiated', 'nm-controller'):
+        return None
+    if rec.get('reservation_alive') is False:
+        return None
+    return rec
+
+
+def _running(name):
+    import slivermanager
+    return slivermanager.is_running(name)
+
+
+def _restart(name, rec):
+    import account
+    import planner
+    account.get(name).apply(planner.Action('start', name, rec, "stopped unexpectedly"))
+
+
+class Restarter:
+
+    def __init__(self, clock=time.time, schedule=_schedule,
+                 wanted=_wanted, running=_running, restart=_restart):
+        self.clock = clock
+        self.schedule = schedule
+        self.wanted = wanted
+        self.running = running
+        self.restart = restart
+        self.lock = threading.Lock()
+        # name -> when it was last seen starting
+        self.started = {}
+        # name -> number of restarts in a row, that drives the backoff
+        self.failures = {}
+        # name -> when we restarted it, within the last WINDOW seconds
+        self.history = {}
+        # name -> until when the breaker is tripped
+        self.tripped = {}
+        # names with a restart scheduled
+        self.pending = set()
+        self.restarts = 0
+
+    def on_event(self, uri, name, kind, intentional):
+        """a sliver_libvirt lifecycle listener"""
+        if kind == 'started':
+            with self.lock:
+                self.started[name] = self.clock()
+        elif not intentional:
+            self.crashed(name)
+
+    def crashed(self, name):
+        """schedules a restart for name; returns the delay, or None"""
+        with self.lock:
+            now = self.clock()
+            if name in self.pending:
+                return None
+            if self.tripped.get(name, 0) > now:
+                logger.verbose("restarter: {} is crash-looping, leaving it alone".format(name))
+                return None
+            self.tripped.pop(name, None)
+            started = self.started.pop(name, None)
+            if started is not None and now - started >= STABLE:
+                self.failures.pop(name, None)
+            history = [stamp for stamp in self.history.get(name, []) if now - stamp < WINDOW]
+            if len(history) >= MAX_RESTARTS:
+                self.tripped[name] = now + COOLDOWN
+                self.history.pop(name, None)
+                self.failures.pop(name, None)
+                logger.log("restarter: {} went down {} times within {}s - not restarting it for {}s"
+                           .format(name, len(history) + 1, WINDOW, COOLDOWN))
+                return None
+            failures = self.failures.get(name, 0)
+            delay = min(BASE_DELAY * 2 ** failures, MAX_DELAY)
+            self.failures[name] = failures + 1
+            history.append(now)
+            self.history[name] = history
+            self.pending.add(name)
+        logger.log("restarter: {} went down, restarting it in {}s".format(name, delay))
+        self.schedule(delay, self._fire, name)
+        return delay
+
+    def _fire(self, name):
+        with self.lock:
+            self.pending.discard(name)
+        try:
+            rec = self.wanted(name)
+            if rec is None:
+                logger.verbose("restarter: {} is not wanted anymore".format(name))
+                return
+            if self.running(name):
+                logger.verbose("restarter: {} is already back up".format(name))
+                return
+            self.restarts += 1
+            self.restart(name, rec)
+        except:
+            logger.log_exc("restarter: could not restart sliver", name=name)
+
+
+restarter = Restarter()
+
+
+def start():
+    """have the libvirt lifecycle events feed the restarter"""
+    import sliver_libvirt
+    sliver_libvirt.add_lifecycle_listener(restarter.on_event)
+
+
+# a little self-test, with a fake clock and no actual timer
+if __name__ == '__main__':
+    now = [1000.]
+    scheduled = []
+    restarted = []
+    up = set()
+    r = Restarter(clock=lambda: now[0],
+                  schedule=lambda delay, function, *args: scheduled.append((delay, function, args)),
+                  wanted=lambda name: {'name': name} if name != 'gone' else None,
+                  running=lambda name: name in up,
+                  restart=lambda name, rec: restarted.append(name))
+    def fire():
+        for (delay, function, args) in scheduled:
+            function(*args)
+        del scheduled[:]
+    # stopped on purpose
+    r.on_event('lxc:///', 'a', 'stopped', True)
+    assert scheduled == []
+    # crashed: restarted, with growing delays
+    delays = []
+    for i in range(MAX_RESTARTS):
+        r.on_event('lxc:///', 'a', 'crashed', False)
+        r.on_event('lxc:///', 'a', 'crashed', False)
+        assert len(scheduled) == 1, "deduplicated"
+        delays.append(scheduled[0][0])
+        fire()
+        now[0] += 10
+    assert delays == [5, 10, 20, 40, 80], delays
+    assert restarted == ['a'] * MAX_RESTARTS
+    # breaker
+    assert r.crashed('a') is None and 'a' in r.tripped
+    now[0] += COOLDOWN
+    assert r.crashed('a') == BASE_DELAY
+    fire()
+    # stable for long enough: back to the base delay
+    r.on_event('lxc:///', 'a', 'started', False)
+    now[0] += STABLE
+    r.on_event('lxc:///', 'a', 'stopped', False)
+    assert scheduled[0][0] == BASE_DELAY
+    fire()
+    # not restarted when no longer wanted, or already up
+    up.add('b')
+    r.crashed('b')
+    r.crashed('gone')
+    fire()
+    assert restarted == ['a'] * (MAX_RESTARTS + 2), restarted
+    print("restarter: OK")
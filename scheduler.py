@@ -0,0 +1,224 @@
+"""
+Dependency-aware scheduler for the GetSlivers callbacks of modules/plugins.
+
+Each module may declare
+  (*) a 'priority' attribute (lower comes first), and
+  (*) an 'after' attribute, i.e. a list of module names it depends upon.
+
+A module that declares 'after' only waits for these modules;
+a module that does not waits for all modules with a strictly lower priority,
+which is how the sequential main loop used to order things.
+Modules whose dependencies are satisfied are run concurrently
+on a bounded pool of threads.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import logger
+
+
+class CycleReport:
+    """
+    Timings for one run of the scheduler:
+    wall time per module, overall wall time, and the critical path
+    """
+
+    def __init__(self):
+        # module name -> (start, end)
+        self.timings = {}
+        self.begin = time.time()
+        self.end = self.begin
+        self.critical_path = []
+
+    def duration(self, name):
+        (start, end) = self.timings[name]
+        return end - start
+
+    def log(self):
+        for name, (start, end) in sorted(self.timings.items(),
+                                         key=lambda item: item[1][0]):
+            logger.log("scheduler: {} ran for {:.2f} s (started at +{:.2f} s)"
+                       .format(name, end - start, start - self.begin))
+        path = " -> ".join("{} ({:.2f} s)".format(name, self.duration(name))
+                           for name in self.critical_path)
+        logger.log("scheduler: cycle took {:.2f} s - critical path: {}"
+                   .format(self.end - self.begin, path or "(empty)"))
+
+
+class ModuleScheduler:
+
+    def __init__(self, modules, default_priority, max_workers=1):
+        """
+        modules is the list of loaded module objects, in load order
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.default_priority = default_priority
+        self.modules = list(modules)
+        self.by_name = {module.__name__: module for module in self.modules}
+        self.deps = self._compute_dependencies()
+
+    def priority(self, module):
+        return getattr(module, 'priority', self.default_priority)
+
+    def rank(self, module):
+        """the sequential order: priority first, then load order"""
+        return (self.priority(module), self.modules.index(module))
+
+    def _compute_dependencies(self):
+        deps = {}
+        for module in self.modules:
+            name = module.__name__
+            after = getattr(module, 'after', None)
+            if after is None:
+                deps[name] = {other.__name__ for other in self.modules
+                              if self.priority(other) < self.priority(module)}
+            else:
+                deps[name] = set()
+                for dep in after:
+                    if dep in self.by_name and dep != name:
+                        deps[name].add(dep)
+                    else:
+                        logger.verbose("scheduler: {} depends on {} which is not loaded - ignored"
+                                       .format(name, dep))
+        if self._has_cycle(deps):
+            logger.log("scheduler: WARNING dependency cycle detected in 'after' declarations"
+                       " - falling back to priority order")
+            ordered = sorted(self.modules, key=self.rank)
+            deps = {module.__name__: {other.__name__ for other in ordered[:index]}
+                    for index, module in enumerate(ordered)}
+        return deps
+
+    @staticmethod
+    def _has_cycle(deps):
+        remaining = {name: set(names) for name, names in deps.items()}
+        while remaining:
+            ready = [name for name, names in remaining.items() if not names]
+            if not ready:
+                return True
+            for name in ready:
+                del remaining[name]
+            for names in remaining.values():
+                names.difference_update(ready)
+        return False
+
+    def ordered(self):
+        """the modules sorted in the order they would be run sequentially"""
+        return sorted(self.modules, key=self.rank)
+
+    def run(self, callback):
+        """
+        Invoke callback(module) once for each module, honouring dependencies.
+        callback is expected to deal with its own exceptions; a module
+        whose callback fails still counts as done for its dependents.
+        Returns a CycleReport.
+        """
+        report = CycleReport()
+        lock = threading.Lock()
+
+        def timed(module):
+            start = time.time()
+            try:
+                callback(module)
+            except Exception:
+                logger.log_exc("scheduler: unexpected exception in {}"
+                               .format(module.__name__))
+            finally:
+                with lock:
+                    report.timings[module.__name__] = (start, time.time())
+
+        pending = self.ordered()
+        done = set()
+
+        def ready_modules():
+            return [module for module in pending
+                    if self.deps[module.__name__] <= done]
+
+        if self.max_workers == 1:
+            while pending:
+                module = ready_modules()[0]
+                pending.remove(module)
+                timed(module)
+                done.add(module.__name__)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                running = {}
+                while pending or running:
+                    for module in ready_modules():
+                        pending.remove(module)
+                        running[executor.submit(timed, module)] = module
+                    finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done.add(running.pop(future).__name__)
+
+        report.end = time.time()
+        report.critical_path = self._critical_path(report.timings)
+        return report
+
+    def _critical_path(self, timings):
+        """walk back from the last module to finish, through the dependency that finished last"""
+        if not timings:
+            return []
+        name = max(timings, key=lambda name: timings[name][1])
+        path = [name]
+        while True:
+            deps = [dep for dep in self.deps[name] if dep in timings]
+            if not deps:
+                break
+            name = max(deps, key=lambda dep: timings[dep][1])
+            path.append(name)
+        path.reverse()
+        return path
+
+
+# a little self-test, with fake modules that sleep instead of doing work
+if __name__ == '__main__':
+    import os
+    import types
+
+    logger.LOG_FILE = os.devnull
+
+    def fake(name, priority=None, after=None, duration=0):
+        module = types.ModuleType(name)
+        if priority is not None:
+            module.priority = priority
+        if after is not None:
+            module.after = after
+        module.duration = duration
+        return module
+
+    modules = [fake('late', 9, duration=.01),
+               fake('net', 1, duration=.05),
+               fake('hostmap', 5, after=['net', 'notloaded'], duration=.01),
+               fake('slow', 5, after=['net'], duration=.2),
+               fake('sliverauth', duration=.01)]
+    scheduler = ModuleScheduler(modules, default_priority=5, max_workers=3)
+    assert scheduler.deps['hostmap'] == {'net'}, "unknown modules are ignored"
+    # no 'after': all the modules with a strictly lower priority
+    assert scheduler.deps['sliverauth'] == {'net'}
+    assert scheduler.deps['late'] == {'net', 'hostmap', 'slow', 'sliverauth'}
+    assert [module.__name__ for module in scheduler.ordered()] \
+        == ['net', 'hostmap', 'slow', 'sliverauth', 'late']
+
+    report = scheduler.run(lambda module: time.sleep(module.duration))
+    for (name, deps) in scheduler.deps.items():
+        for dep in deps:
+            assert report.timings[dep][1] <= report.timings[name][0], (dep, name)
+    # hostmap, slow and sliverauth ran side by side
+    assert report.timings['sliverauth'][0] < report.timings['slow'][1]
+    assert report.critical_path == ['net', 'slow', 'late'], report.critical_path
+
+    # one after the other, in priority order
+    started = []
+    ModuleScheduler(modules, default_priority=5).run(lambda module: started.append(module.__name__))
+    assert started == ['net', 'hostmap', 'slow', 'sliverauth', 'late']
+
+    # a cycle in 'after' falls back to priority order
+    modules = [fake('a', 2, after=['b']), fake('b', 1, after=['a']), fake('c', 3, after=[])]
+    scheduler = ModuleScheduler(modules, default_priority=5, max_workers=3)
+    assert scheduler.deps == {'b': set(), 'a': {'b'}, 'c': {'a', 'b'}}, scheduler.deps
+    started = []
+    scheduler.run(lambda module: started.append(module.__name__))
+    assert started == ['b', 'a', 'c']
+    print("scheduler: OK")
@@ -14,21 +14,37 @@ setup(
         'api',
         'api_calls',
         'bwmon',
+        'bwsim',
+        'bwstate',
+        'capengine',
         'conf_files',
         'config',
         'controller',
         'curlwrapper',
         'database',
+        'delta',
+        'expiry',
         'initscript',
         'iptables',
+        'journal',
         'logger',
+        'mailqueue',
         'net',
         'nodemanager',
+        'planner',
         'plcapi',
+        'pwcache',
+        'restarter',
         'safexmlrpc',
+        'scheduler',
         'slivermanager',
+        'tagindex',
+        'tcbackend',
         'ticket',
+        'timeseries',
         'tools',
+        'topology',
+        'trigger',
         'plugins.codemux',
         'plugins.hostmap',
         'plugins.interfaces',
@@ -3,14 +3,17 @@
 import sys
 import os, os.path
 import re
+import time
 import subprocess
 import pprint
 import random
+import threading
 
 import libvirt
 
 from account import Account
 import logger
+import tools
 import plnode.bwlimit as bwlimit
 import cgroups
 
@@ -53,6 +56,202 @@ except:
     logger.log("WARNING : using hard-wired constants instead of symbolic names for CONNECT_CLOSE*")
 
 connections = dict()
+connections_lock = threading.Lock()
+
+# what each lifecycle event means for the state of the domain
+EVENT_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED:   libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED:   libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN:  libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED:   libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED:   libvirt.VIR_DOMAIN_CRASHED,
+}
+
+
+# how listeners see the lifecycle events
+EVENT_KINDS = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED:   'started',
+    libvirt.VIR_DOMAIN_EVENT_RESUMED:   'started',
+    libvirt.VIR_DOMAIN_EVENT_STOPPED:   'stopped',
+    libvirt.VIR_DOMAIN_EVENT_CRASHED:   'crashed',
+}
+
+# functions called as listener(uri, name, kind, intentional) on lifecycle events
+# kind is 'started', 'stopped' or 'crashed'; intentional is True when
+# the domain was stopped by nodemanager itself, see expect_stop()
+lifecycle_listeners = []
+
+def add_lifecycle_listener(listener):
+    lifecycle_listeners.append(listener)
+
+
+def domain_uri(sliver_type):
+    # sliver_type comes from rec['type'] and is of the form sliver.{LXC,QEMU}
+    # so we need to lower case to lxc/qemu
+    return sliver_type.split('.')[1].lower() + ':///'
+
+
+class DomainStates:
+    """
+    A cache of the domains and their states, per connection uri.
+    It gets filled by one bulk query, and is then kept up to date by the
+    lifecycle events that libvirt sends. Should events not be available,
+    the bulk query is redone when the cache is older than REFRESH_PERIOD.
+    """
+
+    REFRESH_PERIOD = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # uri -> {name: (virDomain, state)}
+        self.domains = {}
+        # uri -> time of the last bulk query
+        self.refreshed = {}
+        # the uris for which we receive lifecycle events
+        self.watched = set()
+        # (uri, name) of the domains we are about to stop on purpose
+        self.stopping = set()
+
+    def refresh(self, uri, conn):
+        """one bulk query for all domains and their states"""
+        domains = {}
+        try:
+            for (dom, stats) in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE):
+                domains[dom.name()] = (dom, stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE))
+        except libvirt.libvirtError:
+            # not supported by all drivers
+            for dom in conn.listAllDomains(0):
+                domains[dom.name()] = (dom, dom.state()[0])
+        with self.lock:
+            self.domains[uri] = domains
+            self.refreshed[uri] = time.time()
+        logger.verbose("sliver_libvirt: {} domains found on {}".format(len(domains), uri))
+        return domains
+
+    def _fresh(self, uri):
+        if uri not in self.refreshed:
+            return False
+        return uri in self.watched \
+            or time.time() - self.refreshed[uri] < DomainStates.REFRESH_PERIOD
+
+    def get(self, uri, conn, name):
+        """(virDomain, state) for that domain, or None if unknown"""
+        if not self._fresh(uri):
+            self.refresh(uri, conn)
+        with self.lock:
+            return self.domains.get(uri, {}).get(name)
+
+    def update(self, uri, name, dom, state):
+        with self.lock:
+            self.domains.setdefault(uri, {})[name] = (dom, state)
+
+    def forget(self, uri, name):
+        with self.lock:
+            self.domains.get(uri, {}).pop(name, None)
+
+    def expect_stop(self, uri, name):
+        """to be called before stopping a domain on purpose"""
+        with self.lock:
+            self.stopping.add((uri, name))
+
+    def unexpect_stop(self, uri, name):
+        """
+        to be called when stopping the domain failed, e.g. because it was not
+        running: no event is coming, and its next stop would not be on purpose
+        """
+        with self.lock:
+            self.stopping.discard((uri, name))
+
+    def invalidate(self, uri):
+        with self.lock:
+            self.refreshed.pop(uri, None)
+            self.watched.discard(uri)
+
+    def watch(self, uri, conn):
+        """subscribe to the lifecycle events of all domains on conn"""
+        try:
+            conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._lifecycle_event, uri)
+            # so that isAlive() notices a dead daemon
+            conn.setKeepAlive(5, 3)
+            with self.lock:
+                self.watched.add(uri)
+        except:
+            logger.log_exc("sliver_libvirt: no lifecycle events from {}, will poll instead".format(uri))
+
+    def _lifecycle_event(self, conn, dom, event, detail, uri):
+        name = dom.name()
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.forget(uri, name)
+        elif event in EVENT_STATES:
+            self.update(uri, name, dom, EVENT_STATES[event])
+        elif event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            with self.lock:
+                known = self.domains.get(uri, {}).get(name)
+            # a redefined domain keeps its state
+            self.update(uri, name, dom, known[1] if known else libvirt.VIR_DOMAIN_SHUTOFF)
+        logger.verbose("sliver_libvirt: lifecycle event {} (detail {}) for {}"
+                       .format(event, detail, name))
+        kind = EVENT_KINDS.get(event)
+        if kind is None:
+            return
+        intentional = False
+        if kind == 'stopped':
+            with self.lock:
+                intentional = (uri, name) in self.stopping
+                self.stopping.discard((uri, name))
+        for listener in lifecycle_listeners:
+            try:
+                listener(uri, name, kind, intentional)
+            except:
+                logger.log_exc("sliver_libvirt: lifecycle listener failed", name=name)
+
+
+domain_states = DomainStates()
+
+_event_loop_started = False
+
+def _start_event_loop():
+    """libvirt wants this done before the first connection gets opened"""
+    global _event_loop_started
+    if _event_loop_started:
+        return
+    _event_loop_started = True
+    try:
+        libvirt.virEventRegisterDefaultImpl()
+    except:
+        logger.log_exc("sliver_libvirt: could not register the libvirt event loop")
+        return
+    def run():
+        while True:
+            try:
+                libvirt.virEventRunDefaultImpl()
+            except:
+                logger.log_exc("sliver_libvirt: libvirt event loop failed")
+                time.sleep(1)
+    tools.as_daemon_thread(run)
+
+
+def lookup_domain(sliver_type, name):
+    """the virDomain for name, preferably from the cache; raises libvirtError if there is none"""
+    uri = domain_uri(sliver_type)
+    conn = Sliver_Libvirt.getConnection(sliver_type)
+    known = domain_states.get(uri, conn, name)
+    if known is not None:
+        return known[0]
+    return conn.lookupByName(name)
+
+
+def is_domain_running(sliver_type, name):
+    """True if the domain exists and runs"""
+    uri = domain_uri(sliver_type)
+    conn = Sliver_Libvirt.getConnection(sliver_type)
+    known = domain_states.get(uri, conn, name)
+    if known is None:
+        return False
+    return known[1] == libvirt.VIR_DOMAIN_RUNNING
+
 
 # Common Libvirt code
 
@@ -68,26 +267,20 @@ class Sliver_Libvirt(Account):
         this call ensures the connection is alive
         and will reconnect if it appears to be necessary
         """
-        # sliver_type comes from rec['type'] and is of the form sliver.{LXC,QEMU}
-        # so we need to lower case to lxc/qemu
-        vtype = sliver_type.split('.')[1].lower()
-        uri = vtype + ':///'
-        if uri not in connections:
-            # create connection
+        uri = domain_uri(sliver_type)
+        with connections_lock:
+            conn = connections.get(uri)
+            # isAlive does not need a round trip to libvirtd
+            if conn is not None and conn.isAlive():
+                return conn
+            if conn is not None:
+                logger.log("libvirt connection to {} looks broken - reconnecting".format(uri))
+                domain_states.invalidate(uri)
+            _start_event_loop()
+            # if this fails then an expection is thrown outside of this function
             conn = libvirt.open(uri)
             connections[uri] = conn
-            return conn
-        else:
-            # connection already available : check for health
-            conn = connections[uri]
-            # see if a reconnection is needed
-            try:
-                numDomains = conn.numOfDomains()
-            except:
-                logger.log("libvirt connection to {} looks broken - reconnecting".format(uri))
-                conn = libvirt.open(uri)
-                # if this fails then an expection is thrown outside of this function
-                numDomains = conn.numOfDomains()
+            domain_states.watch(uri, conn)
             return conn
 
     def __init__(self, rec):
@@ -102,11 +295,12 @@ class Sliver_Libvirt(Account):
         self.slice_id = rec['slice_id']
         self.enabled = True
         self.conn = Sliver_Libvirt.getConnection(rec['type'])
+        self.uri = domain_uri(rec['type'])
         self.xid = bwlimit.get_xid(self.name)
 
         dom = None
         try:
-            dom = self.conn.lookupByName(self.name)
+            dom = lookup_domain(rec['type'], self.name)
         except:
             logger.log('sliver_libvirt: Domain {} does not exist. ' \
                        'Will try to create it again.'.format(self.name))
@@ -184,6 +378,7 @@ class Sliver_Libvirt(Account):
             try:
                 # create actually means start
                 self.dom.create()
+                domain_states.update(self.uri, self.name, self.dom, libvirt.VIR_DOMAIN_RUNNING)
             except Exception as e:
                 # XXX smbaker: attempt to resolve slivers that are stuck in
                 #   "failed to allocate free veth".
@@ -192,6 +387,7 @@ class Sliver_Libvirt(Account):
                      self.repair_veth()
                      logger.log("trying dom.create again")
                      self.dom.create()
+                     domain_states.update(self.uri, self.name, self.dom, libvirt.VIR_DOMAIN_RUNNING)
                 else:
                     raise
         else:
@@ -221,19 +417,36 @@ class Sliver_Libvirt(Account):
         bwlimit.ebtables("-D INPUT -i veth{} -j mark --set-mark {}"
                          .format(self.xid, self.xid))
 
+        domain_states.expect_stop(self.uri, self.name)
         try:
             self.dom.destroy()
         except:
+            domain_states.unexpect_stop(self.uri, self.name)
             logger.log_exc("in sliver_libvirt.stop", name=self.name)
+            return
+        domain_states.update(self.uri, self.name, self.dom, libvirt.VIR_DOMAIN_SHUTOFF)
 
     def is_running(self):
         ''' Return True if the domain is running '''
-        (state, _) = self.dom.state()
+        known = domain_states.get(self.uri, self.conn, self.name)
+        if known is not None:
+            state = known[1]
+        else:
+            (state, _) = self.dom.state()
+            domain_states.update(self.uri, self.name, self.dom, state)
         result = (state == libvirt.VIR_DOMAIN_RUNNING)
         logger.verbose('sliver_libvirt.is_running: {} => {}'
-                       .format(self, result))
+                       .format(self.name, result))
         return result
 
+    @classmethod
+    def running_names(cls, accounts):
+        ''' The names of all running domains; refreshes the whole domain cache '''
+        conn = Sliver_Libvirt.getConnection(cls.TYPE)
+        domains = domain_states.refresh(domain_uri(cls.TYPE), conn)
+        return {name for (name, (dom, state)) in domains.items()
+                if state == libvirt.VIR_DOMAIN_RUNNING}
+
     def configure(self, rec):
 
         #sliver.[LXC/QEMU] tolower case
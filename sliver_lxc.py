@@ -6,8 +6,6 @@ import subprocess
 import sys
 import time
 import os, os.path
-import grp
-from pwd import getpwnam
 from string import Template
 
 # vsys probably should not be a plugin
@@ -20,9 +18,11 @@ from plugins.vsys import removeSliverFromVsys, startService as vsysStartService
 import libvirt
 
 import logger
+import pwcache
 import plnode.bwlimit as bwlimit
 from initscript import Initscript
 from account import Account
+import sliver_libvirt
 from sliver_libvirt import Sliver_Libvirt
 
 BTRFS_TIMEOUT = 15*60
@@ -165,7 +165,7 @@ class Sliver_LXC(Sliver_Libvirt, Initscript):
 
         # Add slices group if not already present
         try:
-            group = grp.getgrnam('slices')
+            group = pwcache.getgrnam('slices')
         except:
             command = ['/usr/sbin/groupadd', 'slices']
             logger.log_call(command)
@@ -173,6 +173,7 @@ class Sliver_LXC(Sliver_Libvirt, Initscript):
         # Add unix account (TYPE is specified in the subclass)
         command = ['/usr/sbin/useradd', '-g', 'slices', '-s', Sliver_LXC.SHELL, name, '-p', '*']
         logger.log_call(command)
+        pwcache.invalidate()
         command = ['mkdir', '/home/{}/.ssh'.format(name)]
         logger.log_call(command)
 
@@ -208,7 +209,7 @@ class Sliver_LXC(Sliver_Libvirt, Initscript):
 
         uid = None
         try:
-            uid = getpwnam(name).pw_uid
+            uid = pwcache.getpwnam(name).pw_uid
         except KeyError:
             # keyerror will happen if user id was not created successfully
             logger.log_exc("exception while getting user id")
@@ -329,9 +330,11 @@ unset pathmunge
         # Lookup for the sliver before actually
         # defining it, just in case it was already defined.
         try:
-            dom = conn.lookupByName(name)
+            dom = sliver_libvirt.lookup_domain(Sliver_LXC.TYPE, name)
         except:
             dom = conn.defineXML(xml)
+            sliver_libvirt.domain_states.update(sliver_libvirt.domain_uri(Sliver_LXC.TYPE), name,
+                                                dom, libvirt.VIR_DOMAIN_SHUTOFF)
         logger.verbose('lxc_create: {} -> {}'.format(name, Sliver_Libvirt.dom_details(dom)))
 
 
@@ -346,7 +349,7 @@ unset pathmunge
 
         try:
             # Destroy libvirt domain
-            dom = conn.lookupByName(name)
+            dom = sliver_libvirt.lookup_domain(Sliver_LXC.TYPE, name)
         except:
             logger.verbose('sliver_lxc.destroy: Domain {} does not exist!'.format(name))
             return
@@ -357,19 +360,23 @@ unset pathmunge
 
         try:
             logger.log("sliver_lxc.destroy: destroying domain {}".format(name))
+            sliver_libvirt.domain_states.expect_stop(sliver_libvirt.domain_uri(Sliver_LXC.TYPE), name)
             dom.destroy()
         except:
+            sliver_libvirt.domain_states.unexpect_stop(sliver_libvirt.domain_uri(Sliver_LXC.TYPE), name)
             logger.verbose("sliver_lxc.destroy: Domain {} not running... continuing.".format(name))
 
         try:
             logger.log("sliver_lxc.destroy: undefining domain {}".format(name))
             dom.undefine()
+            sliver_libvirt.domain_states.forget(sliver_libvirt.domain_uri(Sliver_LXC.TYPE), name)
         except:
             logger.verbose('sliver_lxc.destroy: Domain {} is not defined... continuing.'.format(name))
 
         # Remove user after destroy domain to force logout
         command = ['/usr/sbin/userdel', '-f', '-r', name]
         logger.log_call(command)
+        pwcache.invalidate()
 
         # Remove rootfs of destroyed domain
         command = ['/usr/bin/rm', '-rf', containerDir]
@@ -31,6 +31,7 @@ import vserver
 
 import logger
 import tools
+import pwcache
 from account import Account
 from initscript import Initscript
 
@@ -122,6 +123,7 @@ class Sliver_VS(vserver.VServer, Account, Initscript):
         # slice name
         command += [ name, ]            
         logger.log_call(command, timeout=15*60)
+        pwcache.invalidate()
         # export slicename to the slice in /etc/slicename
         with open('/vservers/{}/etc/slicename'.format(name), 'w') as slicenamefile:
             slicenamefile.write(name)
@@ -142,6 +144,7 @@ class Sliver_VS(vserver.VServer, Account, Initscript):
         Account.umount_ssh_dir(name)
         logger.log("sliver_vs: destroying {}".format(name))
         logger.log_call(['/bin/bash', '-x', '/usr/sbin/vuserdel', name, ])
+        pwcache.invalidate()
 
 
     def configure(self, rec):
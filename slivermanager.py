@@ -16,6 +16,8 @@ import api, api_calls
 import database
 import account
 import controller
+import planner
+from tagindex import get_index
 
 try:
     import sliver_lxc
@@ -101,11 +103,9 @@ def adjustReservedSlivers (data):
             active_lease=lease
             break
 
+    tags = get_index(data)
     def is_system_sliver (sliver):
-        for d in sliver['attributes']:
-            if d['tagname']=='system' and d['value']:
-                return True
-        return False
+        return any(tags.get_all(sliver['name'], 'system'))
 
     # mark slivers as appropriate
     for sliver in data['slivers']:
@@ -124,14 +124,30 @@ def adjustReservedSlivers (data):
             # there is an active lease, mark it alive and the other not
             sliver['reservation_alive'] = sliver['name']==active_lease['name']
 
-@database.synchronized
 def GetSlivers(data, config = None, plc=None, fullupdate=True):
     """This function has two purposes.  One, convert GetSlivers() data
     into a more convenient format.  Two, even if no updates are coming
     in, use the GetSlivers() heartbeat as a cue to scan for expired
-    slivers."""
-
+    slivers.
+    The records are built without the database lock, that is only held
+    while they get merged into the database."""
     logger.verbose("slivermanager: Entering GetSlivers with fullupdate=%r"%fullupdate)
+    recs = build_records(data)
+    if recs is None:
+        return
+
+    with database.db_lock:
+        for rec in recs:
+            database.db.deliver_record(rec)
+        if fullupdate:
+            database.db.set_min_timestamp(data['timestamp'])
+        snapshot = database.db.prepare_sync()
+    # slivers are created here.
+    database.db.execute_sync(snapshot)
+
+def build_records(data):
+    """The database records for the slivers in GetSlivers() data,
+    or None if that data is not for us."""
     for key in list(data.keys()):
         logger.verbose('slivermanager: GetSlivers key : ' + key)
 
@@ -145,7 +161,7 @@ def GetSlivers(data, config = None, plc=None, fullupdate=True):
     except:
         logger.log_exc("slivermanager: GetSlivers failed to read /etc/planetlab/node_id")
 
-    if 'node_id' in data and data['node_id'] != node_id: return
+    if 'node_id' in data and data['node_id'] != node_id: return None
 
     if 'networks' in data:
         for network in data['networks']:
@@ -156,20 +172,22 @@ def GetSlivers(data, config = None, plc=None, fullupdate=True):
     iscripts_hash = {}
     if 'initscripts' not in data:
         logger.log_missing_data("slivermanager.GetSlivers", 'initscripts')
-        return
+        return None
     for initscript_rec in data['initscripts']:
         logger.verbose("slivermanager: initscript: %s" % initscript_rec['name'])
         iscripts_hash[str(initscript_rec['name'])] = initscript_rec['script']
 
     adjustReservedSlivers (data)
+    tags = get_index(data)
+    recs = []
     for sliver in data['slivers']:
         logger.verbose("slivermanager: %s: slivermanager.GetSlivers in slivers loop"%sliver['name'])
         rec = sliver.copy()
         rec.setdefault('timestamp', data['timestamp'])
 
         # convert attributes field to a proper dict
-        attributes = {}
-        for attr in rec.pop('attributes'): attributes[attr['tagname']] = attr['value']
+        rec.pop('attributes')
+        attributes = tags.as_dict(sliver['name'])
         rec.setdefault("attributes", attributes)
 
         # squash keys
@@ -220,15 +238,28 @@ def GetSlivers(data, config = None, plc=None, fullupdate=True):
         # also export tags in rspec so they make it to the sliver_vs.start call
         rspec['tags'] = attributes
 
-        database.db.deliver_record(rec)
-    if fullupdate:
-        database.db.set_min_timestamp(data['timestamp'])
-    # slivers are created here.
-    database.db.sync()
+        recs.append(rec)
+    return recs
+
+def dry_run(data):
+    """The planner.Plan that GetSlivers() would carry out for data;
+    nothing gets changed on the node."""
+    register_classes()
+    recs = build_records(data) or []
+    db = database.Database()
+    for rec in recs:
+        db.deliver_record(rec)
+    db._compute_effective_rspecs()
+    db._publish_snapshot(journal=False)
+    return planner.make_plan(db.snapshot(), planner.observe())
 
 def deliver_ticket(data):
     return GetSlivers(data, fullupdate=False)
 
+def register_classes():
+    account.register_class(sliver_class_to_register)
+    account.register_class(controller.Controller)
+
 def start():
     # No default allocation values for LXC yet, think if its necessary given
     # that they are also default allocation values in this module
@@ -236,8 +267,16 @@ def start():
         for resname, default_amount in sliver_vs.DEFAULT_ALLOCATION.items():
             DEFAULT_ALLOCATION[resname]=default_amount
 
-    account.register_class(sliver_class_to_register)
-    account.register_class(controller.Controller)
+    register_classes()
+    if implementation == 'lxc':
+        import restarter
+        import sliver_libvirt
+        restarter.start()
+        # the lifecycle events only flow once the connection is open
+        try:
+            sliver_libvirt.Sliver_Libvirt.getConnection(sliver_default_type)
+        except:
+            logger.log_exc("slivermanager: could not connect to libvirt")
     database.start()
     api_calls.deliver_ticket = deliver_ticket
     api.start()
@@ -249,12 +288,6 @@ def is_running (name):
         import vserver
         return vserver.VServer(name).is_running()
     else:
-        import libvirt
-        running = False
-        try:
-            conn = libvirt.open('lxc://')
-            dom  = conn.lookupByName(name)
-            running = dom.info()[0] == libvirt.VIR_DOMAIN_RUNNING
-        finally:
-            conn.close()
-        return running
+        # from the domain cache, rather than a connection per call
+        import sliver_libvirt
+        return sliver_libvirt.is_domain_running(sliver_default_type, name)
@@ -0,0 +1,142 @@
+"""
+An index on the tags (a.k.a. attributes) of the slivers in a GetSlivers payload.
+
+Each sliver comes with a list of {'tagname': .., 'value': ..} dicts, that
+used to be scanned linearly by every module looking for a given tag.
+The index is built once per payload, and is attached to the data passed to
+the modules; use get_index(data) to retrieve it.
+
+Tags may be multi-valued (e.g. several 'vsys' tags), so values are kept
+as lists in payload order; the plain get() and as_dict() accessors return
+the last value, like the dicts that modules used to build by hand.
+"""
+
+import logger
+
+# where the index gets stored in the GetSlivers data
+INDEX_KEY = '_tags'
+
+
+def _tagname(attribute):
+    # for legacy, try the old-fashioned 'name' as well
+    return attribute.get('tagname', attribute.get('name', ''))
+
+
+class TagIndex:
+
+    def __init__(self, slivers=None):
+        # slicename -> sliver
+        self.slivers = {}
+        # slicename -> {tagname: [attribute dicts]}
+        self.attributes = {}
+        # tagname -> [slicenames], in payload order
+        self.reverse = {}
+        for sliver in slivers or []:
+            self.add_sliver(sliver)
+
+    def add_sliver(self, sliver):
+        name = sliver['name']
+        self.slivers[name] = sliver
+        self.attributes[name] = {}
+        for attribute in sliver.get('attributes', []):
+            self.add_attribute(name, attribute)
+
+    def add_attribute(self, name, attribute):
+        """index an attribute dict; does not alter the sliver itself"""
+        tagname = _tagname(attribute)
+        tags = self.attributes.setdefault(name, {})
+        if tagname not in tags:
+            tags[tagname] = []
+            self.reverse.setdefault(tagname, []).append(name)
+        tags[tagname].append(attribute)
+
+    def sliver(self, name):
+        return self.slivers.get(name)
+
+    def names(self):
+        return list(self.slivers.keys())
+
+    def tagnames(self, name):
+        return list(self.attributes.get(name, {}).keys())
+
+    def get_attributes(self, name, tagname):
+        """the attribute dicts themselves, so they can be changed in place"""
+        return self.attributes.get(name, {}).get(tagname, [])
+
+    def get_all(self, name, tagname):
+        return [attribute['value'] for attribute in self.get_attributes(name, tagname)]
+
+    def get(self, name, tagname, default=None):
+        attributes = self.get_attributes(name, tagname)
+        return attributes[-1]['value'] if attributes else default
+
+    def has(self, name, tagname):
+        return bool(self.get_attributes(name, tagname))
+
+    def as_dict(self, name):
+        """a fresh {tagname: value} dict for that sliver"""
+        return {tagname: attributes[-1]['value']
+                for tagname, attributes in self.attributes.get(name, {}).items()}
+
+    def slivers_with(self, tagname):
+        """names of the slivers that have that tag, in payload order"""
+        return list(self.reverse.get(tagname, []))
+
+    def slivers_with_prefix(self, prefix):
+        """names of the slivers that have a tag starting with prefix, in payload order"""
+        found = set()
+        for tagname, names in self.reverse.items():
+            if tagname.startswith(prefix):
+                found.update(names)
+        return [name for name in self.slivers if name in found]
+
+    def subset(self, names):
+        """an index restricted to these slivers"""
+        subset = TagIndex()
+        for name in self.slivers:
+            if name in names:
+                subset.slivers[name] = self.slivers[name]
+                subset.attributes[name] = self.attributes[name]
+                for tagname in self.attributes[name]:
+                    subset.reverse.setdefault(tagname, []).append(name)
+        return subset
+
+
+def get_index(data):
+    """the index attached to data - built on the fly if needed"""
+    index = data.get(INDEX_KEY)
+    if index is None:
+        index = TagIndex(data.get('slivers', []))
+        data[INDEX_KEY] = index
+        logger.verbose("tagindex: indexed {} slivers and {} tagnames"
+                       .format(len(index.slivers), len(index.reverse)))
+    return index
+
+
+def without_index(data):
+    """a shallow copy of data suitable for saving or logging"""
+    return {key: value for key, value in data.items() if key != INDEX_KEY}
+
+
+# a little self-test
+if __name__ == '__main__':
+    data = {'slivers': [
+        {'name': 'a', 'attributes': [{'tagname': 'vsys', 'value': 'x'},
+                                     {'tagname': 'vsys', 'value': 'y'},
+                                     {'tagname': 'vsys_m', 'value': '2'}]},
+        {'name': 'b', 'attributes': [{'name': 'hmac', 'value': 'secret'},
+                                     {'tagname': 'vsys', 'value': 'z'}]},
+        {'name': 'c', 'attributes': []},
+    ]}
+    tags = get_index(data)
+    assert get_index(data) is tags
+    assert tags.get_all('a', 'vsys') == ['x', 'y']
+    assert tags.get('a', 'vsys') == 'y'
+    assert tags.get('b', 'hmac') == 'secret'
+    assert tags.get('c', 'hmac', 'none') == 'none'
+    assert tags.slivers_with('vsys') == ['a', 'b']
+    assert tags.slivers_with_prefix('vsys_') == ['a']
+    assert tags.as_dict('a') == {'vsys': 'y', 'vsys_m': '2'}
+    assert tags.subset({'b', 'c'}).slivers_with('vsys') == ['b']
+    assert INDEX_KEY not in without_index(data)
+    print("tagindex: OK")
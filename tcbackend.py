@@ -0,0 +1,347 @@
+"""
+How bwmon reads and changes the per-slice HTB classes.
+
+bwlimit forks tc for pretty much everything: two 'class show' dumps per
+bwmon run, and on top of that a 'class show' plus four tc commands for
+each slice that gets set, and a dump plus two commands for each slice
+that gets turned off. With hundreds of slivers that makes for hundreds of
+processes per run.
+
+Two backends are available, with the same interface:
+  (*) ShellBackend applies each change right away through bwlimit, as
+      bwmon always did; it is the fallback.
+  (*) NetlinkBackend dumps all the classes and their counters in one
+      rtnetlink request; changes are queued and applied on commit():
+      deletions as one batch of rtnetlink messages, and class creations
+      or changes - that would need the HTB rate tables computed here -
+      through a single 'tc -batch' run.
+Pending changes are committed before each dump so that it reflects them.
+
+dump() returns the same tuples as bwlimit.get():
+    (xid, share, minrate, maxrate, minexemptrate, maxexemptrate, bytes, exemptbytes)
+with the rates in bit/s.
+"""
+
+import os
+import socket
+import struct
+import subprocess
+
+try:
+    import plnode.bwlimit as bwlimit
+except ImportError:
+    # e.g. under bwsim, that brings its own kernel
+    bwlimit = None
+
+import logger
+
+TC = '/sbin/tc'
+
+# from linux/netlink.h and linux/rtnetlink.h
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+RTM_NEWTCLASS = 40
+RTM_DELTCLASS = 41
+RTM_GETTCLASS = 42
+# from linux/pkt_sched.h and linux/gen_stats.h
+TCA_KIND = 1
+TCA_OPTIONS = 2
+TCA_STATS = 3
+TCA_STATS2 = 7
+TCA_HTB_PARMS = 1
+TCA_HTB_RATE64 = 6
+TCA_HTB_CEIL64 = 7
+TCA_STATS_BASIC = 1
+
+NLMSGHDR = struct.Struct('=IHHII')
+TCMSG = struct.Struct('=BxxxiIII')
+RTATTR = struct.Struct('=HH')
+# struct tc_htb_opt: two tc_ratespec, then buffer, cbuffer, quantum, level, prio
+HTB_OPT = struct.Struct('=BBHhHI BBHhHI IIIII')
+
+# the parents of the slice classes, see bwlimit.init()
+PARENT = 0x00010010
+EXEMPT_PARENT = 0x00010020
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def parse_attrs(buffer, offset=0, end=None):
+    """type -> payload for the rtattrs in buffer[offset:end]"""
+    end = len(buffer) if end is None else end
+    attrs = {}
+    while offset + RTATTR.size <= end:
+        (length, kind) = RTATTR.unpack_from(buffer, offset)
+        if length < RTATTR.size:
+            break
+        # strip NLA_F_NESTED and NLA_F_NET_BYTEORDER
+        attrs[kind & 0x3fff] = buffer[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_class(message):
+    """
+    (handle, parent, rate, ceil, quantum, bytes) for an htb class, or None
+    message is a RTM_NEWTCLASS payload, i.e. without its nlmsghdr;
+    the rates are in byte/s
+    """
+    (family, ifindex, handle, parent, info) = TCMSG.unpack_from(message, 0)
+    attrs = parse_attrs(message, TCMSG.size)
+    if attrs.get(TCA_KIND, b'').rstrip(b'\0') != b'htb':
+        return None
+    options = parse_attrs(attrs.get(TCA_OPTIONS, b''))
+    if TCA_HTB_PARMS not in options:
+        return None
+    fields = HTB_OPT.unpack_from(options[TCA_HTB_PARMS])
+    (rate, ceil, quantum) = (fields[5], fields[11], fields[14])
+    # rates beyond 32 bits are passed separately
+    if TCA_HTB_RATE64 in options:
+        rate = struct.unpack('=Q', options[TCA_HTB_RATE64][:8])[0]
+    if TCA_HTB_CEIL64 in options:
+        ceil = struct.unpack('=Q', options[TCA_HTB_CEIL64][:8])[0]
+    sent = 0
+    stats2 = parse_attrs(attrs.get(TCA_STATS2, b''))
+    if TCA_STATS_BASIC in stats2:
+        sent = struct.unpack_from('=Q', stats2[TCA_STATS_BASIC])[0]
+    elif TCA_STATS in attrs:
+        sent = struct.unpack_from('=Q', attrs[TCA_STATS])[0]
+    return (handle, parent, rate, ceil, quantum, sent)
+
+
+def rates_from_classes(classes):
+    """turn parse_class() results into bwlimit.get() tuples"""
+    rates = {}
+    for (handle, parent, rate, ceil, quantum, sent) in classes:
+        if parent == PARENT:
+            (minimum, maximum, count) = ('min', 'max', 'bytes')
+        elif parent == EXEMPT_PARENT:
+            (minimum, maximum, count) = ('minexempt', 'maxexempt', 'exemptbytes')
+        else:
+            continue
+        xid = handle & 0x0fff
+        entry = rates.setdefault(xid, {'share': 1,
+                                       'min': bwlimit.bwmin, 'max': bwlimit.bwmin,
+                                       'minexempt': bwlimit.bwmin, 'maxexempt': bwlimit.bwmin,
+                                       'bytes': 0, 'exemptbytes': 0})
+        entry['share'] = max(1, quantum // bwlimit.quantum)
+        entry[minimum] = rate * 8
+        entry[maximum] = ceil * 8
+        entry[count] = sent
+    return [(xid, entry['share'], entry['min'], entry['max'],
+             entry['minexempt'], entry['maxexempt'], entry['bytes'], entry['exemptbytes'])
+            for (xid, entry) in sorted(rates.items())]
+
+
+def tc_commands(xid, dev, share, minrate, maxrate, minexemptrate, maxexemptrate, bwcap):
+    """the tc commands that bwlimit.on() would run, with the same sanity checks"""
+    maxrate = min(max(maxrate, bwlimit.bwmin), bwcap)
+    minrate = min(max(minrate, bwlimit.bwmin), maxrate)
+    maxexemptrate = min(max(maxexemptrate, bwlimit.bwmin), bwlimit.bwmax)
+    minexemptrate = min(max(minexemptrate, bwlimit.bwmin), maxexemptrate)
+    commands = []
+    for (parent, minor, low, high) in (
+            ('1:10', bwlimit.default_minor | xid, minrate, maxrate),
+            ('1:20', bwlimit.exempt_minor | xid, minexemptrate, maxexemptrate)):
+        commands.append("class replace dev %s parent %s classid 1:%x htb rate %dbit ceil %dbit quantum %d"
+                        % (dev, parent, minor, low, high, share * bwlimit.quantum))
+        commands.append("qdisc replace dev %s parent 1:%x handle %x pfifo" % (dev, minor, minor))
+    return commands
+
+
+class ShellBackend:
+
+    name = 'shell'
+
+    def dump(self, dev):
+        return bwlimit.get(dev = dev)
+
+    def set(self, xid, dev, share, minrate, maxrate, minexemptrate, maxexemptrate):
+        bwlimit.set(xid = xid, dev = dev, share = share,
+                    minrate = minrate, maxrate = maxrate,
+                    minexemptrate = minexemptrate, maxexemptrate = maxexemptrate)
+
+    def off(self, xid, dev):
+        bwlimit.off(xid, dev = dev)
+
+    def commit(self):
+        pass
+
+
+class NetlinkBackend:
+
+    name = 'netlink'
+
+    def __init__(self):
+        self.seq = 0
+        # dev -> {xid: set() arguments}, in order
+        self.pending_sets = {}
+        # dev -> xids
+        self.pending_offs = {}
+
+    def _socket(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, 0))
+        return sock
+
+    def _message(self, kind, flags, ifindex, handle=0, parent=0):
+        self.seq += 1
+        payload = TCMSG.pack(socket.AF_UNSPEC, ifindex, handle, parent, 0)
+        return (self.seq, NLMSGHDR.pack(NLMSGHDR.size + len(payload), kind,
+                                        flags, self.seq, 0) + payload)
+
+    def _receive(self, sock, seqs):
+        """yields (seq, kind, payload) for the answers to seqs, until all are done"""
+        pending = set(seqs)
+        while pending:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                (length, kind, flags, seq, pid) = NLMSGHDR.unpack_from(data, offset)
+                if length < NLMSGHDR.size:
+                    return
+                payload = data[offset + NLMSGHDR.size:offset + length]
+                offset += _align(length)
+                if seq not in pending:
+                    continue
+                # a dump ends with NLMSG_DONE, an ack or an error is a single message
+                if kind == NLMSG_DONE:
+                    pending.discard(seq)
+                    continue
+                if kind == NLMSG_ERROR or not flags & NLM_F_MULTI:
+                    pending.discard(seq)
+                yield (seq, kind, payload)
+
+    def dump(self, dev):
+        self.commit()
+        ifindex = socket.if_nametoindex(dev)
+        sock = self._socket()
+        try:
+            (seq, message) = self._message(RTM_GETTCLASS, NLM_F_REQUEST | NLM_F_DUMP, ifindex)
+            sock.send(message)
+            classes = []
+            for (seq, kind, payload) in self._receive(sock, [seq]):
+                if kind == NLMSG_ERROR:
+                    error = struct.unpack_from('=i', payload)[0]
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                elif kind == RTM_NEWTCLASS:
+                    parsed = parse_class(payload)
+                    if parsed is not None:
+                        classes.append(parsed)
+        finally:
+            sock.close()
+        return rates_from_classes(classes)
+
+    def set(self, xid, dev, share, minrate, maxrate, minexemptrate, maxexemptrate):
+        self.pending_sets.setdefault(dev, {})[xid] = \
+            (share, minrate, maxrate, minexemptrate, maxexemptrate)
+        offs = self.pending_offs.get(dev)
+        if offs:
+            offs.discard(xid)
+
+    def off(self, xid, dev):
+        self.pending_offs.setdefault(dev, set()).add(xid)
+        sets = self.pending_sets.get(dev)
+        if sets:
+            sets.pop(xid, None)
+
+    def commit(self):
+        (sets, self.pending_sets) = (self.pending_sets, {})
+        (offs, self.pending_offs) = (self.pending_offs, {})
+        for (dev, xids) in offs.items():
+            if xids:
+                self._delete(dev, xids)
+        for (dev, rates) in sets.items():
+            if rates:
+                self._batch(dev, rates)
+
+    def _delete(self, dev, xids):
+        ifindex = socket.if_nametoindex(dev)
+        messages = []
+        for xid in sorted(xids):
+            for minor in (bwlimit.default_minor, bwlimit.exempt_minor):
+                messages.append(self._message(RTM_DELTCLASS, NLM_F_REQUEST | NLM_F_ACK,
+                                              ifindex, handle=0x00010000 | minor | xid))
+        sock = self._socket()
+        try:
+            sock.send(b''.join(message for (seq, message) in messages))
+            for (seq, kind, payload) in self._receive(sock, [seq for (seq, message) in messages]):
+                error = struct.unpack_from('=i', payload)[0] if kind == NLMSG_ERROR else 0
+                if error:
+                    logger.verbose("tcbackend: could not delete class (%s)" % os.strerror(-error))
+        finally:
+            sock.close()
+        logger.verbose("tcbackend: removed the classes of %d slice(s) on %s" % (len(xids), dev))
+
+    def _batch(self, dev, rates):
+        bwcap = bwlimit.get_bwcap(dev)
+        commands = []
+        for (xid, args) in rates.items():
+            commands += tc_commands(xid, dev, *args, bwcap=bwcap)
+        process = subprocess.run([TC, '-force', '-batch', '-'], input="\n".join(commands) + "\n",
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            logger.log("tcbackend: tc -batch failed: %s" % process.stdout.strip())
+        logger.verbose("tcbackend: set the classes of %d slice(s) on %s" % (len(rates), dev))
+
+
+def get_backend(name='auto', dev=None):
+    """a backend by name - 'auto' means netlink if it works on dev, shell otherwise"""
+    if name == 'shell':
+        return ShellBackend()
+    if name == 'netlink':
+        return NetlinkBackend()
+    if name != 'auto':
+        raise ValueError("tcbackend: unknown backend %s" % name)
+    backend = NetlinkBackend()
+    try:
+        if not os.access(TC, os.X_OK):
+            raise OSError("%s not found" % TC)
+        if dev is not None:
+            backend.dump(dev)
+        return backend
+    except Exception as e:
+        logger.log("tcbackend: netlink not usable (%s), using tc" % e)
+        return ShellBackend()
+
+
+# a little self-test of the codec, against a made-up dump
+if __name__ == '__main__':
+    if bwlimit is None:
+        # same constants and sanity checks, without plnode
+        import bwsim
+        bwlimit = bwsim.FakeLimits()
+    def attr(kind, payload):
+        raw = RTATTR.pack(RTATTR.size + len(payload), kind) + payload
+        return raw + b'\0' * (_align(len(raw)) - len(raw))
+    def htb_class(handle, parent, rate, ceil, quantum, sent):
+        parms = HTB_OPT.pack(0, 1, 0, 0, 0, rate, 0, 1, 0, 0, 0, ceil, 0, 0, quantum, 0, 0)
+        basic = struct.pack('=QI', sent, 0) + b'\0' * 4
+        return TCMSG.pack(0, 2, handle, parent, 0) + attr(TCA_KIND, b'htb\0') \
+            + attr(TCA_OPTIONS, attr(TCA_HTB_PARMS, parms)) \
+            + attr(TCA_STATS2, attr(TCA_STATS_BASIC, basic))
+    xid = 0x123
+    classes = [parse_class(htb_class(0x10000 | bwlimit.default_minor | xid, PARENT,
+                                     1000, 125000, 2 * bwlimit.quantum, 4242)),
+               parse_class(htb_class(0x10000 | bwlimit.exempt_minor | xid, EXEMPT_PARENT,
+                                     1000, 250000, 2 * bwlimit.quantum, 17)),
+               parse_class(htb_class(0x10010, 0x10001, 1, 1, 1, 1))]
+    assert rates_from_classes(classes) == [(xid, 2, 8000, 1000000, 8000, 2000000, 4242, 17)]
+    commands = tc_commands(xid, 'eth0', 1, 0, 10**12, 0, 10**12, bwcap=10**9)
+    assert len(commands) == 4 and "ceil %dbit" % 10**9 in commands[0], commands
+    backend = NetlinkBackend()
+    backend.set(1, 'eth0', 1, 0, 0, 0, 0)
+    backend.off(1, 'eth0')
+    backend.off(2, 'eth0')
+    backend.set(2, 'eth0', 1, 0, 0, 0, 0)
+    assert backend.pending_sets == {'eth0': {2: (1, 0, 0, 0, 0)}}
+    assert backend.pending_offs == {'eth0': {1}}
+    print("tcbackend: OK")
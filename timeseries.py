@@ -0,0 +1,147 @@
+"""
+Fixed-size time series of byte counters.
+
+bwmon samples the HTB byte counters of all slices every few seconds,
+and keeps the last samples of each slice in a Ring, i.e. two arrays of
+doubles used as a circular buffer, so that memory use stays fixed however
+long nodemanager runs. From these a Ring computes
+  (*) rate(window)         : the average rate over the last window seconds
+  (*) ewma                 : an exponentially weighted moving average rate,
+                             updated on each sample, with time constant tau
+  (*) percentile(p, window): the p-th percentile of the rates between
+                             successive samples
+All rates are in counter units per second, i.e. bytes/s for bwmon.
+A counter that goes backwards, e.g. because its HTB class got re-created,
+is taken as a reset: that interval is ignored.
+"""
+
+import array
+import math
+import threading
+
+
+class Ring:
+
+    def __init__(self, size, tau=60.):
+        self.size = size
+        self.tau = tau
+        self.times = array.array('d', bytes(8 * size))
+        self.values = array.array('d', bytes(8 * size))
+        # index of the next sample to write, and number of valid samples
+        self.head = 0
+        self.count = 0
+        self.ewma = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, when, value):
+        if self.count:
+            (last_when, last_value) = self.last()
+            elapsed = when - last_when
+            if elapsed <= 0:
+                return
+            if value >= last_value:
+                rate = (value - last_value) / elapsed
+                if self.ewma is None:
+                    self.ewma = rate
+                else:
+                    weight = 1 - math.exp(-elapsed / self.tau)
+                    self.ewma += weight * (rate - self.ewma)
+        self.times[self.head] = when
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self):
+        index = (self.head - 1) % self.size
+        return (self.times[index], self.values[index])
+
+    def samples(self, window=None):
+        """(when, value) from oldest to newest, within the last window seconds"""
+        result = [(self.times[index % self.size], self.values[index % self.size])
+                  for index in range(self.head - self.count, self.head)]
+        if window is not None and result:
+            since = result[-1][0] - window
+            result = [sample for sample in result if sample[0] >= since]
+        return result
+
+    def rates(self, window=None):
+        """the rates between successive samples"""
+        samples = self.samples(window)
+        return [(value - previous) / (when - previous_when)
+                for ((previous_when, previous), (when, value)) in zip(samples, samples[1:])
+                if value >= previous]
+
+    def rate(self, window=None):
+        """the average rate over the window, leaving resets out; None without 2 samples"""
+        samples = self.samples(window)
+        if len(samples) < 2:
+            return None
+        (total, elapsed) = (0, 0)
+        for ((previous_when, previous), (when, value)) in zip(samples, samples[1:]):
+            if value >= previous:
+                total += value - previous
+                elapsed += when - previous_when
+        return total / elapsed if elapsed else None
+
+    def percentile(self, p, window=None):
+        """nearest-rank percentile of the rates; None without 2 samples"""
+        rates = sorted(self.rates(window))
+        if not rates:
+            return None
+        rank = max(1, int(math.ceil(p / 100. * len(rates))))
+        return rates[rank - 1]
+
+
+class Series:
+    """A set of named rings, safe to use from several threads"""
+
+    def __init__(self, size, tau=60.):
+        self.size = size
+        self.tau = tau
+        self.lock = threading.Lock()
+        self.rings = {}
+
+    def record(self, when, values):
+        """
+        add one sample for each key in values;
+        the rings of the keys not in values are dropped
+        """
+        with self.lock:
+            for key in list(self.rings):
+                if key not in values:
+                    del self.rings[key]
+            for (key, value) in values.items():
+                ring = self.rings.get(key)
+                if ring is None:
+                    ring = self.rings[key] = Ring(self.size, self.tau)
+                ring.append(when, value)
+
+    def query(self, function):
+        """key -> function(ring), with the rings locked"""
+        with self.lock:
+            return {key: function(ring) for (key, ring) in self.rings.items()}
+
+
+# a little self-test
+if __name__ == '__main__':
+    ring = Ring(10, tau=10)
+    assert ring.rate() is None and ring.percentile(95) is None
+    for second in range(20):
+        # 100 bytes/s, then 300 bytes/s over the last 5 seconds
+        ring.append(second, 100 * second if second < 15 else 1400 + 300 * (second - 14))
+    assert len(ring) == 10 and ring.samples()[0] == (10, 1000)
+    assert ring.rate(window=4) == 300
+    assert ring.rate() == (2900 - 1000) / 9
+    assert ring.percentile(40) == 100 and ring.percentile(50) == 300
+    assert 100 < ring.ewma < 300
+    # a counter reset is ignored
+    ring.append(20, 50)
+    ring.append(21, 150)
+    assert ring.rate(window=2) == 100
+    series = Series(5)
+    series.record(0, {'a': 0, 'b': 0})
+    series.record(10, {'a': 1000})
+    assert series.query(lambda ring: ring.rate()) == {'a': 100}
+    print("timeseries: OK")
@@ -21,11 +21,17 @@ PID_FILE = '/var/run/nodemanager.pid'
 ####################
 
 
+_default_if = None
+
+
 def get_default_if():
-    interface = get_if_from_hwaddr(get_hwaddr_from_plnode())
-    if not interface:
-        interface = "eth0"
-    return interface
+    global _default_if
+    if _default_if is None:
+        interface = get_if_from_hwaddr(get_hwaddr_from_plnode())
+        if not interface:
+            interface = "eth0"
+        _default_if = interface
+    return _default_if
 
 
 def get_hwaddr_from_plnode():
@@ -342,14 +348,8 @@ try:
 except:
     logger.log("Could not import 're', 'socket', or 'fileinput' python packages.")
 
-# TODO: is there anything better to do if the "libvirt", "sliver_libvirt",
-# and "sliver_lxc" are not in place?
-try:
-    import libvirt
-    from sliver_libvirt import Sliver_Libvirt
-    import sliver_lxc
-except:
-    logger.log("Could not import 'sliver_lxc' or 'libvirt' or 'sliver_libvirt'.")
+# "libvirt", "sliver_libvirt" and "sliver_lxc" are imported only where needed,
+# as loading them is costly and they are not available on all nodes
 ###################################################
 
 
@@ -492,6 +492,7 @@ def has_systemctl():
 
 
 def reboot_slivers():
+    from sliver_libvirt import Sliver_Libvirt, domain_states, domain_uri
     type = 'sliver.LXC'
     # connecting to the libvirtd
     connLibvirt = Sliver_Libvirt.getConnection(type)
@@ -510,10 +511,16 @@ def reboot_slivers():
             logger.log(
                 "tools: Trying to DESTROY/CREATE {} instead...".format(domain.name()))
             try:
-                result = domain.destroy()
+                domain_states.expect_stop(domain_uri(type), domain.name())
+                try:
+                    result = domain.destroy()
+                except:
+                    domain_states.unexpect_stop(domain_uri(type), domain.name())
+                    raise
                 if result == 0:
                     logger.log("tools: DESTROYED {}".format(domain.name()))
                 else:
+                    domain_states.unexpect_stop(domain_uri(type), domain.name())
                     logger.log(
                         "tools: FAILED in the DESTROY call of {}".format(domain.name()))
                 result = domain.create()
@@ -534,6 +541,7 @@ def reboot_slivers():
 
 
 def get_hosts_file_path(slicename):
+    import sliver_lxc
     containerDir = os.path.join(sliver_lxc.Sliver_LXC.CON_BASE_DIR, slicename)
     return os.path.join(containerDir, 'etc', 'hosts')
 
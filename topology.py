@@ -0,0 +1,231 @@
+"""
+CPU and NUMA topology of the node, for the whole-core scheduler.
+
+CoreSched used to read the sysfs topology files of each cpu and each
+memory node again on every database sync. get() now returns a Topology
+that is built once per process:
+  (*) cpus             : the online cpus
+  (*) core_siblings    : cpu -> the cpus in the same package
+  (*) thread_siblings  : cpu -> the cpus in the same core, i.e. SMT siblings
+  (*) cores            : the cores, each as the list of its threads
+  (*) nodes, node_cpus : the NUMA nodes, and node -> its cpus
+  (*) cpu_node         : cpu -> its node
+  (*) distances        : node -> node -> distance
+so that all of these are plain lookups. The cpusets are not part of it:
+they can change at any time, so read_list() reads them on each call.
+
+The topology only changes when cpus or memory nodes come and go: a
+thread listens to the kernel uevents, and has the next get() rebuild
+it on such events. Where uevents cannot be received, get() compares
+the online cpus and memory nodes instead, that takes two reads.
+"""
+
+import os
+import socket
+import threading
+
+import logger
+import tools
+
+SYSFS = '/sys/devices/system'
+# from linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+
+
+def parse_list(data):
+    """'0,1,2-3,5' -> [0, 1, 2, 3, 5], in order and without duplicates"""
+    units = []
+    data = data.strip()
+    if not data:
+        return units
+    for part in data.split(","):
+        unitRange = part.split("-")
+        if len(unitRange) == 1:
+            unitRange = (unitRange[0], unitRange[0])
+        for i in range(int(unitRange[0]), int(unitRange[1]) + 1):
+            if not i in units:
+                units.append(i)
+    return units
+
+
+def parse_mask(data):
+    """'00000000,0000000f' -> [0, 1, 2, 3]"""
+    mask = int(data.strip().replace(',', '') or '0', 16)
+    units = []
+    unit = 0
+    while mask:
+        if mask & 1:
+            units.append(unit)
+        mask >>= 1
+        unit += 1
+    return units
+
+
+def _read(path):
+    with open(path) as f:
+        return f.readline()
+
+
+def read_list(filename):
+    """the cpu or memory node list in filename, e.g. cpuset.cpus"""
+    return parse_list(_read(filename))
+
+
+def _online(root):
+    """the online cpus and memory nodes, as they read"""
+    try:
+        nodes = _read(os.path.join(root, 'node', 'online'))
+    except IOError:
+        nodes = None
+    return (_read(os.path.join(root, 'cpu', 'online')), nodes)
+
+
+class Topology:
+
+    def __init__(self, root=SYSFS):
+        self.root = root
+        self.online = _online(root)
+        self.cpus = parse_list(self.online[0])
+        self.core_siblings = {}
+        self.thread_siblings = {}
+        for cpu in self.cpus:
+            # core_siblings rather than core_siblings_list, as older kernels lack the latter
+            self.core_siblings[cpu] = self._mask('cpu', 'cpu%d' % cpu, 'topology', 'core_siblings')
+            self.thread_siblings[cpu] = self._mask('cpu', 'cpu%d' % cpu, 'topology', 'thread_siblings') \
+                or [cpu]
+        self.cores = []
+        seen = set()
+        for cpu in self.cpus:
+            if cpu not in seen:
+                threads = [thread for thread in self.thread_siblings[cpu] if thread in self.core_siblings]
+                seen.update(threads)
+                self.cores.append(threads)
+
+        self.nodes = parse_list(self.online[1] or '')
+        self.node_cpus = {}
+        self.cpu_node = {}
+        self.distances = {}
+        for node in self.nodes:
+            try:
+                self.node_cpus[node] = parse_list(_read(os.path.join(root, 'node', 'node%d' % node, 'cpulist')))
+            except IOError:
+                logger.log("topology: failed to locate memory node %d" % node)
+                continue
+            for cpu in self.node_cpus[node]:
+                self.cpu_node[cpu] = node
+            try:
+                distances = _read(os.path.join(root, 'node', 'node%d' % node, 'distance')).split()
+                self.distances[node] = dict(zip(self.nodes, [int(d) for d in distances]))
+            except IOError:
+                pass
+
+    def _mask(self, *path):
+        try:
+            return parse_mask(_read(os.path.join(self.root, *path)))
+        except IOError:
+            return []
+
+    def __repr__(self):
+        return "<Topology %d cpus in %d cores, %d nodes>" % (len(self.cpus), len(self.cores), len(self.nodes))
+
+
+def is_hotplug(message):
+    """whether a kernel uevent is about a cpu or a memory node coming or going"""
+    fields = message.split(b'\0')
+    header = fields[0]
+    if b'@' not in header:
+        return False
+    (action, devpath) = header.split(b'@', 1)
+    return action in (b'add', b'remove', b'online', b'offline') \
+        and (devpath.startswith(b'/devices/system/cpu/cpu') or devpath.startswith(b'/devices/system/node/node'))
+
+
+lock = threading.Lock()
+current = None
+# None until get() tries to listen to the uevents, then whether that worked
+listening = None
+
+
+def _listen():
+    """start the thread that drops the topology on hotplug events, if possible"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+    except (OSError, AttributeError) as e:
+        logger.log("topology: no uevents (%s) - polling the online cpus" % e)
+        return False
+    def run():
+        global current
+        while True:
+            try:
+                message = sock.recv(65536)
+            except OSError:
+                # e.g. ENOBUFS after a burst of events: some may be lost
+                message = b'online@/devices/system/cpu/cpu'
+            if is_hotplug(message):
+                logger.log("topology: %s - will rebuild" % message.split(b'\0')[0].decode(errors='replace'))
+                with lock:
+                    current = None
+    tools.as_daemon_thread(run)
+    return True
+
+
+def get(root=SYSFS):
+    """the current Topology"""
+    global current, listening
+    with lock:
+        if listening is None:
+            listening = _listen()
+        if current is not None and not listening:
+            if _online(current.root) != current.online:
+                current = None
+        if current is None:
+            current = Topology(root)
+            logger.verbose("topology: %r" % current)
+        return current
+
+
+# a little self-test, against a made-up sysfs: 2 nodes, 2 cores each, 2 threads per core
+if __name__ == '__main__':
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    def write(path, contents):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents + "\n")
+    write('cpu/online', '0-7')
+    for cpu in range(8):
+        node = cpu // 4
+        write('cpu/cpu%d/topology/core_siblings' % cpu, '00000000,%08x' % (0xf << (4 * node)))
+        write('cpu/cpu%d/topology/thread_siblings' % cpu, '%x' % (0x3 << (cpu - cpu % 2)))
+    write('node/online', '0-1')
+    write('node/node0/cpulist', '0-3')
+    write('node/node0/distance', '10 21')
+    write('node/node1/cpulist', '4,5-7')
+    write('node/node1/distance', '21 10')
+    write('cpuset.cpus', '0-2,4')
+
+    topology = Topology(root)
+    assert topology.cpus == list(range(8))
+    assert topology.core_siblings[5] == [4, 5, 6, 7] and topology.thread_siblings[5] == [4, 5]
+    assert topology.cores == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    assert topology.node_cpus == {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]} and topology.cpu_node[6] == 1
+    assert topology.distances[0][1] == 21 and topology.distances[1][1] == 10
+    assert read_list(os.path.join(root, 'cpuset.cpus')) == [0, 1, 2, 4]
+    write('cpuset.cpus', '0-1')
+    assert read_list(os.path.join(root, 'cpuset.cpus')) == [0, 1]
+    # without uevents, a memory node going offline is seen too
+    (current, listening) = (topology, False)
+    assert get(root) is topology
+    write('node/online', '0')
+    assert get(root) is not topology and get(root).nodes == [0]
+    assert parse_mask('80000000,00000001') == [0, 63]
+    assert parse_list('') == [] and parse_list('0,1,2-3,2') == [0, 1, 2, 3]
+    assert is_hotplug(b'offline@/devices/system/cpu/cpu3\0ACTION=offline\0SUBSYSTEM=cpu')
+    assert not is_hotplug(b'add@/devices/virtual/net/veth0\0ACTION=add')
+    print(topology)
+    print("topology: OK")
@@ -0,0 +1,123 @@
+"""
+"Sync now" hints for the nodemanager main loop.
+
+By default nodemanager polls PLC every period + random seconds.
+With hints enabled (nodemanager --hints), the main loop also wakes up
+when someone calls hint(), e.g. through the SyncNow API call.
+
+Hints are debounced: the loop waits for things to quieten down before
+syncing, and the quiet period grows while hints keep pouring in, up to
+MAX_DEBOUNCE. In any case two hint-triggered syncs are at least
+MIN_INTERVAL apart, so hints cannot raise the load on PLC much; the
+regular period + random delay remains the fallback.
+"""
+
+import threading
+import time
+
+import logger
+
+# quiet period after the last hint, that doubles when hints come in bursts
+MIN_DEBOUNCE = 2
+MAX_DEBOUNCE = 30
+# never sync more often than that because of hints
+MIN_INTERVAL = 30
+
+
+class Trigger:
+
+    def __init__(self, min_debounce=MIN_DEBOUNCE, max_debounce=MAX_DEBOUNCE,
+                 min_interval=MIN_INTERVAL, clock=time.time):
+        self.min_debounce = min_debounce
+        self.max_debounce = max_debounce
+        self.min_interval = min_interval
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.debounce = min_debounce
+        # the reasons of the hints received since last sync
+        self.reasons = []
+        self.first_hint = None
+        self.last_hint = None
+        self.last_sync = 0
+
+    def hint(self, reason="unspecified"):
+        with self.cond:
+            now = self.clock()
+            if self.last_hint is not None and now - self.last_hint < self.debounce:
+                # another one within the quiet period: be more patient
+                self.debounce = min(self.debounce * 2, self.max_debounce)
+            if self.first_hint is None:
+                self.first_hint = now
+            self.last_hint = now
+            self.reasons.append(reason)
+            self.cond.notify_all()
+        logger.verbose("trigger: received hint ({})".format(reason))
+
+    def _due(self, now):
+        """when a sync is due because of hints, or None"""
+        if self.last_hint is None:
+            return None
+        # don't let a steady flow of hints postpone the sync forever
+        due = min(self.last_hint + self.debounce, self.first_hint + self.max_debounce)
+        return max(due, self.last_sync + self.min_interval)
+
+    def wait(self, timeout):
+        """
+        Wait for at most timeout seconds, or until a sync is due because of hints.
+        Returns the list of hint reasons, empty when the timeout expired.
+        """
+        with self.cond:
+            deadline = self.clock() + timeout
+            while True:
+                now = self.clock()
+                due = self._due(now)
+                if due is not None and due <= now:
+                    reasons = self.reasons
+                    self._reset(now)
+                    return reasons
+                if now >= deadline:
+                    # regular sync - whatever hints we had get served as well
+                    self._reset(now)
+                    return []
+                self.cond.wait(min(deadline, due or deadline) - now)
+
+    def _reset(self, now):
+        if self.last_hint is None or now - self.last_hint >= self.debounce:
+            self.debounce = self.min_debounce
+        self.reasons = []
+        self.first_hint = None
+        self.last_hint = None
+        self.last_sync = now
+
+
+trigger = Trigger()
+
+
+def hint(reason="unspecified"):
+    """ask the main loop for a sync as soon as reasonable"""
+    trigger.hint(reason)
+
+
+# a little self-test
+if __name__ == '__main__':
+    t = Trigger(min_debounce=0.1, max_debounce=0.4, min_interval=0)
+    start = time.time()
+    assert t.wait(0.2) == []
+    assert time.time() - start >= 0.2
+    threading.Timer(0.05, t.hint, args=("test",)).start()
+    start = time.time()
+    assert t.wait(5) == ["test"]
+    assert time.time() - start < 1
+    for i in range(3):
+        t.hint("burst {}".format(i))
+    assert t.debounce == 0.4
+    start = time.time()
+    assert len(t.wait(5)) == 3
+    assert 0.3 < time.time() - start < 1
+    t = Trigger(min_debounce=0, max_debounce=0, min_interval=0.5)
+    t.last_sync = time.time()
+    t.hint("too soon")
+    start = time.time()
+    assert t.wait(5) == ["too soon"]
+    assert time.time() - start >= 0.4
+    print("trigger: OK")